@@ -1,26 +1,81 @@
 # Imports
 import os
 import uuid
-import random
-import string
-from flask import Flask, request, jsonify, send_from_directory
+import logging
+import base64
+import json
+import time
+from concurrent.futures import TimeoutError as FutureTimeout
+from flask import Flask, Response, request, jsonify, send_from_directory, stream_with_context
 from flask_cors import CORS
 from dotenv import load_dotenv
 from werkzeug.utils import secure_filename
+from sqlalchemy.exc import IntegrityError
 from flask_socketio import SocketIO, emit, join_room
 
-from db import db
-from src.models import Game, Player, RoundRecord
+from db import db, engine_options, green_database_driver
+from migrations import migrate
+from src.models import Game, Player, RoundRecord, FinishedJob
+from src.result_store import ResultStore, DEFAULT_MAX_ITEMS, DEFAULT_MAX_BYTES
+from src.room_codes import RoomCodeAllocator
+from src.message_queue import socketio_options
+from src.analysis_pool import AnalysisPool, AnalysisTimeout, PoolSaturated, DEFAULT_WORKERS, DEFAULT_TIMEOUT
+from src.metrics import configure_logging, metric_lines, share_metrics, render as render_metrics
+from src.result_cache import AnalysisCache, DEFAULT_MAX_ITEMS as CACHE_MAX_ITEMS, DEFAULT_MAX_BYTES as CACHE_MAX_BYTES
 
 load_dotenv() # Load environment variables from .env
+configure_logging() # LOG_LEVEL, DEBUG logs every analysis step
+share_metrics(os.getenv('METRICS_DIR')) # With several web workers /metrics sums the histograms of all of them
+logger = logging.getLogger(__name__)
 
-# Import your core functions from the src package
-from src.main import backend_main
+# The analysis pipeline (OpenCV, NumPy, the detector) is imported on first use,
+# so the game routes are served right after start up
+from src.pattern_recognition.inference_service import UndecodableImage, service_enabled, service_metrics
 
 # --- Flask App Configuration ---
 UPLOAD_FOLDER = 'static/uploads'
 OUTPUT_FOLDER = 'static/outputs'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
+UPLOAD_MIMETYPES = {'png': 'image/png', 'jpg': 'image/jpeg', 'jpeg': 'image/jpeg'}
+
+ROOM_CODE_ATTEMPTS = 5
+
+# Round history pages
+ROUNDS_PAGE_SIZE = 50
+ROUNDS_MAX_PAGE_SIZE = 500
+ROUNDS_STREAM_PAGE = 500
+
+# Uploads and generated images are kept in memory unless SAVE_UPLOADS=1
+SAVE_UPLOADS = os.getenv('SAVE_UPLOADS', '0') == '1'
+result_store = ResultStore(
+    max_items=int(os.getenv('RESULT_STORE_ITEMS', DEFAULT_MAX_ITEMS)),
+    max_bytes=int(os.getenv('RESULT_STORE_BYTES', DEFAULT_MAX_BYTES)),
+)
+
+# Repeated uploads are answered from a cache of detections and scores, kept in
+# memory or, with ANALYSIS_CACHE_PATH, in a SQLite file shared by the workers
+# ANALYSIS_CACHE_ITEMS=0 turns it off
+analysis_cache = None
+if int(os.getenv('ANALYSIS_CACHE_ITEMS', CACHE_MAX_ITEMS)) > 0:
+    analysis_cache = AnalysisCache(
+        max_items=int(os.getenv('ANALYSIS_CACHE_ITEMS', CACHE_MAX_ITEMS)),
+        max_bytes=int(os.getenv('ANALYSIS_CACHE_BYTES', CACHE_MAX_BYTES)),
+        path=os.getenv('ANALYSIS_CACHE_PATH') or None,
+    )
+
+# Uploads are analyzed in worker processes, at most ANALYSIS_QUEUE_LIMIT at a time,
+# a request waits at most ANALYSIS_TIMEOUT seconds for its result
+ANALYSIS_TIMEOUT = float(os.getenv('ANALYSIS_TIMEOUT', DEFAULT_TIMEOUT))
+analysis_pool = AnalysisPool(
+    workers=int(os.getenv('ANALYSIS_WORKERS', DEFAULT_WORKERS)),
+    queue_limit=int(os.environ['ANALYSIS_QUEUE_LIMIT']) if os.getenv('ANALYSIS_QUEUE_LIMIT') else None,
+    cache=analysis_cache,
+    timeout=ANALYSIS_TIMEOUT,
+)
+
+# Results of async analyses finished before their socket asked to watch them,
+# in the database shared by the web workers, for FINISHED_JOBS_TTL seconds
+FINISHED_JOBS_TTL = float(os.getenv('FINISHED_JOBS_TTL', 600))
 
 app = Flask(__name__)
 CORS(app) # Enable CORS for all routes
@@ -29,29 +84,71 @@ CORS(app) # Enable CORS for all routes
 # Fallback to local SQLite if DATABASE_URL is not set
 app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', 'sqlite:///local_development.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Pool size, overflow, pre-ping and recycle come from DB_POOL_* environment variables
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
+green_database_driver()
 
 db.init_app(app)
-socketio = SocketIO(app, cors_allowed_origins="*")
+# With several workers or nodes, SOCKETIO_MESSAGE_QUEUE fans the room events out to all of them
+socketio = SocketIO(app, cors_allowed_origins="*", **socketio_options())
 
 with app.app_context():
     # Import models here so they register with SQLAlchemy
     import src.models
     db.create_all()
+    # AUTO_MIGRATE=0 leaves the schema to `python migrations.py`
+    if os.getenv('AUTO_MIGRATE', '1') == '1':
+        migrate()
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['OUTPUT_FOLDER'] = OUTPUT_FOLDER
+if SAVE_UPLOADS:
+    os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+    os.makedirs(OUTPUT_FOLDER, exist_ok=True)
+
+# Warm up the analysis pipeline in the background once the server is running
+# WARM_UP=1 enables it, WARM_UP_DELAY is the number of seconds to wait first
+def warm_up_task(delay):
+    socketio.sleep(delay)
+    try:
+        analysis_pool.warm_up()
+        logger.info("Warm up finished")
+    except Exception as e:
+        logger.warning("Warm up failed: %s", e)
+
+if os.getenv('WARM_UP', '0') == '1':
+    socketio.start_background_task(warm_up_task, float(os.getenv('WARM_UP_DELAY', 1)))
 
 def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def data_url(data, mimetype):
+    if data is None:
+        return None
+    return f"data:{mimetype};base64,{base64.b64encode(data).decode('ascii')}"
+
 # --- General Helper ---
-def generate_room_code(length=6):
-    letters_and_digits = string.ascii_uppercase + string.digits
-    while True:
-        code = ''.join(random.choices(letters_and_digits, k=length))
-        if not Game.query.filter_by(game_code=code).first():
-            return code
+_room_codes = None
+
+def room_codes():
+    # Created on first use, it needs the database engine
+    global _room_codes
+    if _room_codes is None:
+        _room_codes = RoomCodeAllocator(db.engine)
+    return _room_codes
+
+def game_delta(game, players, record):
+    # Changes of one write: the game state, the changed balances and the new round
+    return {
+        'game_code': game.game_code,
+        'seq': game.seq,
+        'round_wind': game.round_wind,
+        'dealer_id': game.dealer_id,
+        'continues': game.continues,
+        'players': [{'id': player.id, 'money': player.money} for player in players],
+        'round': record.to_dict() if record is not None else None,
+    }
 
 def get_wind_from_dealer_distance(round_wind, dealer_id, seat_position):
     winds = ['East', 'South', 'West', 'North']
@@ -66,10 +163,17 @@ def create_game():
     players_names = data.get('players', ['Player 1', 'Player 2', 'Player 3', 'Player 4'])
     base_score = data.get('base_score', 0)
 
-    room_code = generate_room_code()
-    new_game = Game(game_code=room_code)
-    db.session.add(new_game)
-    db.session.flush()
+    # Codes never repeat, but a game created before the allocator may hold one
+    for attempt in range(ROOM_CODE_ATTEMPTS):
+        new_game = Game(game_code=room_codes().next_code())
+        db.session.add(new_game)
+        try:
+            db.session.flush()
+            break
+        except IntegrityError:
+            db.session.rollback()
+    else:
+        return jsonify({"error": "Could not allocate a room code"}), 503
 
     for i, name in enumerate(players_names):
         player = Player(
@@ -81,7 +185,7 @@ def create_game():
         db.session.add(player)
 
     db.session.commit()
-    return jsonify(new_game.to_dict()), 201
+    return jsonify(new_game.snapshot()), 201
 
 
 @app.route('/api/game/<room_code>', methods=['GET'])
@@ -89,12 +193,49 @@ def get_game(room_code):
     game = Game.query.filter_by(game_code=room_code).first()
     if not game:
         return jsonify({"error": "Game not found"}), 404
-    return jsonify(game.to_dict())
+    return jsonify(game.snapshot())
+
+
+@app.route('/api/game/<room_code>/summary', methods=['GET'])
+def get_game_summary(room_code):
+    game = Game.by_code(room_code)
+    if not game:
+        return jsonify({"error": "Game not found"}), 404
+    return jsonify(game.summary_dict())
+
+
+@app.route('/api/game/<room_code>/rounds', methods=['GET'])
+def get_game_rounds(room_code):
+    # Players are loaded first so the winner and loser of each round come from the identity map
+    game = Game.by_code(room_code)
+    if not game:
+        return jsonify({"error": "Game not found"}), 404
+
+    after = request.args.get('after', type=int)
+    if request.args.get('format') == 'ndjson':
+        # Stream the whole history one round per line, a page at a time
+        def generate():
+            last = after
+            while True:
+                page = game.rounds_page(after=last, limit=ROUNDS_STREAM_PAGE)
+                for r in page:
+                    yield json.dumps(r.to_dict()) + '\n'
+                if len(page) < ROUNDS_STREAM_PAGE:
+                    break
+                last = page[-1].id
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+    limit = min(max(request.args.get('limit', ROUNDS_PAGE_SIZE, type=int), 1), ROUNDS_MAX_PAGE_SIZE)
+    page = game.rounds_page(after=after, limit=limit)
+    return jsonify({
+        "rounds": [r.to_dict() for r in page],
+        "next_after": page[-1].id if len(page) == limit else None,
+    })
 
 
 @app.route('/api/game/<room_code>/win', methods=['POST'])
 def process_win(room_code):
-    game = Game.query.filter_by(game_code=room_code).first()
+    game = Game.by_code(room_code)
     if not game:
         return jsonify({"error": "Game not found"}), 404
 
@@ -112,16 +253,19 @@ def process_win(room_code):
 
     # Calculate payouts (simplified for this example - adjust to your real rules)
     payout = points
+    changed_players = [winner]
     if win_type == 'tsumo':
         for player in game.players:
             if player.id != winner.id:
                 player.money -= payout
                 winner.money += payout
+                changed_players.append(player)
     else: # ron
         loser = Player.query.get(loser_id)
         if loser and loser.game_id == game.id:
             loser.money -= payout
             winner.money += payout
+            changed_players.append(loser)
 
     # Apply Dealer/Round logic
     if is_dealer_win:
@@ -146,12 +290,31 @@ def process_win(room_code):
         is_dealer_win=is_dealer_win
     )
     db.session.add(record)
+
+    # Incremented in SQL so concurrent wins of the same game get distinct numbers
+    game.seq = Game.seq + 1
+    db.session.flush()
+    delta = game_delta(game, changed_players, record)
     db.session.commit()
 
-    # Emit socket io event
-    socketio.emit('game_updated', game.to_dict(), to=room_code)
+    # Emit socket io event with only what changed, clients resync on a gap in seq
+    socketio.emit('game_delta', delta, to=room_code)
     
-    return jsonify(game.to_dict())
+    return jsonify(delta)
+
+
+@app.route('/api/game/<room_code>/resync', methods=['GET'])
+def resync_game(room_code):
+    game = Game.query.filter_by(game_code=room_code).first()
+    if not game:
+        return jsonify({"error": "Game not found"}), 404
+
+    # A client that is already up to date only gets the sequence number back
+    since = request.args.get('since', type=int)
+    if since is not None and since == game.seq:
+        return jsonify({"seq": game.seq, "snapshot": None})
+    snapshot = game.snapshot()
+    return jsonify({"seq": snapshot['seq'], "snapshot": snapshot})
 
 
 @app.route('/api/game/<room_code>', methods=['DELETE'])
@@ -177,6 +340,108 @@ def on_join(data):
     join_room(room)
 
 
+def analysis_room(job_id):
+    return f"analysis:{job_id}"
+
+
+@socketio.on('watch_analysis')
+def on_watch_analysis(data):
+    # The result of an async analysis goes to the sockets that watch its job id,
+    # which only the uploader got back
+    job_id = str(data.get('job_id', ''))
+    join_room(analysis_room(job_id))
+    # Joined first, so a result stored after this read is still emitted to the room
+    job = db.session.get(FinishedJob, job_id)
+    if job is None:
+        return
+    payload, finished_at = job.payload, job.finished_at
+    # Only the watcher that deletes the row gets it, the client drops a repeat by job_id
+    taken = FinishedJob.query.filter_by(job_id=job_id).delete(synchronize_session=False)
+    db.session.commit()
+    if taken and finished_at >= time.time() - FINISHED_JOBS_TTL:
+        emit('analysis_result', json.loads(payload), to=request.sid)
+
+
+def store_finished_job(job_id, payload):
+    # Kept for a socket that starts watching after the result, on any worker
+    now = time.time()
+    with app.app_context():
+        try:
+            FinishedJob.query.filter(FinishedJob.finished_at < now - FINISHED_JOBS_TTL).delete(synchronize_session=False)
+            db.session.add(FinishedJob(job_id=job_id, payload=json.dumps(payload), finished_at=now))
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.warning("Could not store the result of job %s: %s", job_id, e)
+
+
+def analysis_settings(form):
+    return {
+        "round": form.get('round', 'east'),
+        "dealer": form.get('dealer', 'east'),
+        "continues": int(form.get('continues', 1)),
+        "dice": int(form.get('dice', 18)),
+        "seat": form.get('seat', 'east'),
+        "wins": form.get('wins', 'east'),
+        "base": int(form.get('base', 100)),
+        "bonus": int(form.get('bonus', 30)),
+    }
+
+def analysis_response(result, generated_png, image_bytes, ext, inline):
+    unique_id = str(uuid.uuid4())
+    response = {
+        "money": result.money,
+        "breakdown": result.breakdown,
+        "tai": result.tai,
+        "tai_items": [{"name": name, "tai": tai} for name, tai in result.tai_items],
+    }
+    upload_type = UPLOAD_MIMETYPES[ext]
+    if inline:
+        # Return the images in the response, nothing is kept on the server
+        response["uploaded_image"] = data_url(image_bytes, upload_type)
+        response["generated_image"] = data_url(generated_png, 'image/png')
+        response["uploaded_image_url"] = None
+        response["generated_image_url"] = None
+    elif SAVE_UPLOADS:
+        upload_filename = f"upload_{unique_id}.{ext}"
+        output_filename = f"result_{unique_id}.png"
+        with open(os.path.join(app.config['UPLOAD_FOLDER'], upload_filename), 'wb') as f:
+            f.write(image_bytes)
+        if generated_png is not None:
+            with open(os.path.join(app.config['OUTPUT_FOLDER'], output_filename), 'wb') as f:
+                f.write(generated_png)
+        response["uploaded_image_url"] = f"/static/uploads/{upload_filename}"
+        response["generated_image_url"] = f"/static/outputs/{output_filename}" if generated_png else None
+    else:
+        result_store.put(unique_id, {
+            "upload": (image_bytes, upload_type),
+            "generated": (generated_png, 'image/png') if generated_png else None,
+        })
+        response["uploaded_image_url"] = f"/api/results/{unique_id}/upload"
+        response["generated_image_url"] = f"/api/results/{unique_id}/generated" if generated_png else None
+    return response
+
+def analysis_error(e):
+    # The response and status of a failed analysis
+    if isinstance(e, UndecodableImage):
+        return {"error": str(e)}, 400
+    if isinstance(e, (AnalysisTimeout, FutureTimeout)):
+        return {"error": f"Analysis took longer than {ANALYSIS_TIMEOUT:g} s"}, 504
+    return {"error": str(e)}, 500
+
+def analysis_job_task(job_id, future, image_bytes, ext, inline):
+    # Waits in a background greenlet, the result goes to the sockets watching the job
+    try:
+        result, generated_png = future.result(timeout=ANALYSIS_TIMEOUT)
+        payload = analysis_response(result, generated_png, image_bytes, ext, inline)
+    except Exception as e:
+        payload, status = analysis_error(e)
+        payload["status"] = status
+    payload["job_id"] = job_id
+    store_finished_job(job_id, payload)
+    socketio.emit('analysis_result', payload, to=analysis_room(job_id))
+
+
 @app.route('/api/analyze', methods=['POST'])
 def analyze_hand():
     # Check if the post request has the file part
@@ -188,46 +453,86 @@ def analyze_hand():
     
     if file and allowed_file(file.filename):
         original_filename = secure_filename(file.filename)
-        # Generate generic unique ID
-        unique_id = str(uuid.uuid4())
-        
-        # Determine extension and create unique final filename
         ext = original_filename.rsplit('.', 1)[1].lower()
-        upload_filename = f"upload_{unique_id}.{ext}"
-        image_path = os.path.join(app.config['UPLOAD_FOLDER'], upload_filename)
-        file.save(image_path)
+        inline = request.form.get('inline', '0') == '1'
 
-        # Generate unique output filename for the generated image
-        output_filename = f"result_{unique_id}.png"
+        # async=1 returns a job id at once, the result is emitted as analysis_result
+        # to the sockets that send watch_analysis with that job id
+        run_async = request.form.get('async', '0') == '1'
+
+        # Read the upload straight from the request, it is decoded in memory
+        image_bytes = file.read()
+        if not image_bytes:
+            return jsonify({"error": "Empty file"}), 400
 
         # --- Call Your Backend Logic ---
         try:
-            others = {
-                "round": request.form.get('round', 'east'),
-                "dealer": request.form.get('dealer', 'east'),
-                "continues": int(request.form.get('continues', 1)),
-                "dice": int(request.form.get('dice', 18)),
-                "seat": request.form.get('seat', 'east'),
-                "wins": request.form.get('wins', 'east'),
-                "base": int(request.form.get('base', 100)),
-                "bonus": int(request.form.get('bonus', 30)),
-            }
-            final_money, final_breakdown = backend_main(others, output_filename=output_filename)
+            others = analysis_settings(request.form)
+            future = analysis_pool.submit(image_bytes, others)
+        except PoolSaturated as e:
+            return jsonify({"error": str(e)}), 503, {"Retry-After": str(e.retry_after)}
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        if run_async:
+            job_id = str(uuid.uuid4())
+            socketio.start_background_task(analysis_job_task, job_id, future, image_bytes, ext, inline)
+            return jsonify({"job_id": job_id}), 202
+
+        try:
+            result, generated_png = future.result(timeout=ANALYSIS_TIMEOUT)
             
             # Future Phase 3 Game Update Logic goes here (e.g. updating DB, socketio.emit)
-            
-            return jsonify({
-                "money": final_money,
-                "breakdown": final_breakdown,
-                "uploaded_image_url": f"/static/uploads/{upload_filename}",
-                "generated_image_url": f"/static/outputs/{output_filename}"
-            })
+
+            return jsonify(analysis_response(result, generated_png, image_bytes, ext, inline))
         except Exception as e:
-            return jsonify({"error": str(e)}), 500
+            payload, status = analysis_error(e)
+            return jsonify(payload), status
 
     return jsonify({"error": "Invalid file type"}), 400
 
 
+@app.route('/api/results/<result_id>/<name>', methods=['GET'])
+def get_result_image(result_id, name):
+    image = result_store.get(result_id, name)
+    if image is None:
+        return jsonify({"error": "Result not found or expired"}), 404
+    data, mimetype = image
+    return Response(data, mimetype=mimetype, headers={"Cache-Control": "private, max-age=3600"})
+
+
+@app.route('/api/inference/metrics', methods=['GET'])
+def inference_metrics():
+    if not service_enabled():
+        return jsonify({"error": "Inference service is not enabled"}), 404
+    try:
+        return jsonify(service_metrics())
+    except OSError as e:
+        return jsonify({"error": f"Inference service unavailable: {e}"}), 503
+
+
+@app.route('/api/analyze/stats', methods=['GET'])
+def analysis_stats():
+    return jsonify(analysis_pool.stats())
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    # Stage histograms of the analyses run by every web worker, plus the queue and cache state.
+    # The queue is per worker, so is the cache unless it is the shared SQLite file
+    stats = analysis_pool.stats()
+    lines = metric_lines("mahjong_analysis_queue_pending", "Analyses queued or running", stats["pending"], per_process=True)
+    lines += metric_lines("mahjong_analysis_queue_limit", "Analyses allowed in the queue", stats["queue_limit"], per_process=True)
+    if "cache" in stats:
+        cache = stats["cache"]
+        per_process = analysis_cache.path is None
+        lines += metric_lines("mahjong_analysis_cache_hits_total", "Analysis cache hits", {
+            stage: cache[stage]["hits"] for stage in ("detect", "score")}, kind="counter", label="stage", per_process=per_process)
+        lines += metric_lines("mahjong_analysis_cache_misses_total", "Analysis cache misses", {
+            stage: cache[stage]["misses"] for stage in ("detect", "score")}, kind="counter", label="stage", per_process=per_process)
+    return Response(render_metrics(lines), mimetype='text/plain; version=0.0.4')
+
+
 # Serve static files
 @app.route('/static/<path:folder>/<path:filename>')
 def serve_static(folder, filename):
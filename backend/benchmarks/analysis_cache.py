@@ -0,0 +1,78 @@
+import os
+import time
+import argparse
+import tempfile
+import threading
+
+from load_test import Client, free_port, start_server, percentile
+from analyze_latency import IMAGE_PATH, random_hand_detector, upload
+from src.pattern_recognition.inference_service import InferenceServer
+
+# Repeated uploads against two servers sharing one ANALYSIS_CACHE_PATH file:
+# the first upload runs the analysis, the repeats on either server and after
+# a restart are answered from the cache.
+# python benchmarks/analysis_cache.py --repeats 50
+def timed_uploads(port, image, count):
+    latencies = []
+    for _ in range(count):
+        start = time.perf_counter()
+        status, _ = upload(port, image)
+        if status != 200:
+            raise RuntimeError(f"/api/analyze failed with status {status}")
+        latencies.append(time.perf_counter() - start)
+    return sorted(latencies)
+
+
+def analysis_cache_test(repeats=50, workers=1):
+    with open(IMAGE_PATH, "rb") as f:
+        image = f.read()
+
+    service_address = f"127.0.0.1:{free_port()}"
+    service = InferenceServer(service_address, detector=random_hand_detector())
+    threading.Thread(target=service.serve_forever, daemon=True).start()
+
+    rows = []
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            env = dict(os.environ, WARM_UP="0", INFERENCE_ADDRESS=service_address, ANALYSIS_WORKERS=str(workers),
+                       DATABASE_URL=f"sqlite:///{os.path.join(tmp, 'analysis_cache.db')}",
+                       ANALYSIS_CACHE_PATH=os.path.join(tmp, "analysis_cache.sqlite"))
+            ports = [free_port(), free_port()]
+            servers = [start_server(port, env) for port in ports]
+            try:
+                rows.append(("first upload, server A", timed_uploads(ports[0], image, 1)))
+                rows.append(("repeats, server A", timed_uploads(ports[0], image, repeats)))
+                rows.append(("repeats, server B", timed_uploads(ports[1], image, repeats)))
+
+                # The entries outlive the process
+                servers[0].terminate()
+                servers[0].wait()
+                servers[0] = start_server(ports[0], env)
+                rows.append(("after restart, server A", timed_uploads(ports[0], image, repeats)))
+                stats = Client(ports[1]).request("GET", "/api/analyze/stats")[1]["cache"]
+            finally:
+                for server in servers:
+                    server.terminate()
+                    server.wait()
+    finally:
+        service.shutdown()
+
+    print(f"{'uploads of the same photo':<26} {'count':>6} {'p50 ms':>8} {'max ms':>8}")
+    for name, latencies in rows:
+        print(f"{name:<26} {len(latencies):>6} {1e3 * percentile(latencies, 0.5):>8.1f} {1e3 * latencies[-1]:>8.1f}")
+    print(f"Shared cache: {stats['items']} entries, detect {stats['detect']}, score {stats['score']}")
+    # Only the first upload runs the detector, every repeat is a hit of both stages
+    return stats["detect"]["misses"] == 1 and stats["score"]["hits"] == 3 * repeats
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Repeated uploads against servers sharing the analysis cache")
+    parser.add_argument("--repeats", type=int, default=50, help="Uploads of the same photo per step")
+    parser.add_argument("--workers", type=int, default=1, help="ANALYSIS_WORKERS of each server")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if not analysis_cache_test(args.repeats, args.workers):
+        raise SystemExit(1)
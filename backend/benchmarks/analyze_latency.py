@@ -0,0 +1,164 @@
+import os
+import sys
+import time
+import uuid
+import random
+import argparse
+import tempfile
+import threading
+import http.client
+from collections import defaultdict
+
+from load_test import Client, free_port, start_server, percentile, BACKEND_DIR
+
+sys.path.insert(0, BACKEND_DIR)
+from src.pattern_recognition.inference_service import InferenceServer
+from src.pattern_recognition.hand_decomposition import random_winning_hand, split_tiles
+
+# Latency of the game routes while uploads saturate /api/analyze. The same
+# load runs against a server analyzing in the request (ANALYSIS_WORKERS=0)
+# and against the process pool, get_game p99 must stay flat with the pool.
+# Without the YOLO weights, --hands random serves random winning hands from
+# an inference service in this process, so only scoring and rendering run in
+# the web server, which is the part the pool takes off the eventlet hub.
+# python benchmarks/analyze_latency.py --workers 0,2 --uploaders 8 --seconds 15
+IMAGE_PATH = os.path.join(BACKEND_DIR, "src", "test2.jpg")
+
+
+def random_hand_detector(seed=0):
+    rng = random.Random(seed)
+    lock = threading.Lock()
+
+    def detect(images, conf=0.5):
+        with lock:
+            return [split_tiles(random_winning_hand(rng)) for _ in images]
+    return detect
+
+
+def multipart(fields, filename, data):
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode("utf-8"))
+    parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+                 f'Content-Type: image/jpeg\r\n\r\n'.encode("utf-8") + data + b"\r\n")
+    parts.append(f"--{boundary}--\r\n".encode("utf-8"))
+    return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+
+def upload(port, image, timeout=120):
+    body, content_type = multipart({"seat": "east", "wins": "east"}, "hand.jpg", image)
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=timeout)
+    try:
+        conn.request("POST", "/api/analyze", body=body, headers={"Content-Type": content_type})
+        response = conn.getresponse()
+        response.read()
+        return response.status, response.getheader("Retry-After")
+    except (OSError, http.client.HTTPException):
+        return 599, None
+    finally:
+        conn.close()
+
+
+def run_uploader(port, image, deadline, statuses, latencies):
+    while time.time() < deadline:
+        start = time.perf_counter()
+        status, retry_after = upload(port, image)
+        statuses[status] += 1
+        if status == 200:
+            latencies.append(time.perf_counter() - start)
+        elif status == 503 and retry_after:
+            # Back off like a client would, at most a second so the queue stays full
+            time.sleep(min(1.0, float(retry_after)))
+
+
+def run_reader(port, room_code, deadline, latencies):
+    client = Client(port)
+    while time.time() < deadline:
+        start = time.perf_counter()
+        client.request("GET", f"/api/game/{room_code}")
+        latencies.append(time.perf_counter() - start)
+        time.sleep(0.01)
+
+
+def measure(port, room_code, image, seconds, readers, uploaders):
+    deadline = time.time() + seconds
+    reads, analyses = [], []
+    statuses = defaultdict(int)
+    threads = [threading.Thread(target=run_reader, args=(port, room_code, deadline, reads)) for _ in range(readers)]
+    threads += [threading.Thread(target=run_uploader, args=(port, image, deadline, statuses, analyses)) for _ in range(uploaders)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sorted(reads), sorted(analyses), dict(statuses)
+
+
+def analyze_latency(workers_list=(0, 2), uploaders=8, readers=4, seconds=15.0, queue_limit=None, hands="random"):
+    with open(IMAGE_PATH, "rb") as f:
+        image = f.read()
+
+    service = None
+    env = dict(os.environ, WARM_UP="0")
+    if hands == "random":
+        service_address = f"127.0.0.1:{free_port()}"
+        service = InferenceServer(service_address, detector=random_hand_detector())
+        threading.Thread(target=service.serve_forever, daemon=True).start()
+        env["INFERENCE_ADDRESS"] = service_address
+
+    rows = []
+    try:
+        for workers in workers_list:
+            with tempfile.TemporaryDirectory() as tmp:
+                server_env = dict(env, ANALYSIS_WORKERS=str(workers),
+                                  DATABASE_URL=f"sqlite:///{os.path.join(tmp, 'analyze_latency.db')}")
+                if queue_limit is not None:
+                    server_env["ANALYSIS_QUEUE_LIMIT"] = str(queue_limit)
+                port = free_port()
+                server = start_server(port, server_env)
+                try:
+                    room_code = Client(port).request("POST", "/api/game/create", {})[1]["game_code"]
+                    # Start the workers and fill the caches before measuring
+                    warm = [threading.Thread(target=upload, args=(port, image)) for _ in range(max(1, workers) * 2)]
+                    for thread in warm:
+                        thread.start()
+                    for thread in warm:
+                        thread.join()
+
+                    idle, _, _ = measure(port, room_code, image, seconds / 3, readers, 0)
+                    loaded, analyses, statuses = measure(port, room_code, image, seconds, readers, uploaders)
+                finally:
+                    server.terminate()
+                    server.wait()
+            rows.append((workers, idle, loaded, analyses, statuses))
+    finally:
+        if service is not None:
+            service.shutdown()
+
+    print(f"{readers} get_game readers, {uploaders} uploaders for {seconds:.0f} s, hands from {hands}")
+    print(f"{'workers':>7} {'idle p50':>9} {'idle p99':>9} {'busy p50':>9} {'busy p99':>9} {'analyze/s':>10} {'analyze p50':>12}  statuses")
+    for workers, idle, loaded, analyses, statuses in rows:
+        print(f"{workers:>7} {1e3 * percentile(idle, 0.5):>9.1f} {1e3 * percentile(idle, 0.99):>9.1f} "
+              f"{1e3 * percentile(loaded, 0.5):>9.1f} {1e3 * percentile(loaded, 0.99):>9.1f} "
+              f"{len(analyses) / seconds:>10.1f} {1e3 * percentile(analyses, 0.5) if analyses else 0.0:>12.1f}  {statuses}")
+    print("(latencies in ms, idle is get_game without uploads, busy while the uploaders saturate /api/analyze)")
+    return all(statuses.get(200, 0) > 0 for _, _, _, _, statuses in rows)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="get_game latency while /api/analyze is saturated")
+    parser.add_argument("--workers", default="0,2", help="Comma separated ANALYSIS_WORKERS values to compare")
+    parser.add_argument("--uploaders", type=int, default=8, help="Concurrent upload clients")
+    parser.add_argument("--readers", type=int, default=4, help="Concurrent get_game clients")
+    parser.add_argument("--seconds", type=float, default=15.0, help="Duration of the loaded run")
+    parser.add_argument("--queue-limit", type=int, default=None, help="ANALYSIS_QUEUE_LIMIT of the server")
+    parser.add_argument("--hands", choices=["random", "model"], default="random",
+                        help="random: random winning hands from a local inference service, model: the YOLO detector")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    workers_list = [int(w) for w in args.workers.split(",")]
+    if not analyze_latency(workers_list, args.uploaders, args.readers, args.seconds, args.queue_limit, args.hands):
+        raise SystemExit(1)
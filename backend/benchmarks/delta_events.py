@@ -0,0 +1,83 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+
+# Bytes sent to each client and server CPU per win: the game_delta event
+# against the full game snapshot that used to be broadcast on every win.
+# python benchmarks/delta_events.py --rounds 10 100 1000
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+
+def play_rounds(client, room_code, players, rounds):
+    for i in range(rounds):
+        client.post(f"/api/game/{room_code}/win",
+                    json={"winner_id": players[i % 4]["id"], "loser_id": players[(i + 1) % 4]["id"], "points": 1})
+
+
+def measure_game(app, socketio, rounds, wins):
+    from src.models import Game
+
+    client = app.test_client()
+    game = client.post("/api/game/create", json={}).get_json()
+    room_code, players = game["game_code"], game["players"]
+    play_rounds(client, room_code, players, rounds)
+
+    listener = socketio.test_client(app)
+    listener.emit("join_game", {"room_code": room_code})
+    listener.get_received()
+
+    delta_cpu = 0.0
+    for i in range(wins):
+        start = time.process_time()
+        client.post(f"/api/game/{room_code}/win",
+                    json={"winner_id": players[i % 4]["id"], "loser_id": players[(i + 1) % 4]["id"], "points": 1})
+        delta_cpu += time.process_time() - start
+    events = listener.get_received()
+    delta_bytes = sum(len(json.dumps(event["args"])) for event in events) / len(events)
+
+    # What the previous broadcast cost: load, serialize and encode the whole game
+    full_cpu = full_bytes = 0.0
+    with app.app_context():
+        for _ in range(wins):
+            start = time.process_time()
+            payload = json.dumps(Game.query.options(*Game._load_options(full=True)).filter_by(game_code=room_code).one().to_dict())
+            full_cpu += time.process_time() - start
+            full_bytes = len(payload)
+    listener.disconnect()
+    return {
+        "delta_bytes": delta_bytes,
+        "full_bytes": full_bytes,
+        "delta_cpu_ms": 1e3 * delta_cpu / wins,
+        "full_cpu_ms": 1e3 * full_cpu / wins,
+    }
+
+
+def benchmark_deltas(round_counts, wins=20):
+    from app import app, socketio
+
+    print("win CPU: whole process_win request with the delta event, "
+          "snapshot CPU: what the full broadcast added on top of it")
+    print(f"{'rounds':>8} {'delta B':>9} {'full B':>9} {'win CPU ms':>11} {'snapshot CPU ms':>16}")
+    for rounds in round_counts:
+        result = measure_game(app, socketio, rounds, wins)
+        print(f"{rounds:>8} {result['delta_bytes']:>9.0f} {result['full_bytes']:>9.0f} "
+              f"{result['delta_cpu_ms']:>11.2f} {result['full_cpu_ms']:>16.2f}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the game_delta event against full snapshots")
+    parser.add_argument("--rounds", type=int, nargs="+", default=[10, 100, 1000], help="Rounds played before measuring")
+    parser.add_argument("--wins", type=int, default=20, help="Wins measured per game")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        # Use a throw away database so the local one is not touched
+        os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tmp, 'delta_events.db')}"
+        benchmark_deltas(args.rounds, args.wins)
@@ -0,0 +1,152 @@
+import os
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.client
+from collections import defaultdict
+
+# Load test of the game routes against a server started like in production
+# (eventlet, one process). The database is a throw away SQLite file unless
+# --database-url points at a local Postgres.
+# python benchmarks/load_test.py --clients 32 --seconds 20
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SERVER = """
+import eventlet
+eventlet.monkey_patch()
+import sys
+from app import app, socketio
+socketio.run(app, host="127.0.0.1", port=int(sys.argv[1]), log_output=False)
+"""
+
+# Share of each route in the request mix
+MIX = [("create_game", 0.1), ("get_game", 0.6), ("process_win", 0.3)]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(port, env):
+    server = subprocess.Popen([sys.executable, "-c", SERVER, str(port)], cwd=BACKEND_DIR, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError("Server exited: " + server.stderr.read().decode(errors="replace")[-2000:])
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return server
+        except OSError:
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError("Server did not start in 30 s")
+
+
+class Client():
+    def __init__(self, port):
+        self.port = port
+        self.conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+
+    def request(self, method, path, body=None):
+        headers = {"Content-Type": "application/json"} if body is not None else {}
+        try:
+            self.conn.request(method, path, body=json.dumps(body) if body is not None else None, headers=headers)
+            response = self.conn.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException):
+            # Reconnect on the next request
+            self.conn.close()
+            self.conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=30)
+            return 599, None
+        return response.status, json.loads(data) if data else None
+
+
+def run_client(port, games, games_lock, deadline, seed, latencies, errors):
+    rng = random.Random(seed)
+    client = Client(port)
+    routes, weights = zip(*MIX)
+    while time.time() < deadline:
+        route = rng.choices(routes, weights)[0]
+        with games_lock:
+            game = rng.choice(games)
+
+        start = time.perf_counter()
+        if route == "create_game":
+            status, data = client.request("POST", "/api/game/create", {})
+        elif route == "get_game":
+            status, data = client.request("GET", f"/api/game/{game['game_code']}")
+        else:
+            winner, loser = rng.sample(game["players"], 2)
+            status, data = client.request("POST", f"/api/game/{game['game_code']}/win",
+                                          {"winner_id": winner["id"], "loser_id": loser["id"], "points": 1})
+        latencies[route].append(time.perf_counter() - start)
+
+        if status >= 400:
+            errors[route] += 1
+        elif route == "create_game":
+            with games_lock:
+                games.append(data)
+
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def load_test(clients=32, seconds=20.0, games=20, database_url=None):
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, WARM_UP="0",
+                   DATABASE_URL=database_url or f"sqlite:///{os.path.join(tmp, 'load_test.db')}")
+        port = free_port()
+        server = start_server(port, env)
+        try:
+            seed_client = Client(port)
+            created = [seed_client.request("POST", "/api/game/create", {})[1] for _ in range(games)]
+            games_lock = threading.Lock()
+            latencies = defaultdict(list)
+            errors = defaultdict(int)
+
+            deadline = time.time() + seconds
+            threads = [threading.Thread(target=run_client, args=(port, created, games_lock, deadline, i, latencies, errors))
+                       for i in range(clients)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            server.terminate()
+            server.wait()
+
+    total = sum(len(samples) for samples in latencies.values())
+    print(f"{clients} clients for {seconds:.0f} s, database {'Postgres' if database_url else 'SQLite'}: {total / seconds:,.0f} requests/s")
+    print(f"{'route':<12} {'requests':>9} {'errors':>7} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for route, _ in MIX:
+        ordered = sorted(latencies[route])
+        if not ordered:
+            continue
+        print(f"{route:<12} {len(ordered):>9} {errors[route]:>7} {1e3 * percentile(ordered, 0.5):>8.1f} "
+              f"{1e3 * percentile(ordered, 0.99):>8.1f} {1e3 * ordered[-1]:>8.1f}")
+    return sum(errors.values()) == 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load test of create_game, get_game and process_win")
+    parser.add_argument("--clients", type=int, default=32, help="Concurrent clients")
+    parser.add_argument("--seconds", type=float, default=20.0, help="Duration of the test")
+    parser.add_argument("--games", type=int, default=20, help="Games created before the test")
+    parser.add_argument("--database-url", default=None, help="e.g. postgresql://localhost/mahjong_load, default a temporary SQLite file")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if not load_test(args.clients, args.seconds, args.games, args.database_url):
+        raise SystemExit(1)
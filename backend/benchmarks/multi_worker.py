@@ -0,0 +1,138 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.client
+
+from load_test import Client, free_port, start_server, BACKEND_DIR
+
+# Multi-worker harness: N server processes share one database and fan the
+# Socket.IO room events out through the local message broker. Clients join
+# the room on every worker, wins are posted to random workers, and every
+# client must receive every game_delta event.
+# python benchmarks/multi_worker.py --workers 3 --clients 4 --wins 30
+
+
+class PollingClient():
+    """
+    Minimal Socket.IO client over Engine.IO long polling, no extra packages needed.
+    """
+    def __init__(self, port):
+        self.port = port
+        self.events = []
+        self.closed = threading.Event()
+        packets = self._get("/socket.io/?EIO=4&transport=polling")
+        self.sid = json.loads(packets[0][1:])["sid"]
+        self._post("40")
+        self._poll()  # the namespace connect answer
+
+    def _get(self, path):
+        conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=60)
+        conn.request("GET", path)
+        body = conn.getresponse().read().decode("utf-8")
+        conn.close()
+        return body.split("\x1e")
+
+    def _post(self, packet):
+        conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=60)
+        conn.request("POST", f"/socket.io/?EIO=4&transport=polling&sid={self.sid}", body=packet.encode("utf-8"))
+        conn.getresponse().read()
+        conn.close()
+
+    def _poll(self):
+        return self._get(f"/socket.io/?EIO=4&transport=polling&sid={self.sid}")
+
+    def emit(self, event, data):
+        self._post("42" + json.dumps([event, data]))
+
+    def listen(self):
+        while not self.closed.is_set():
+            for packet in self._poll():
+                if packet == "2":
+                    self._post("3")  # pong
+                elif packet.startswith("42"):
+                    self.events.append(json.loads(packet[2:]))
+                elif packet == "1":
+                    return
+
+    def close(self):
+        self.closed.set()
+        try:
+            self._post("1")
+        except OSError:
+            pass
+
+
+def multi_worker_test(workers=3, clients=4, wins=30, timeout=30.0):
+    with tempfile.TemporaryDirectory() as tmp:
+        broker_address = f"127.0.0.1:{free_port()}"
+        env = dict(os.environ, WARM_UP="0", DATABASE_URL=f"sqlite:///{os.path.join(tmp, 'multi_worker.db')}",
+                   SOCKETIO_MESSAGE_QUEUE=f"broker://{broker_address}")
+        broker = subprocess.Popen([sys.executable, "-m", "src.message_queue", "--serve", "--address", broker_address],
+                                  cwd=BACKEND_DIR, stdout=subprocess.DEVNULL)
+        ports = [free_port() for _ in range(workers)]
+        servers = []
+        listeners = []
+        try:
+            for port in ports:
+                servers.append(start_server(port, env))
+
+            http_clients = [Client(port) for port in ports]
+            game = http_clients[0].request("POST", "/api/game/create", {})[1]
+            room_code, players = game["game_code"], game["players"]
+
+            for port in ports:
+                for _ in range(clients):
+                    listener = PollingClient(port)
+                    listener.emit("join_game", {"room_code": room_code})
+                    thread = threading.Thread(target=listener.listen, daemon=True)
+                    thread.start()
+                    listeners.append(listener)
+            time.sleep(0.5)  # let every join reach its worker
+
+            rng = random.Random(0)
+            for _ in range(wins):
+                winner, loser = rng.sample(players, 2)
+                server = rng.randrange(workers)
+                status, _ = http_clients[server].request("POST", f"/api/game/{room_code}/win",
+                                                         {"winner_id": winner["id"], "loser_id": loser["id"], "points": 1})
+                if status != 200:
+                    raise RuntimeError(f"process_win failed with status {status}")
+
+            deadline = time.time() + timeout
+            while time.time() < deadline and any(len(listener.events) < wins for listener in listeners):
+                time.sleep(0.1)
+        finally:
+            for listener in listeners:
+                listener.close()
+            for process in servers + [broker]:
+                process.terminate()
+                process.wait()
+
+    received = [sorted(data["seq"] for name, data in listener.events if name == "game_delta") for listener in listeners]
+    complete = sum(seqs == list(range(1, wins + 1)) for seqs in received)
+    print(f"{workers} workers, {clients} clients per worker, {wins} wins posted to random workers")
+    for worker in range(workers):
+        counts = [len(seqs) for seqs in received[worker * clients:(worker + 1) * clients]]
+        print(f"  worker {worker}: game_delta events per client {counts}")
+    print(f"Clients that received every event: {complete}/{len(listeners)}")
+    return complete == len(listeners)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Check Socket.IO events reach the clients of every worker")
+    parser.add_argument("--workers", type=int, default=3, help="Server processes")
+    parser.add_argument("--clients", type=int, default=4, help="Socket.IO clients per worker")
+    parser.add_argument("--wins", type=int, default=30, help="Wins to post")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if not multi_worker_test(args.workers, args.clients, args.wins):
+        raise SystemExit(1)
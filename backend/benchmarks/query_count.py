@@ -0,0 +1,92 @@
+import os
+import sys
+import argparse
+import tempfile
+from contextlib import contextmanager
+
+# Query count regression check: the number of SQL statements of get_game and
+# process_win must not grow with the number of rounds of the game.
+# python benchmarks/query_count.py --rounds 10 50 200
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+
+@contextmanager
+def count_queries(engine):
+    from sqlalchemy import event
+
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+
+def measure(client, engine, room_code, players):
+    from src.models import _snapshots
+
+    counts = {}
+    # The first read builds the snapshot, the next one is cached
+    _snapshots.clear()
+    with count_queries(engine) as statements:
+        client.get(f"/api/game/{room_code}")
+    counts["get_game"] = len(statements)
+    with count_queries(engine) as statements:
+        client.get(f"/api/game/{room_code}")
+    counts["get_game cached"] = len(statements)
+    with count_queries(engine) as statements:
+        client.post(f"/api/game/{room_code}/win", json={"winner_id": players[0]["id"], "loser_id": players[1]["id"], "points": 10})
+    counts["process_win ron"] = len(statements)
+    with count_queries(engine) as statements:
+        client.post(f"/api/game/{room_code}/win", json={"winner_id": players[2]["id"], "win_type": "tsumo", "points": 10})
+    counts["process_win tsumo"] = len(statements)
+    return counts
+
+
+def check_query_counts(round_counts):
+    from app import app, db
+
+    client = app.test_client()
+    with app.app_context():
+        engine = db.engine
+
+    results = {}
+    for rounds in round_counts:
+        game = client.post("/api/game/create", json={}).get_json()
+        players = game["players"]
+        for i in range(rounds):
+            client.post(f"/api/game/{game['game_code']}/win",
+                        json={"winner_id": players[i % 4]["id"], "loser_id": players[(i + 1) % 4]["id"], "points": 1})
+        results[rounds] = measure(client, engine, game["game_code"], players)
+
+    names = list(results[round_counts[0]])
+    print(f"{'rounds':>8} " + " ".join(f"{name:>18}" for name in names))
+    for rounds, counts in results.items():
+        print(f"{rounds:>8} " + " ".join(f"{counts[name]:>18}" for name in names))
+
+    growing = [name for name in names if len({counts[name] for counts in results.values()}) > 1]
+    if growing:
+        print("Query count grows with the number of rounds:", ", ".join(growing))
+        return False
+    print("Query counts are constant")
+    return True
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Check the SQL statements per request stay constant as games grow")
+    parser.add_argument("--rounds", type=int, nargs="+", default=[10, 50, 200], help="Rounds played before measuring")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        # Use a throw away database so the local one is not touched
+        os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tmp, 'query_count.db')}"
+        if not check_query_counts(args.rounds):
+            raise SystemExit(1)
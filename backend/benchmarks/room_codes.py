@@ -0,0 +1,66 @@
+import os
+import time
+import argparse
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from load_test import Client, free_port, start_server
+
+# Concurrent game creation: several server processes share one database and
+# each reserves its own blocks of room codes. Every create must succeed and
+# every code must be unique.
+# python benchmarks/room_codes.py --games 20000 --servers 4 --clients 32
+def create_games(ports, games, clients):
+    local = threading.local()
+
+    def create(i):
+        if not hasattr(local, "client"):
+            local.client = Client(ports[i % len(ports)])
+        return local.client.request("POST", "/api/game/create", {"players": ["A", "B", "C", "D"]})
+
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        return list(executor.map(create, range(games)))
+
+
+def room_code_test(games=20000, servers=4, clients=32, database_url=None):
+    with tempfile.TemporaryDirectory() as tmp:
+        database_url = database_url or f"sqlite:///{os.path.join(tmp, 'room_codes.db')}"
+        env = dict(os.environ, WARM_UP="0", DATABASE_URL=database_url)
+        ports = [free_port() for _ in range(servers)]
+        processes = []
+        try:
+            # Started one after the other so only the first one migrates
+            for port in ports:
+                processes.append(start_server(port, env))
+            start = time.perf_counter()
+            results = create_games(ports, games, clients)
+            duration = time.perf_counter() - start
+        finally:
+            for process in processes:
+                process.terminate()
+                process.wait()
+
+    statuses = {}
+    for status, _ in results:
+        statuses[status] = statuses.get(status, 0) + 1
+    codes = [data["game_code"] for status, data in results if status == 201]
+    duplicates = len(codes) - len(set(codes))
+    print(f"{games} games from {clients} clients on {servers} servers in {duration:.1f} s ({games / duration:,.0f} games/s)")
+    print(f"Status codes: {statuses}, duplicate room codes: {duplicates}")
+    return statuses.get(201, 0) == games and duplicates == 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Create games concurrently and check the room codes")
+    parser.add_argument("--games", type=int, default=20000, help="Games to create")
+    parser.add_argument("--servers", type=int, default=4, help="Server processes sharing the database")
+    parser.add_argument("--clients", type=int, default=32, help="Concurrent clients")
+    parser.add_argument("--database-url", default=None, help="Default a temporary SQLite file")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if not room_code_test(args.games, args.servers, args.clients, args.database_url):
+        raise SystemExit(1)
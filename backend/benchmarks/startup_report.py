@@ -0,0 +1,96 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+from collections import defaultdict
+
+# Start up report of the Flask app: import time by package, and the time from
+# process start until a game endpoint answers.
+# python benchmarks/startup_report.py --top 15 --warm-up
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Child process that serves one game request, started from the parent's clock
+FIRST_REQUEST = """
+import json, time
+from app import app
+imported = time.time()
+client = app.test_client()
+code = client.post('/api/game/create', json={}).get_json()['game_code']
+status = client.get(f'/api/game/{code}').status_code
+print(json.dumps({"imported": imported, "answered": time.time(), "status": status}))
+"""
+
+WARM_UP = """
+import json, time
+start = time.perf_counter()
+from src.main import warm_up
+imported = time.perf_counter()
+warm_up()
+print(json.dumps({"import_s": imported - start, "warm_up_s": time.perf_counter() - imported}))
+"""
+
+
+def _run(code, env=None, flags=()):
+    return subprocess.run([sys.executable, *flags, "-c", code], cwd=BACKEND_DIR, env=env,
+                          capture_output=True, text=True, check=True)
+
+
+def import_times(env, module="app") -> dict:
+    """
+    Self time of every top level package imported by `module`, in seconds.
+    """
+    stderr = _run(f"import {module}", env=env, flags=("-X", "importtime")).stderr
+    totals = defaultdict(float)
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, _, name = line[len("import time:"):].split("|")
+        totals[name.strip().split(".")[0]] += int(self_us) / 1e6
+    return dict(totals)
+
+
+def first_request_time(env) -> dict:
+    start = time.time()
+    result = json.loads(_run(FIRST_REQUEST, env=env).stdout.strip().splitlines()[-1])
+    return {
+        "import_s": result["imported"] - start,
+        "first_response_s": result["answered"] - start,
+        "status": result["status"],
+    }
+
+
+def startup_report(top=15, warm_up=False):
+    # Use a throw away database so the local one is not touched
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, DATABASE_URL=f"sqlite:///{os.path.join(tmp, 'startup.db')}", WARM_UP="0")
+        totals = import_times(env)
+        result = first_request_time(env)
+
+    print(f"Import time of app: {sum(totals.values()):.3f} s")
+    for name, seconds in sorted(totals.items(), key=lambda item: -item[1])[:top]:
+        print(f"  {name:<28} {seconds * 1e3:>8.1f} ms")
+    print(f"Process start to app imported: {result['import_s']:.3f} s")
+    print(f"Process start to first game response: {result['first_response_s']:.3f} s (status {result['status']})")
+
+    if warm_up:
+        try:
+            result = json.loads(_run(WARM_UP).stdout.strip().splitlines()[-1])
+        except subprocess.CalledProcessError as e:
+            print("Warm up failed:", e.stderr.strip().splitlines()[-1])
+            return
+        print(f"Analysis pipeline: import {result['import_s']:.3f} s, warm up {result['warm_up_s']:.3f} s")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Start up time report of the backend")
+    parser.add_argument("--top", type=int, default=15, help="Number of packages to list")
+    parser.add_argument("--warm-up", action="store_true", help="Also time the warm up of the analysis pipeline")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    startup_report(args.top, args.warm_up)
@@ -0,0 +1,326 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import threading
+import statistics
+import importlib.util
+from io import BytesIO
+
+from load_test import free_port, BACKEND_DIR
+
+sys.path.insert(0, BACKEND_DIR)
+
+# Benchmark suite of the analysis pipeline, offline on the CPU. Every case
+# reports metrics in ms (lower is better) or per second (higher is better),
+# the median of --repeat rounds. --baseline compares with the JSON of an
+# earlier run and exits with 1 when a metric got worse by more than
+# --threshold, so a change can be gated on it, --report-only prints the
+# regressions without failing. Baselines only compare on the same machine,
+# run the suite on the base branch first.
+# Without the YOLO weights the detection case is skipped and /api/analyze
+# gets its hands from a local inference service with a fixed sequence.
+# python benchmarks/suite.py --output base.json
+# python benchmarks/suite.py --baseline base.json --threshold 0.25
+IMAGES = [os.path.join(BACKEND_DIR, "src", "test.png"), os.path.join(BACKEND_DIR, "src", "test2.jpg")]
+SETTINGS = {
+    "round": "east", "dealer": "south", "continues": 2, "dice": 18,
+    "seat": "east", "wins": "west", "base": 100, "bonus": 30,
+}
+DEFAULT_REPEAT = 5
+DEFAULT_THRESHOLD = 0.25
+
+
+class Skipped(Exception):
+    """
+    Raised by a case that cannot run here, with the reason.
+    """
+
+
+def lower(value, unit="ms"):
+    return {"value": value, "unit": unit, "better": "lower"}
+
+
+def higher(value, unit):
+    return {"value": value, "unit": unit, "better": "higher"}
+
+
+def median_seconds(run, repeat, setup=None):
+    # Median duration of repeat calls of run, setup runs untimed before each call
+    durations = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        run()
+        durations.append(time.perf_counter() - start)
+    return statistics.median(durations)
+
+
+def detector_available():
+    from src.pattern_recognition.tile_recognition import select_backend
+
+    if importlib.util.find_spec("ultralytics") is None:
+        return False, "ultralytics is not installed"
+    backend, path = select_backend()
+    if not os.path.exists(path):
+        return False, f"no {backend} weights at {path}"
+    return True, backend
+
+
+def decomposition_case(repeat, rounds=20):
+    """
+    The adversarial hands of hand_decomposition (many dui, ke and four of a kind)
+    through evaluate_hand with cold and warm caches, and through check_sets.
+    """
+    from src.pattern_recognition.main import evaluate_hand
+    from src.pattern_recognition.hand_decomposition import _benchmark_hands, _legacy_decompositions, clear_cache, split_tiles
+    from src.pattern_recognition.suit_table import load_table, suit_decompositions
+
+    hands = _benchmark_hands()
+    load_table()
+
+    def clear():
+        clear_cache()
+        suit_decompositions.cache_clear()
+
+    def evaluate_all(cold):
+        # A handful of hands is too short to time once, every call runs rounds of them
+        for _ in range(rounds):
+            if cold:
+                clear()
+            for hand in hands:
+                evaluate_hand(*split_tiles(hand), SETTINGS)
+
+    cold = median_seconds(lambda: evaluate_all(True), repeat)
+    warm = median_seconds(lambda: evaluate_all(False), repeat)
+    legacy = median_seconds(lambda: [_legacy_decompositions(hand, SETTINGS) for hand in hands], repeat)
+    return {
+        "evaluate_cold_ms_per_hand": lower(1e3 * cold / (rounds * len(hands))),
+        "evaluate_warm_ms_per_hand": lower(1e3 * warm / (rounds * len(hands))),
+        "check_sets_ms_per_hand": lower(1e3 * legacy / len(hands)),
+    }
+
+
+def scoring_case(repeat, hands=500, batch_size=100000):
+    """
+    Random winning hands (and some that do not win) through evaluate_hand, and as one score_hands batch.
+    """
+    from src.pattern_recognition.batch_scoring import _random_batch, _evaluate_rows, score_hands
+
+    sample = _random_batch(hands, seed=1)
+    batch = _random_batch(batch_size)
+    _evaluate_rows(sample, SETTINGS)  # load the suit table and fill the caches
+    single = median_seconds(lambda: _evaluate_rows(sample, SETTINGS), repeat)
+    batched = median_seconds(lambda: score_hands(batch, SETTINGS), repeat)
+    return {
+        "evaluate_hand_per_s": higher(hands / single, "hands/s"),
+        "score_hands_per_s": higher(batch_size / batched, "hands/s"),
+    }
+
+
+def rendering_case(repeat, hands=200):
+    """
+    17 random tiles drawn from the sprite atlas, and drawn and encoded to PNG without the render cache.
+    """
+    from src.tile_generation.main import _encode, load_atlas, render_tiles
+
+    rng = random.Random(0)
+    cases = [tuple(rng.randint(1, 42) for _ in range(17)) for _ in range(hands)]
+    load_atlas()
+    render = median_seconds(lambda: [render_tiles(tiles) for tiles in cases], repeat)
+    encode = median_seconds(lambda: [_encode(tiles) for tiles in cases], repeat)
+    return {
+        "render_per_s": higher(hands / render, "renders/s"),
+        "render_encode_per_s": higher(hands / encode, "renders/s"),
+    }
+
+
+def detection_case(repeat):
+    """
+    The detector on the sample photos, after the model is loaded.
+    """
+    import cv2
+
+    available, reason = detector_available()
+    if not available:
+        raise Skipped(reason)
+
+    from src.pattern_recognition.tile_recognition import detect_tiles, get_model
+
+    start = time.perf_counter()
+    get_model()
+    metrics = {"load_ms": lower(1e3 * (time.perf_counter() - start))}
+    for path in IMAGES:
+        image = cv2.imread(path, cv2.IMREAD_COLOR)
+        detect_tiles([image])
+        name = os.path.splitext(os.path.basename(path))[0]
+        metrics[f"{name}_ms"] = lower(1e3 * median_seconds(lambda: detect_tiles([image]), repeat))
+    return metrics
+
+
+def analyze_case(repeat):
+    """
+    POST /api/analyze of the sample photos through the Flask test client, in
+    the request (ANALYSIS_WORKERS=0) and without the analysis cache.
+    """
+    available, _ = detector_available()
+    service = None
+    tmp = tempfile.TemporaryDirectory()
+    env = {"WARM_UP": "0", "ANALYSIS_WORKERS": "0", "ANALYSIS_CACHE_ITEMS": "0",
+           "DATABASE_URL": f"sqlite:///{os.path.join(tmp.name, 'suite.db')}"}
+    if not available:
+        from src.pattern_recognition.inference_service import InferenceServer
+        from analyze_latency import random_hand_detector
+
+        env["INFERENCE_ADDRESS"] = f"127.0.0.1:{free_port()}"
+        service = InferenceServer(env["INFERENCE_ADDRESS"], detector=random_hand_detector())
+        threading.Thread(target=service.serve_forever, daemon=True).start()
+    saved = {name: os.environ.get(name) for name in env}
+    os.environ.update(env)
+
+    try:
+        # The app reads its settings when it is imported
+        from app import app
+
+        client = app.test_client()
+        metrics = {}
+        for path in IMAGES:
+            with open(path, "rb") as f:
+                image = f.read()
+            filename = os.path.basename(path)
+
+            def post():
+                response = client.post("/api/analyze", data={
+                    "file": (BytesIO(image), filename), "seat": "east", "wins": "west", "inline": "1"})
+                if response.status_code != 200:
+                    raise RuntimeError(f"/api/analyze of {filename} failed with {response.status_code}: {response.get_data(as_text=True)[:200]}")
+
+            post()
+            metrics[f"{os.path.splitext(filename)[0]}_ms"] = lower(1e3 * median_seconds(post, repeat))
+        return metrics
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        if service is not None:
+            service.shutdown()
+        tmp.cleanup()
+
+
+CASES = {
+    "decomposition": decomposition_case,
+    "scoring": scoring_case,
+    "rendering": rendering_case,
+    "detection": detection_case,
+    "analyze": analyze_case,
+}
+
+
+def run_suite(names, repeat=DEFAULT_REPEAT) -> dict:
+    """
+    Run the cases.
+    Returns:
+        report: dict, the machine and {"status", "metrics" or "reason"} of every case.
+    """
+    cases = {}
+    for name in names:
+        start = time.perf_counter()
+        try:
+            cases[name] = {"status": "ok", "metrics": CASES[name](repeat)}
+        except Skipped as e:
+            cases[name] = {"status": "skipped", "reason": str(e)}
+        except Exception as e:
+            cases[name] = {"status": "error", "reason": f"{type(e).__name__}: {e}"}
+        cases[name]["seconds"] = time.perf_counter() - start
+        print(f"{name:<14} {cases[name]['status']:<8} {cases[name]['seconds']:>6.1f} s", file=sys.stderr)
+    return {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "machine": {"python": platform.python_version(), "platform": platform.platform(),
+                    "processor": platform.processor(), "cpus": os.cpu_count()},
+        "repeat": repeat,
+        "cases": cases,
+    }
+
+
+def compare(report, baseline, threshold=DEFAULT_THRESHOLD) -> list:
+    """
+    Compare the metrics of report with those of baseline.
+    Returns:
+        rows: list of tuple, (case, metric, unit, baseline, current, change, regressed),
+        change is positive when the metric got worse.
+    """
+    rows = []
+    for name, case in report["cases"].items():
+        base_case = baseline.get("cases", {}).get(name, {})
+        if case["status"] != "ok" or base_case.get("status") != "ok":
+            continue
+        for metric, current in case["metrics"].items():
+            base = base_case["metrics"].get(metric)
+            if base is None or not base["value"]:
+                continue
+            if current["better"] == "lower":
+                change = current["value"] / base["value"] - 1
+            else:
+                change = base["value"] / current["value"] - 1 if current["value"] else float("inf")
+            rows.append((name, metric, current["unit"], base["value"], current["value"], change, change > threshold))
+    return rows
+
+
+def print_report(report, rows=None):
+    print(f"{'case':<14} {'metric':<28} {'value':>14} {'unit':<10}{'       baseline    change' if rows is not None else ''}")
+    compared = {(name, metric): row for name, metric, *row in rows or []}
+    for name, case in report["cases"].items():
+        if case["status"] != "ok":
+            print(f"{name:<14} {case['status']}: {case['reason']}")
+            continue
+        for metric, current in case["metrics"].items():
+            line = f"{name:<14} {metric:<28} {current['value']:>14.3f} {current['unit']:<10}"
+            if (name, metric) in compared:
+                _, base, _, change, regressed = compared[(name, metric)]
+                line += f" {base:>14.3f} {100 * change:>+8.1f}%{'  REGRESSION' if regressed else ''}"
+            print(line)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark suite of the analysis pipeline")
+    parser.add_argument("--cases", default=",".join(CASES), help="Comma separated cases to run")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT, help="Timed rounds of each metric, the median is kept")
+    parser.add_argument("--output", default=None, help="Write the report as JSON to this file")
+    parser.add_argument("--baseline", default=None, help="JSON report of an earlier run to compare with")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="Relative slow down of a metric counted as a regression")
+    parser.add_argument("--report-only", action="store_true", help="Print the regressions but only fail on errors")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    names = [name for name in args.cases.split(",") if name]
+    unknown = [name for name in names if name not in CASES]
+    if unknown:
+        raise SystemExit(f"Unknown cases: {', '.join(unknown)}, choose from {', '.join(CASES)}")
+
+    report = run_suite(names, max(1, args.repeat))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    rows = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            rows = compare(report, json.load(f), args.threshold)
+    print_report(report, rows)
+
+    failed = [name for name, case in report["cases"].items() if case["status"] == "error"]
+    regressions = [f"{name}.{metric}" for name, metric, *_, regressed in rows or [] if regressed]
+    if regressions:
+        print(f"Regressions over {100 * args.threshold:.0f}%: {', '.join(regressions)}")
+    if failed or (regressions and not args.report_only):
+        raise SystemExit(1)
@@ -1,3 +1,42 @@
+import os
+
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.engine import make_url
 
 db = SQLAlchemy()
+
+
+def engine_options(database_url):
+    """
+    Connection pool settings from the environment.
+    Under eventlet every request is a green thread sharing one process, so the
+    pool is sized for concurrent requests and dead connections are detected
+    before use instead of failing a request.
+    """
+    options = {
+        "pool_pre_ping": os.getenv("DB_POOL_PRE_PING", "1") == "1",
+        "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", 1800)),
+    }
+    # In-memory SQLite (sqlite:// or sqlite:///:memory:) uses a single connection pool without these settings
+    url = make_url(database_url)
+    if url.get_backend_name() != "sqlite" or url.database not in (None, "", ":memory:"):
+        options["pool_size"] = int(os.getenv("DB_POOL_SIZE", 10))
+        options["max_overflow"] = int(os.getenv("DB_MAX_OVERFLOW", 20))
+        options["pool_timeout"] = float(os.getenv("DB_POOL_TIMEOUT", 10))
+    return options
+
+
+def green_database_driver():
+    """
+    Make psycopg2 yield to other green threads while it waits on Postgres.
+    Only needed when the process runs under eventlet, psycogreen is optional.
+    """
+    try:
+        from eventlet import patcher
+        if not patcher.is_monkey_patched("socket"):
+            return False
+        from psycogreen.eventlet import patch_psycopg
+    except ImportError:
+        return False
+    patch_psycopg()
+    return True
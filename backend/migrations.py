@@ -0,0 +1,130 @@
+import logging
+import argparse
+
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import DBAPIError
+
+from db import db
+
+# Versioned schema migrations. db.create_all only creates missing tables, so
+# every change to an existing table is a numbered step here. Steps check what
+# already exists, so a database created by create_all is simply stamped.
+# python migrations.py            apply pending migrations
+# python migrations.py --status   show the current version
+VERSION_TABLE = "schema_version"
+
+logger = logging.getLogger(__name__)
+
+
+def _columns(conn, table):
+    return {column["name"] for column in inspect(conn).get_columns(table)}
+
+
+def _indexes(conn, table):
+    return {index["name"] for index in inspect(conn).get_indexes(table)}
+
+
+def add_column(conn, table, name, ddl):
+    if name not in _columns(conn, table):
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {name} {ddl}"))
+
+
+def create_index(conn, table, name, columns):
+    if name not in _indexes(conn, table):
+        conn.execute(text(f"CREATE INDEX {name} ON {table} ({', '.join(columns)})"))
+
+
+def _add_game_seq(conn):
+    add_column(conn, "games", "seq", "INTEGER DEFAULT 0 NOT NULL")
+
+
+def _add_rounds_keyset_index(conn):
+    create_index(conn, "round_records", "ix_round_records_game_id_id", ["game_id", "id"])
+
+
+def _add_foreign_key_indexes(conn):
+    # round_records.game_id is covered by ix_round_records_game_id_id
+    create_index(conn, "players", "ix_players_game_id", ["game_id"])
+    create_index(conn, "round_records", "ix_round_records_winner_id", ["winner_id"])
+    create_index(conn, "round_records", "ix_round_records_loser_id", ["loser_id"])
+
+
+def _add_room_code_counter(conn):
+    conn.execute(text("CREATE TABLE IF NOT EXISTS room_code_counter (id INTEGER PRIMARY KEY, value BIGINT NOT NULL DEFAULT 0)"))
+    conn.execute(text("INSERT INTO room_code_counter (id, value) SELECT 1, 0 WHERE NOT EXISTS (SELECT 1 FROM room_code_counter WHERE id = 1)"))
+
+
+def _add_room_code_secret(conn):
+    # The key of the room code permutation, set by the first allocator that runs
+    add_column(conn, "room_code_counter", "secret", "VARCHAR(64)")
+
+
+def _add_finished_jobs(conn):
+    conn.execute(text("CREATE TABLE IF NOT EXISTS finished_jobs (job_id VARCHAR(36) PRIMARY KEY, payload TEXT NOT NULL, finished_at FLOAT NOT NULL)"))
+
+
+# (version, description, step), in order
+MIGRATIONS = [
+    (1, "add games.seq", _add_game_seq),
+    (2, "index round_records (game_id, id)", _add_rounds_keyset_index),
+    (3, "index the foreign keys of players and round_records", _add_foreign_key_indexes),
+    (4, "add the room code counter", _add_room_code_counter),
+    (5, "add the room code key", _add_room_code_secret),
+    (6, "add the finished async analyses", _add_finished_jobs),
+]
+
+
+def current_version(conn):
+    if not inspect(conn).has_table(VERSION_TABLE):
+        return 0
+    return conn.execute(text(f"SELECT MAX(version) FROM {VERSION_TABLE}")).scalar() or 0
+
+
+def migrate(engine=None):
+    """
+    Apply the pending migrations, each in its own transaction.
+    Returns:
+        version: int, the schema version after migrating.
+    """
+    engine = engine or db.engine
+    with engine.begin() as conn:
+        conn.execute(text(f"CREATE TABLE IF NOT EXISTS {VERSION_TABLE} (version INTEGER PRIMARY KEY, description VARCHAR(200))"))
+        version = current_version(conn)
+
+    for number, description, step in MIGRATIONS:
+        if number <= version:
+            continue
+        try:
+            with engine.begin() as conn:
+                step(conn)
+                conn.execute(text(f"INSERT INTO {VERSION_TABLE} (version, description) VALUES (:version, :description)"),
+                             {"version": number, "description": description})
+        except DBAPIError:
+            # Another worker starting at the same time may have applied it first
+            with engine.connect() as conn:
+                if current_version(conn) < number:
+                    raise
+        else:
+            logger.info("Applied migration %s: %s", number, description)
+        version = number
+    return version
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Mahjong database migrations")
+    parser.add_argument("--status", action="store_true", help="Show the schema version without migrating")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    import os
+    os.environ["AUTO_MIGRATE"] = "0"
+    from app import app
+
+    args = parse_args()
+    with app.app_context():
+        with db.engine.connect() as conn:
+            version = current_version(conn)
+        if not args.status:
+            version = migrate()
+        print(f"Schema version {version}, latest {MIGRATIONS[-1][0]}")
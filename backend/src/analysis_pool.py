@@ -0,0 +1,266 @@
+import os
+import sys
+import math
+import time
+import queue
+import socket
+import argparse
+import threading
+import subprocess
+from collections import deque
+from concurrent.futures import Future
+
+from .metrics import collect, configure_logging, observe, record, span
+from .pattern_recognition.inference_service import UndecodableImage, send_frame, recv_frame
+
+# Analysis of the uploads runs in worker processes. Scoring and rendering do
+# not yield, so inside an eventlet greenlet they would stall every other
+# request and socket client until the hand is done. Each worker talks to the
+# server over a socket pair, which yields under eventlet while the worker is
+# busy (multiprocessing pipes block the whole hub once a frame fills them).
+#   ANALYSIS_WORKERS       worker processes, 0 analyzes in the request as before
+#   ANALYSIS_QUEUE_LIMIT   jobs queued or running before new uploads are refused
+#   ANALYSIS_TIMEOUT       seconds a job may run before its worker is replaced
+# python -m src.analysis_pool --worker <fd>   (started by AnalysisPool)
+DEFAULT_WORKERS = min(4, os.cpu_count() or 1)
+QUEUE_LIMIT_PER_WORKER = 4
+DEFAULT_JOB_SECONDS = 1.0
+DEFAULT_TIMEOUT = 60.0
+_backend_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class PoolSaturated(Exception):
+    """
+    Raised when the analysis queue is full, retry_after is the number of seconds to wait.
+    """
+    def __init__(self, retry_after):
+        super().__init__("Analysis queue is full, try again later")
+        self.retry_after = retry_after
+
+
+class AnalysisError(Exception):
+    """
+    Raised when the analysis failed in the worker, with the worker's message.
+    """
+
+
+class AnalysisTimeout(AnalysisError):
+    """
+    Raised when a job ran longer than the pool's timeout, its worker is replaced.
+    """
+
+
+def _analyze(image_bytes, others_settings, tiles=None):
+    # Known tiles skip the detector
+    from .main import recognize_image, score_tiles
+    if tiles is None:
+        tiles = recognize_image(image_bytes)
+    result, png = score_tiles(tiles, others_settings)
+    return result, png, tiles
+
+
+class _Worker():
+    def __init__(self, timeout=None):
+        parent, child = socket.socketpair()
+        self.process = subprocess.Popen([sys.executable, "-m", "src.analysis_pool", "--worker", str(child.fileno())],
+                                        cwd=_backend_dir, pass_fds=[child.fileno()])
+        child.close()
+        # A wedged worker makes the call time out instead of holding the job forever
+        parent.settimeout(timeout)
+        self.conn = parent
+
+    def call(self, header, payload=b""):
+        send_frame(self.conn, header, payload)
+        return recv_frame(self.conn)
+
+    def close(self):
+        self.conn.close()
+        self.process.terminate()
+        self.process.wait()
+
+
+class AnalysisPool():
+    """
+    Bounded pool of analysis worker processes.
+    Parameters:
+        workers: int, the number of worker processes, 0 runs the analysis in the caller.
+        queue_limit: int, the maximum number of jobs queued or running.
+        cache: AnalysisCache, answers repeated uploads without a job, None disables it.
+        timeout: float, seconds a job may run in a worker, None waits forever.
+    """
+    def __init__(self, workers=DEFAULT_WORKERS, queue_limit=None, cache=None, timeout=DEFAULT_TIMEOUT):
+        self.workers = max(0, workers)
+        self.cache = cache
+        self.timeout = timeout
+        self.queue_limit = queue_limit if queue_limit is not None else max(1, self.workers) * QUEUE_LIMIT_PER_WORKER
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.durations = deque(maxlen=50)
+        self.idle = queue.Queue()
+        self.started = False
+
+    def _start(self):
+        # The workers are started on first use, not when the app is imported
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+        for _ in range(self.workers):
+            self.idle.put(_Worker(self.timeout))
+
+    def _call(self, header, payload=b""):
+        self._start()
+        with span("queue"):
+            worker = self.idle.get()
+        try:
+            reply = worker.call(header, payload)
+        except socket.timeout:
+            worker.close()
+            self.idle.put(_Worker(self.timeout))
+            raise AnalysisTimeout(f"Analysis took longer than {self.timeout:g} s")
+        except (ConnectionError, OSError, ValueError):
+            # The worker died, replace it so the pool keeps its size
+            worker.close()
+            self.idle.put(_Worker(self.timeout))
+            raise AnalysisError("Analysis worker stopped unexpectedly")
+        self.idle.put(worker)
+        return reply
+
+    def _run(self, future, image_bytes, others_settings, tiles):
+        from .pattern_recognition.main import HandResult
+
+        start = time.perf_counter()
+        try:
+            if self.workers == 0:
+                result, png, detected = _analyze(image_bytes, others_settings, tiles)
+            else:
+                header, png = self._call({"type": "analyze", "others": others_settings, "tiles": tiles}, image_bytes)
+                if header.get("undecodable"):
+                    raise UndecodableImage(header["error"])
+                if "error" in header:
+                    raise AnalysisError(header["error"])
+                result, png, detected = HandResult(**header["result"]), png or None, header["tiles"]
+                record(header["metrics"])
+            observe("total", time.perf_counter() - start)
+            if self.cache is not None:
+                if tiles is None:
+                    self.cache.put_detection(image_bytes, detected)
+                self.cache.put_score(detected, others_settings, result, png)
+            future.set_result((result, png))
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            with self.lock:
+                self.pending -= 1
+                self.durations.append(time.perf_counter() - start)
+
+    def retry_after(self) -> int:
+        # Time for the queue ahead to drain at the recent job duration
+        with self.lock:
+            mean = sum(self.durations) / len(self.durations) if self.durations else DEFAULT_JOB_SECONDS
+            pending = self.pending
+        return max(1, math.ceil(mean * pending / max(1, self.workers)))
+
+    def submit(self, image_bytes, others_settings) -> Future:
+        """
+        Queue the analysis of an encoded image.
+        Returns a Future of (HandResult, png), raises PoolSaturated when the queue is full.
+        """
+        # An upload seen before, or a hand scored before, is answered right away
+        tiles = self.cache.get_detection(image_bytes) if self.cache is not None else None
+        if tiles is not None:
+            scored = self.cache.get_score(tiles, others_settings)
+            if scored is not None:
+                future = Future()
+                future.set_result(scored)
+                return future
+
+        with self.lock:
+            saturated = self.pending >= self.queue_limit
+            if not saturated:
+                self.pending += 1
+        if saturated:
+            raise PoolSaturated(self.retry_after())
+
+        future = Future()
+        if self.workers == 0:
+            self._run(future, image_bytes, others_settings, tiles)
+        else:
+            # A green thread under eventlet, it only waits on the worker's socket
+            threading.Thread(target=self._run, args=(future, image_bytes, others_settings, tiles), daemon=True).start()
+        return future
+
+    def warm_up(self):
+        # Load the pipeline in every worker
+        if self.workers == 0:
+            from .main import warm_up
+            warm_up()
+            return
+        self._start()
+        workers = [self.idle.get() for _ in range(self.workers)]
+        try:
+            for worker in workers:
+                # Loading the model may take longer than a job
+                worker.conn.settimeout(None)
+                try:
+                    header, _ = worker.call({"type": "warm_up"})
+                finally:
+                    worker.conn.settimeout(self.timeout)
+                if "error" in header:
+                    raise AnalysisError(header["error"])
+        finally:
+            for worker in workers:
+                self.idle.put(worker)
+
+    def stats(self) -> dict:
+        with self.lock:
+            stats = {
+                "workers": self.workers,
+                "pending": self.pending,
+                "queue_limit": self.queue_limit,
+                "mean_job_ms": 1e3 * sum(self.durations) / len(self.durations) if self.durations else 0.0,
+            }
+        if self.cache is not None:
+            stats["cache"] = self.cache.stats()
+        return stats
+
+    def shutdown(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+def serve_worker(fd):
+    conn = socket.socket(fileno=fd)
+    conn.setblocking(True)  # the server's end is non blocking under eventlet, the flag is shared
+    while True:
+        try:
+            header, payload = recv_frame(conn)
+        except (ConnectionError, OSError):
+            break
+        try:
+            if header.get("type") == "warm_up":
+                from .main import warm_up
+                warm_up()
+                send_frame(conn, {})
+            else:
+                # The spans of the job go back with the result, the server records them
+                with collect() as collected:
+                    result, png, tiles = _analyze(payload, header.get("others"), header.get("tiles"))
+                send_frame(conn, {"result": result._asdict(), "tiles": [list(group) for group in tiles],
+                                  "metrics": collected}, png or b"")
+        except Exception as e:
+            send_frame(conn, {"error": str(e), "undecodable": isinstance(e, UndecodableImage)})
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Analysis worker process")
+    parser.add_argument("--worker", type=int, required=True, help="File descriptor of the socket to the server")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    configure_logging()
+    serve_worker(parse_args().worker)
@@ -0,0 +1,199 @@
+import os
+import time
+import random
+import argparse
+import tempfile
+
+import cv2
+import numpy as np
+
+from data_augmentation import SCENE_NAMES, THIS_FOLDER, render_augmented_image, save_augmented_image
+from dataset_shards import SHARD_SIZE, ShardWriter, collate_yolo, shard_path, yolo_sample
+
+# Augmented images rendered on the fly for training, instead of writing every
+# JPEG and label file with data_augmentation.py, moving them with
+# data_classification.py and reading them back. Sample i is rendered from its
+# own generator seeded with (seed, i), so it is the same on every run and in
+# any DataLoader worker, and the workers split the indices without overlap.
+# python augmentation_dataset.py --benchmark --samples 200
+# python augmentation_dataset.py --materialize 2000 --seed 1 --output datasets/val
+# python augmentation_dataset.py --materialize 2000 --seed 1 --shards --output datasets/shards
+# python main.py --stream 20000
+IMAGE_SIZE = 640
+
+
+class AugmentedDataset():
+    """
+    Augmented images rendered when they are read, usable as a map style dataset
+    by torch's DataLoader or iterated directly.
+    Parameters:
+        length: int, the number of samples.
+        seed: int, the seed of the dataset, the same seed renders the same samples.
+        min_tiles: int, the minimum number of tiles in an image.
+        max_tiles: int, the maximum number of tiles in an image.
+        scene: str, the scene of the images, one of data_augmentation.SCENE_NAMES.
+    """
+    def __init__(self, length, seed=0, min_tiles=5, max_tiles=14, scene="row"):
+        self.length = length
+        self.seed = seed
+        self.min_tiles = min(min_tiles, max_tiles)
+        self.max_tiles = max(min_tiles, max_tiles)
+        self.scene = scene
+
+    def __len__(self):
+        return self.length
+
+    def render(self, index):
+        if not 0 <= index < self.length:
+            raise IndexError(f"Sample {index} out of range for {self.length} samples")
+        rng = random.Random(f"{self.seed}:{index}")
+        return render_augmented_image(rng.randint(self.min_tiles, self.max_tiles), rng, self.scene)
+
+    def __getitem__(self, index):
+        """
+        Returns:
+            image: np.ndarray, the RGB image.
+            labels: np.ndarray, float32 (tiles, 5) rows of class, center x, center y, width, height.
+        """
+        image, labels = self.render(index)
+        return image, np.array([(int(label), *box) for label, *box in labels], dtype=np.float32).reshape(-1, 5)
+
+    def __iter__(self):
+        # Inside a DataLoader worker only this worker's share of the indices
+        start, step = 0, 1
+        worker = _worker_info()
+        if worker is not None:
+            start, step = worker.id, worker.num_workers
+        for index in range(start, self.length, step):
+            yield self[index]
+
+    def materialize(self, output_dir, count=None, shards=False):
+        """
+        Write the first count samples as JPEG and YOLO label files, named by seed and index,
+        or in shards of dataset_shards.SHARD_SIZE samples.
+        """
+        count = min(self.length, count if count is not None else self.length)
+        if shards:
+            os.makedirs(output_dir, exist_ok=True)
+            for start in range(0, count, SHARD_SIZE):
+                with ShardWriter(shard_path(output_dir, f"{self.seed}-{start:06d}")) as writer:
+                    for index in range(start, min(start + SHARD_SIZE, count)):
+                        image, labels = self.render(index)
+                        writer.add(image, [(int(label), *box) for label, *box in labels], f"{self.seed}-{index:06d}")
+            return
+
+        images_dir, labels_dir = os.path.join(output_dir, "images"), os.path.join(output_dir, "labels")
+        os.makedirs(images_dir, exist_ok=True)
+        os.makedirs(labels_dir, exist_ok=True)
+        for index in range(count):
+            image, labels = self.render(index)
+            save_augmented_image(image, labels, f"{self.seed}-{index:06d}", images_dir, labels_dir)
+
+
+def _worker_info():
+    try:
+        from torch.utils.data import get_worker_info
+    except ImportError:
+        return None
+    return get_worker_info()
+
+
+class YoloStreamDataset(AugmentedDataset):
+    """
+    AugmentedDataset in the batch format of the ultralytics detection trainer.
+    Parameters:
+        imgsz: int, the size the square images are resized to.
+    """
+    def __init__(self, length, seed=0, min_tiles=5, max_tiles=14, scene="row", imgsz=IMAGE_SIZE):
+        super().__init__(length, seed, min_tiles, max_tiles, scene)
+        self.imgsz = imgsz
+
+    def __getitem__(self, index):
+        image, labels = super().__getitem__(index)
+        return yolo_sample(image, labels, f"stream-{self.seed}-{index:06d}.jpg", self.imgsz)
+
+    collate_fn = staticmethod(collate_yolo)
+
+
+def train_streaming(config, samples, seed=0, scene="row"):
+    """
+    Train on samples streamed images instead of the train folder, validation still reads the val folder.
+    """
+    from ultralytics import YOLO
+    from ultralytics.models.yolo.detect import DetectionTrainer
+
+    class StreamingTrainer(DetectionTrainer):
+        def build_dataset(self, img_path, mode="train", batch=None):
+            if mode != "train":
+                return super().build_dataset(img_path, mode, batch)
+            return YoloStreamDataset(samples, seed, scene=scene, imgsz=self.args.imgsz)
+
+        def plot_training_labels(self):
+            # The labels of a stream are not known before it is read
+            pass
+
+    model = YOLO(config["model"])
+    return model.train(trainer=StreamingTrainer, **config)
+
+
+# Streamed samples against the write-then-read path
+# python augmentation_dataset.py --benchmark --samples 200
+def _read_sample(images_dir, labels_dir, stem):
+    # What the trainer does with a materialized sample
+    image = cv2.cvtColor(cv2.imread(os.path.join(images_dir, f"{stem}.jpg"), cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB)
+    labels = np.loadtxt(os.path.join(labels_dir, f"{stem}.txt"), dtype=np.float32, ndmin=2)
+    return image, labels
+
+
+def benchmark_streaming(samples=200, seed=0):
+    dataset = AugmentedDataset(samples, seed)
+    first, again = dataset[0], dataset[0]
+    deterministic = np.array_equal(first[0], again[0]) and np.array_equal(first[1], again[1])
+
+    start = time.perf_counter()
+    for _ in dataset:
+        pass
+    stream_duration = time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as tmp:
+        start = time.perf_counter()
+        dataset.materialize(tmp)
+        write_duration = time.perf_counter() - start
+        disk_bytes = sum(entry.stat().st_size for folder in ("images", "labels")
+                         for entry in os.scandir(os.path.join(tmp, folder)))
+
+        start = time.perf_counter()
+        for index in range(samples):
+            _read_sample(os.path.join(tmp, "images"), os.path.join(tmp, "labels"), f"{seed}-{index:06d}")
+        read_duration = time.perf_counter() - start
+
+    print(f"Samples: {samples}, deterministic by seed: {deterministic}")
+    print(f"Streamed in memory:     {samples / stream_duration:>8.1f} samples/s")
+    print(f"Write JPEG + labels:    {samples / write_duration:>8.1f} samples/s ({disk_bytes / samples / 1024:.0f} KiB/sample on disk)")
+    print(f"Read back:              {samples / read_duration:>8.1f} samples/s")
+    print(f"Write then read:        {samples / (write_duration + read_duration):>8.1f} samples/s")
+    print(f"Speedup: {(write_duration + read_duration) / stream_duration:.2f}x")
+    return deterministic
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Augmented images rendered on the fly")
+    parser.add_argument("--benchmark", action="store_true", help="Compare streaming with writing and reading back")
+    parser.add_argument("--samples", type=int, default=200, help="Number of samples of the benchmark")
+    parser.add_argument("--materialize", type=int, default=None, help="Write this many samples to --output")
+    parser.add_argument("--output", default=os.path.join(THIS_FOLDER, "datasets", "val"), help="Folder of the materialized samples")
+    parser.add_argument("--shards", action="store_true", help="Materialize the samples in shards instead of image and label files")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the dataset")
+    parser.add_argument("--min-tiles", type=int, default=5, help="Minimum tiles per image")
+    parser.add_argument("--max-tiles", type=int, default=14, help="Maximum tiles per image")
+    parser.add_argument("--scene", choices=SCENE_NAMES, default="row", help="Scene of the images")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.benchmark and not benchmark_streaming(args.samples, args.seed):
+        raise SystemExit(1)
+    if args.materialize:
+        AugmentedDataset(args.materialize, args.seed, args.min_tiles, args.max_tiles, args.scene).materialize(args.output, shards=args.shards)
+        print(f"Wrote {args.materialize} samples to {args.output}")
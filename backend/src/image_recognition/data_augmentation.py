@@ -4,6 +4,7 @@ from glob import glob
 import numpy as np
 import cv2
 import csv
+import json
 import pickle
 import random
 import datetime
@@ -11,6 +12,8 @@ import time
 import uuid
 from concurrent.futures import ProcessPoolExecutor, as_completed
 
+from dataset_shards import SHARD_SIZE, ShardWriter, shard_path
+
 THIS_FOLDER = os.path.dirname(os.path.abspath(__file__))
 
 # Specify the size of tiles
@@ -28,7 +31,6 @@ output_path = os.path.join(THIS_FOLDER, "datasets", "original", "augmented")  #
 output_images_path = os.path.join(output_path, "images")
 output_labels_path = os.path.join(output_path, "labeled")
 filenames = {}  # Get the list of filenames
-tile_cache = {}
 
 # Create the output directory if it does not exist
 os.makedirs(output_path, exist_ok=True)
@@ -51,29 +53,31 @@ else:
 
 
 class Backgrounds():
-    def __init__(self, background_fn=background_fn):
-        with open(background_fn, "rb") as background_file:
-            raw_backgrounds = pickle.load(background_file)
-        self.backgrounds = [
-            cv2.resize(
-                cv2.cvtColor(background, cv2.COLOR_RGB2RGBA),
-                (image_width, image_height),
-                interpolation=cv2.INTER_AREA,
-            )
-            for background in raw_backgrounds
-        ]
+    def __init__(self, background_fn=background_fn, images=None):
+        # images are the resized backgrounds, or a view of the shared cache
+        self.backgrounds = images if images is not None else _resize_backgrounds(background_fn)
         self.bg_num = len(self.backgrounds)
 
-    def get_random(self, display=False):
-        bg = random.choice(self.backgrounds)
+    def get_random(self, display=False, rng=random):
+        bg = rng.choice(self.backgrounds)
         if display:
             import matplotlib.pyplot as plt
             plt.imshow(bg)
             plt.show()
         return bg
 
-# Initialize the background generator
-backgrounds = Backgrounds()
+
+def _resize_backgrounds(background_fn=background_fn):
+    with open(background_fn, "rb") as background_file:
+        raw_backgrounds = pickle.load(background_file)
+    return [
+        cv2.resize(
+            cv2.cvtColor(background, cv2.COLOR_RGB2RGBA),
+            (image_width, image_height),
+            interpolation=cv2.INTER_AREA,
+        )
+        for background in raw_backgrounds
+    ]
 
 # Load the labels of the images
 labels = os.path.join(THIS_FOLDER, "datasets", "original", "tiles-data", "data.csv")
@@ -94,23 +98,139 @@ with open(labels, newline='') as csvfile:
         else:
             filenames[tile_label] = [filename]
 
-# Store background image in cache
-for tile_label, tile_paths in filenames.items():
-    cached_images = []
-    for tile_filename in tile_paths:
-        tile_filepath = os.path.join(image_path, tile_filename)
-        image = cv2.imread(tile_filepath, cv2.IMREAD_UNCHANGED)
-        if image is None:
-            continue
-        if image.ndim == 2:
-            image = cv2.cvtColor(image, cv2.COLOR_GRAY2RGBA)
-        elif image.shape[2] == 3:
-            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGBA)
-        elif image.shape[2] == 4:
-            image = cv2.cvtColor(image, cv2.COLOR_BGRA2RGBA)
-        cached_images.append(image)
-    if cached_images:
-        tile_cache[tile_label] = cached_images
+
+def _decode_tiles():
+    # Every tile image as RGBA, by label
+    decoded = {}
+    for tile_label, tile_paths in filenames.items():
+        cached_images = []
+        for tile_filename in tile_paths:
+            tile_filepath = os.path.join(image_path, tile_filename)
+            image = cv2.imread(tile_filepath, cv2.IMREAD_UNCHANGED)
+            if image is None:
+                continue
+            if image.ndim == 2:
+                image = cv2.cvtColor(image, cv2.COLOR_GRAY2RGBA)
+            elif image.shape[2] == 3:
+                image = cv2.cvtColor(image, cv2.COLOR_BGR2RGBA)
+            elif image.shape[2] == 4:
+                image = cv2.cvtColor(image, cv2.COLOR_BGRA2RGBA)
+            cached_images.append(image)
+        if cached_images:
+            decoded[tile_label] = cached_images
+    return decoded
+
+
+# The resized backgrounds and decoded tiles are packed once into memory-mapped
+# .npy files, every process (pool workers, DataLoader workers) maps the same
+# pages instead of unpickling and decoding its own copy.
+#   backgrounds.npy   (backgrounds, image_height, image_width, 4) uint8
+#   tiles.npy         every tile's RGBA pixels, one after the other
+#   tile_index.npy    (tiles, 4) int64 rows of offset, height, width, label
+#   manifest.json     the labels and the sources the cache was built from
+# AUGMENTATION_SHARED_CACHE=0 loads them in each process instead.
+shared_cache_path = os.path.join(THIS_FOLDER, "augmentation_cache")
+SHARED_CACHE = os.getenv("AUGMENTATION_SHARED_CACHE", "1") == "1"
+
+
+def _file_stamp(path):
+    # Size and mtime, None for a missing file
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _cache_sources():
+    # The folder's mtime only changes when a tile is added or removed, every
+    # tile the cache decodes is stamped so an overwritten one is noticed too
+    return {
+        "image_size": [image_height, image_width],
+        "sources": [[path, _file_stamp(path)] for path in (background_fn, labels)],
+        "tiles": [[tile_filename, _file_stamp(os.path.join(image_path, tile_filename))]
+                  for tile_paths in filenames.values() for tile_filename in tile_paths],
+    }
+
+
+def _temporary(path, name):
+    # Files are written under a name of this process, moved into place once complete
+    return os.path.join(path, f"{name}.{os.getpid()}.tmp")
+
+
+def _open_packed(path, name, shape):
+    return np.lib.format.open_memmap(_temporary(path, f"{name}.npy"), mode="w+", dtype=np.uint8, shape=shape)
+
+
+def build_shared_cache(path=shared_cache_path):
+    os.makedirs(path, exist_ok=True)
+    resized = _resize_backgrounds()
+    packed_backgrounds = _open_packed(path, "backgrounds", (len(resized), image_height, image_width, 4))
+    for i, background in enumerate(resized):
+        packed_backgrounds[i] = background
+    packed_backgrounds.flush()
+    del packed_backgrounds, resized
+
+    decoded = _decode_tiles()
+    label_keys = list(decoded)
+    index = []
+    offset = 0
+    for label_index, tile_label in enumerate(label_keys):
+        for image in decoded[tile_label]:
+            index.append((offset, image.shape[0], image.shape[1], label_index))
+            offset += image.size
+    packed_tiles = _open_packed(path, "tiles", (offset,))
+    for (start, height, width, _), image in zip(index, (image for tile_label in label_keys for image in decoded[tile_label])):
+        packed_tiles[start:start + height * width * 4] = image.reshape(-1)
+    packed_tiles.flush()
+    del packed_tiles
+    with open(_temporary(path, "tile_index.npy"), "wb") as index_file:
+        np.save(index_file, np.array(index, dtype=np.int64).reshape(-1, 4))
+    with open(_temporary(path, "manifest.json"), "w") as manifest_file:
+        json.dump(dict(_cache_sources(), labels=label_keys), manifest_file)
+
+    # The manifest goes last, a cache without a matching one is rebuilt
+    for name in ("backgrounds.npy", "tiles.npy", "tile_index.npy", "manifest.json"):
+        os.replace(_temporary(path, name), os.path.join(path, name))
+
+
+def load_shared_cache(path=shared_cache_path):
+    """
+    Map the shared cache, without copying it.
+    Returns:
+        backgrounds: np.ndarray, read only (backgrounds, image_height, image_width, 4).
+        tiles: dict of list, read only RGBA views of every tile by label, or None if the cache is missing or stale.
+    """
+    try:
+        with open(os.path.join(path, "manifest.json")) as manifest_file:
+            manifest = json.load(manifest_file)
+    except (OSError, ValueError):
+        return None
+    label_keys = manifest.pop("labels")
+    if manifest != json.loads(json.dumps(_cache_sources())):
+        return None
+
+    mapped_backgrounds = np.load(os.path.join(path, "backgrounds.npy"), mmap_mode="r")
+    mapped_tiles = np.load(os.path.join(path, "tiles.npy"), mmap_mode="r")
+    tiles = {}
+    for start, height, width, label_index in np.load(os.path.join(path, "tile_index.npy")).tolist():
+        tiles.setdefault(label_keys[label_index], []).append(
+            mapped_tiles[start:start + height * width * 4].reshape(height, width, 4))
+    return mapped_backgrounds, tiles
+
+
+# Initialize the background generator and the tile cache
+if SHARED_CACHE:
+    shared = load_shared_cache()
+    if shared is None:
+        print("Packing the background and tile caches...")
+        build_shared_cache()
+        shared = load_shared_cache()
+    backgrounds = Backgrounds(images=shared[0])
+    tile_cache = shared[1]
+else:
+    backgrounds = Backgrounds()
+    tile_cache = _decode_tiles()
 
 tile_label_keys = list(tile_cache.keys())
 
@@ -163,13 +283,13 @@ def resize_tile(image, width=None, height=None, inter=cv2.INTER_AREA):
     return cv2.resize(image, dim, interpolation=inter)
 
 # Generate the augmented image information
-def generate_images(num_tiles=14):
+def generate_images(num_tiles=14, rng=random):
     tile_images = []
     tile_labels = []
 
     for _ in range(num_tiles):
-        tile_label = random.choice(tile_label_keys)
-        tile_image = random.choice(tile_cache[tile_label]).copy()
+        tile_label = rng.choice(tile_label_keys)
+        tile_image = rng.choice(tile_cache[tile_label]).copy()
         tile_images.append(tile_image)
         tile_labels.append(tile_label)
     
@@ -185,20 +305,30 @@ def _build_output_stem(task_index=None):
     return f"{now_str}-{pid}-{task_index}-{random_suffix}"
 
 
-def generate_augmented_image(num_tiles=14, output_stem=None):
+def render_augmented_image(num_tiles=14, rng=random, scene="row"):
+    """
+    Render one augmented image in memory.
+    Parameters:
+        num_tiles: int, the number of tiles in the row, of the hand in scenes of several rows.
+        rng: random.Random, the source of every random choice, a seeded one renders the same image.
+        scene: str, one of SCENE_NAMES.
+    Returns:
+        image: np.ndarray, the RGB image (image_height, image_width, 3).
+        labels: list of tuple, (tile_label, center_x, center_y, width, height) of every tile, normalized.
+    """
+    if scene == "mixed":
+        scene = rng.choice(SCENE_NAMES[:-1])
+    if scene != "row":
+        return _render_scene(num_tiles, rng, SCENES[scene])
+
     # Generate the image information
-    (tile_images, tile_labels) = generate_images(num_tiles)
+    (tile_images, tile_labels) = generate_images(num_tiles, rng)
 
     # Randomly select the background image
-    bg_image = backgrounds.get_random()
+    bg_image = backgrounds.get_random(rng=rng)
 
     # Copy the background image such that the image would not be modified
-    output_image = bg_image.copy()
-
-    if output_stem is None:
-        output_stem = _build_output_stem()
-    output_filename = os.path.join(output_images_path, f"{output_stem}.jpg")
-    output_labels = os.path.join(output_labels_path, f"{output_stem}.txt")
+    output_image = cv2.cvtColor(bg_image, cv2.COLOR_RGBA2RGB)
 
     # Resize tiles so they fit nicely
     target_height = int(image_height / 3)
@@ -232,7 +362,7 @@ def generate_augmented_image(num_tiles=14, output_stem=None):
         tile_boxes.append((x_offset, 0, x_offset + w, target_height))
         x_offset += w
 
-    angle = random.randint(0, 359)
+    angle = rng.randint(0, 359)
     # Get the rotation matrix
     (h, w) = row_img.shape[:2]
     (cX, cY) = (w // 2, h // 2)
@@ -266,101 +396,466 @@ def generate_augmented_image(num_tiles=14, output_stem=None):
     y1, y2 = start_y, start_y + nH
     x1, x2 = start_x, start_x + nW
     
-    alpha = (rotated_row_img[:, :, 3:4].astype(np.float32)) / 255.0
-    foreground = rotated_row_img[:, :, :3].astype(np.float32)
-    background = output_image[y1:y2, x1:x2, :3].astype(np.float32)
-    blended = alpha * foreground + (1.0 - alpha) * background
-    output_image[y1:y2, x1:x2, :3] = blended.astype(np.uint8)
-
-    label_lines = []
-    with open(output_labels, "w") as file:
-        for i, (xmin, ymin, xmax, ymax) in enumerate(tile_boxes):
-            # Calculate 4 corners of original tile box
-            corners = np.array([
-                [xmin, ymin, 1],
-                [xmax, ymin, 1],
-                [xmax, ymax, 1],
-                [xmin, ymax, 1]
-            ])
-            # Apply affine transform
-            rotated_corners = matrix.dot(corners.T).T
-            
-            # Translated to bounding box on output_image
-            rotated_corners[:, 0] += start_x
-            rotated_corners[:, 1] += start_y
-
-            rx_min = np.min(rotated_corners[:, 0]) / output_image.shape[1]
-            rx_max = np.max(rotated_corners[:, 0]) / output_image.shape[1]
-            ry_min = np.min(rotated_corners[:, 1]) / output_image.shape[0]
-            ry_max = np.max(rotated_corners[:, 1]) / output_image.shape[0]
-            
-            # Ensure within bounds
-            rx_min = max(0, min(1, rx_min))
-            rx_max = max(0, min(1, rx_max))
-            ry_min = max(0, min(1, ry_min))
-            ry_max = max(0, min(1, ry_max))
-
-            center_x = (rx_min + rx_max) / 2
-            center_y = (ry_min + ry_max) / 2
-            width = rx_max - rx_min
-            height = ry_max - ry_min
-            
-            label_lines.append(f"{tile_labels[i]} {center_x} {center_y} {width} {height}\n")
-        file.writelines(label_lines)
-        
+    blend_overlay(output_image[y1:y2, x1:x2], rotated_row_img)
+
+    boxes = box_labels(tile_boxes, matrix, start_x, start_y)
+    return output_image, [(tile_label, *box) for tile_label, box in zip(tile_labels, boxes.tolist())]
+
+
+# Per process buffers of the blending, reused by every image
+_blend_buffers = []
+
+def blend_overlay(background, overlay):
+    """
+    Alpha blend an RGBA overlay onto an RGB region of the same size in place,
+    in 8 bit fixed point: (fg * a + bg * (255 - a)) / 255, rounded.
+    """
+    if not _blend_buffers:
+        _blend_buffers.extend(np.empty(image_height * image_width * 3, dtype=np.uint16) for _ in range(2))
+    (h, w) = overlay.shape[:2]
+    # Contiguous views, the same shape as the three channel alpha
+    total, part = (buffer[:h * w * 3].reshape(h, w, 3) for buffer in _blend_buffers)
+
+    alpha = overlay[:, :, 3]
+    alpha = cv2.merge([alpha, alpha, alpha])
+    np.multiply(cv2.cvtColor(overlay, cv2.COLOR_RGBA2RGB), alpha, out=total, dtype=np.uint16)
+    np.multiply(background, cv2.bitwise_not(alpha), out=part, dtype=np.uint16)
+    total += part
+    # Exact rounded division by 255 of values below 65536
+    total += 128
+    np.right_shift(total, 8, out=part)
+    total += part
+    total >>= 8
+    np.copyto(background, total, casting="unsafe")
+
+
+def box_labels(tile_boxes, matrix, start_x, start_y):
+    """
+    Transform the tile boxes of the row with the affine matrix and place them on the image.
+    Returns:
+        boxes: np.ndarray, (tiles, 4) normalized center x, center y, width, height.
+    """
+    boxes = np.asarray(tile_boxes, dtype=np.float64).reshape(-1, 4)
+    # The 4 corners of every box, (tiles, 4, 3) homogeneous
+    corners = np.stack([
+        boxes[:, [0, 2, 2, 0]],
+        boxes[:, [1, 1, 3, 3]],
+        np.ones((len(boxes), 4)),
+    ], axis=2)
+    return quad_labels(corners @ matrix.T + (start_x, start_y))
+
+
+def quad_labels(quads):
+    """
+    Returns:
+        boxes: np.ndarray, (tiles, 4) normalized center x, center y, width, height of
+        the bounding boxes of (tiles, 4, 2) corners on the image, clipped to it.
+    """
+    low = np.clip(quads.min(axis=1) / (image_width, image_height), 0, 1)
+    high = np.clip(quads.max(axis=1) / (image_width, image_height), 0, 1)
+    return np.concatenate([(low + high) / 2, high - low], axis=1)
+
+
+def _format_labels(labels):
+    return "".join(f"{tile_label} {center_x} {center_y} {width} {height}\n"
+                   for tile_label, center_x, center_y, width, height in labels)
+
+
+# Scenes closer to photos of a table, the options of each:
+#   rows         the hand and 1-3 melds, each with its own size and tilt, in bands
+#   occlusion    rows dropped over each other, tiles less than MIN_VISIBLE visible are not labelled
+#   perspective  rows seen at an angle, each warped by its own homography
+#   lighting     one row under a colour cast, another gamma and a shadow
+#   table        all of the above
+# "row" is the single centred row above and "mixed" picks any scene per image.
+SCENES = {
+    "rows": {"rows": (2, 4), "overlap": False, "perspective": 0.0, "lighting": False},
+    "occlusion": {"rows": (2, 4), "overlap": True, "perspective": 0.0, "lighting": False},
+    "perspective": {"rows": (2, 4), "overlap": False, "perspective": 0.4, "lighting": False},
+    "lighting": {"rows": (1, 1), "overlap": False, "perspective": 0.0, "lighting": True},
+    "table": {"rows": (2, 4), "overlap": True, "perspective": 0.4, "lighting": True},
+}
+SCENE_NAMES = ["row", *SCENES, "mixed"]
+MELD_TILES = (3, 4)
+MIN_VISIBLE = 0.4
+VISIBILITY_SCALE = 4  # the tile visibility is counted on a map this many times smaller
+
+
+def _build_row(tile_images, target_height):
+    # The tiles side by side at one height, and the box of each in the row. The
+    # row is resampled again when it is warped, a bilinear resize is enough here
+    resized_tiles = [resize_tile(tile_image, height=target_height, inter=cv2.INTER_LINEAR) for tile_image in tile_images]
+    edges = np.cumsum([0] + [r_tile.shape[1] for r_tile in resized_tiles])
+    tile_boxes = [(edges[i], 0, edges[i + 1], target_height) for i in range(len(resized_tiles))]
+    return np.concatenate(resized_tiles, axis=1), tile_boxes
+
+
+def _row_corners(w, h, rng, options, bands, band):
+    """
+    Where the corners of a w x h row go on the image.
+    Returns:
+        corners: np.ndarray, (4, 2) top left, top right, bottom right, bottom left.
+    """
+    corners = np.array([[0, 0], [w, 0], [w, h], [0, h]], dtype=np.float64)
+    if options["perspective"]:
+        # The far edge is narrower and the row is foreshortened towards it
+        far, near = ([0, 1], 1.0) if rng.random() < 0.5 else ([3, 2], -1.0)
+        corners[far, 0] += np.array([1, -1]) * rng.uniform(0, options["perspective"]) * w / 2
+        corners[far, 1] += near * rng.uniform(0, options["perspective"]) * h / 2
+        # and one end of the row is further away than the other
+        end = [1, 2] if rng.random() < 0.5 else [0, 3]
+        corners[end, 1] += np.array([1, -1]) * rng.uniform(0, options["perspective"]) * h / 4
+
+    # Rows of one player are about parallel, dropped rows go any way
+    angle = np.radians(rng.uniform(0, 360) if options["overlap"] else rng.uniform(-12, 12))
+    rotation = np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+    corners = (corners - (w / 2, h / 2)) @ rotation.T
+    extent = np.abs(corners).max(axis=0)
+    fit = min(1.0, 0.95 * image_width / (2 * extent[0]), 0.95 * image_height / (2 * extent[1]))
+    corners *= fit
+    extent *= fit
+
+    if options["overlap"] and band is not None:
+        # Drop the row across the previous one
+        center = band + [rng.uniform(-1, 1) * v for v in extent]
+    elif options["overlap"]:
+        center = np.array([rng.uniform(extent[0], image_width - extent[0]), rng.uniform(extent[1], image_height - extent[1])])
+    else:
+        band_height = image_height / bands
+        center = np.array([rng.uniform(extent[0], image_width - extent[0]),
+                           (band + 0.5 + rng.uniform(-0.2, 0.2)) * band_height])
+    center = np.clip(center, extent, (image_width - extent[0], image_height - extent[1]))
+    return corners + center
+
+
+def _warp_row(output_image, row_img, homography, corners, strips=8):
+    # A tilted row covers a small part of its bounding box, so it is warped and
+    # blended in horizontal strips, each only as wide as the row in it
+    y0 = max(int(np.floor(corners[:, 1].min())), 0)
+    y1 = min(int(np.ceil(corners[:, 1].max())), image_height)
+    quad = np.float32(corners)
+    for top in range(y0, y1, max(1, -(-(y1 - y0) // strips))):
+        bottom = min(top + -(-(y1 - y0) // strips), y1)
+        band = np.float32([[0, top - 1], [image_width, top - 1], [image_width, bottom + 1], [0, bottom + 1]])
+        area, part = cv2.intersectConvexConvex(quad, band)
+        if area <= 0 or part is None:
+            continue
+        left = max(int(np.floor(part[:, 0, 0].min())) - 1, 0)
+        right = min(int(np.ceil(part[:, 0, 0].max())) + 1, image_width)
+        if right <= left:
+            continue
+        shift = np.array([[1, 0, -left], [0, 1, -top], [0, 0, 1]], dtype=np.float64)
+        overlay = cv2.warpPerspective(row_img, shift @ homography, (right - left, bottom - top))
+        blend_overlay(output_image[top:bottom, left:right], overlay)
+
+
+def _apply_lighting(image, rng):
+    # Colour cast, contrast and gamma in one lookup table, then a shadow along one edge
+    levels = np.arange(256, dtype=np.float32) / 255
+    gamma, contrast, brightness = rng.uniform(0.7, 1.4), rng.uniform(0.8, 1.2), rng.uniform(-0.1, 0.1)
+    curve = (levels ** gamma - 0.5) * contrast + 0.5 + brightness
+    table = np.stack([np.clip(curve * rng.uniform(0.85, 1.15), 0, 1) for _ in range(3)], axis=1)
+    image[:] = cv2.LUT(image, (table * 255 + 0.5).astype(np.uint8).reshape(1, 256, 3))
+    if rng.random() < 0.5:
+        size = rng.randint(image_width // 5, image_width // 2)
+        region = rng.choice([np.s_[:size], np.s_[-size:], np.s_[:, :size], np.s_[:, -size:]])
+        shade = (levels * rng.uniform(0.5, 0.8) * 255 + 0.5).astype(np.uint8)
+        image[region] = cv2.LUT(image[region], shade)
+
+
+def _render_scene(num_tiles, rng, options):
+    output_image = cv2.cvtColor(backgrounds.get_random(rng=rng), cv2.COLOR_RGBA2RGB)
+    # Index of the tile drawn last at every point, at VISIBILITY_SCALE
+    owner = np.full((image_height // VISIBILITY_SCALE, image_width // VISIBILITY_SCALE), -1, dtype=np.int16)
+    tile_labels, quads = [], []
+
+    rows = rng.randint(*options["rows"])
+    previous = None
+    for row in range(rows):
+        (tile_images, row_labels) = generate_images(num_tiles if row == 0 else rng.randint(*MELD_TILES), rng)
+        row_img, tile_boxes = _build_row(tile_images, rng.randint(image_height // 10, image_height // 6))
+        (h, w) = row_img.shape[:2]
+        corners = _row_corners(w, h, rng, options, rows, previous if options["overlap"] else row)
+        previous = corners.mean(axis=0)
+        homography = cv2.getPerspectiveTransform(np.float32([[0, 0], [w, 0], [w, h], [0, h]]), np.float32(corners))
+
+        _warp_row(output_image, row_img, homography, corners)
+
+        boxes = np.asarray(tile_boxes, dtype=np.float64)
+        tile_corners = np.stack([boxes[:, [0, 2, 2, 0]], boxes[:, [1, 1, 3, 3]]], axis=2)
+        tile_quads = cv2.perspectiveTransform(tile_corners.reshape(-1, 1, 2), homography).reshape(-1, 4, 2)
+        for quad in tile_quads:
+            cv2.fillConvexPoly(owner, np.round(quad / VISIBILITY_SCALE).astype(np.int32), len(quads))
+            quads.append(quad)
+        tile_labels.extend(row_labels)
+
+    quads = np.array(quads)
+    # Share of each tile not covered by a later row
+    visible = np.bincount(owner.ravel() + 1, minlength=len(quads) + 1)[1:]
+    x, y = quads[:, :, 0], quads[:, :, 1]
+    areas = 0.5 * np.abs((x * np.roll(y, -1, axis=1) - np.roll(x, -1, axis=1) * y).sum(axis=1)) / VISIBILITY_SCALE ** 2
+    kept = visible >= MIN_VISIBLE * np.maximum(areas, 1)
+
+    if options["lighting"]:
+        _apply_lighting(output_image, rng)
+    boxes = quad_labels(quads)
+    return output_image, [(tile_label, *box) for tile_label, box, keep in zip(tile_labels, boxes.tolist(), kept) if keep]
+
+
+def save_augmented_image(image, labels, output_stem, images_dir=output_images_path, labels_dir=output_labels_path):
+    # Write the JPEG and the YOLO label file of a rendered image, YOLO reads
+    # one label file next to each image, --shards keeps a chunk in one file
+    with open(os.path.join(labels_dir, f"{output_stem}.txt"), "w") as file:
+        file.write(_format_labels(labels))
+
     # Save the output image
-    cv2.imwrite(output_filename, cv2.cvtColor(output_image, cv2.COLOR_RGBA2BGR))
+    cv2.imwrite(os.path.join(images_dir, f"{output_stem}.jpg"), cv2.cvtColor(image, cv2.COLOR_RGB2BGR))
 
 
-# Parallize image generateion
-# python data_augmentation.py --total-images 20000 --workers 4
-def _worker_generate_image(task_index, min_tiles, max_tiles, base_seed):
-    seed = base_seed + task_index + (os.getpid() * 9973)
-    random.seed(seed)
-    np.random.seed(seed % (2**32 - 1))
+def generate_augmented_image(num_tiles=14, output_stem=None, rng=random):
+    image, labels = render_augmented_image(num_tiles, rng)
+    if output_stem is None:
+        output_stem = _build_output_stem()
+    save_augmented_image(image, labels, output_stem)
 
-    num_tiles_in_row = random.randint(min_tiles, max_tiles)
-    output_stem = _build_output_stem(task_index)
-    generate_augmented_image(num_tiles_in_row, output_stem=output_stem)
-    return (task_index, num_tiles_in_row)
 
+# Parallize image generateion
+# python data_augmentation.py --total-images 20000 --workers 4 --chunk-size 64
+# python data_augmentation.py --total-images 20000 --workers 4 --shards datasets/shards
+def _worker_generate_chunk(task_indices, min_tiles, max_tiles, base_seed, scene="row", shards=None):
+    # Image i is rendered from its own generator, the same for any chunking
+    if shards is not None:
+        # A chunk is one shard
+        counts = []
+        with ShardWriter(shard_path(shards, f"{base_seed}-{task_indices[0]:08d}"), len(task_indices)) as writer:
+            for task_index in task_indices:
+                rng = random.Random(f"{base_seed}:{task_index}")
+                image, labels = render_augmented_image(rng.randint(min_tiles, max_tiles), rng, scene)
+                output_stem = _build_output_stem(task_index)
+                writer.add(image, [(int(label), *box) for label, *box in labels], output_stem)
+                counts.append((output_stem, len(labels)))
+        return counts
+
+    counts = []
+    for task_index in task_indices:
+        rng = random.Random(f"{base_seed}:{task_index}")
+        num_tiles_in_row = rng.randint(min_tiles, max_tiles)
+        image, labels = render_augmented_image(num_tiles_in_row, rng, scene)
+        output_stem = _build_output_stem(task_index)
+        save_augmented_image(image, labels, output_stem)
+        counts.append((output_stem, len(labels)))
+    return counts
+
+
+def _chunks(total_images, chunk_size):
+    return [range(start + 1, min(start + chunk_size, total_images) + 1) for start in range(0, total_images, chunk_size)]
+
+
+def run_generation(total_images, workers=1, min_tiles=5, max_tiles=14, chunk_size=None, seed=None, scene="row",
+                   shards=None):
+    """
+    Generate total_images images into the augmented folder.
+    Parameters:
+        workers: int, the number of worker processes, 1 generates in this process.
+        chunk_size: int, the images of one task, defaults to about 4 tasks per worker.
+        seed: int, the same seed generates the same images, defaults to the time.
+        scene: str, one of SCENE_NAMES.
+        shards: str, write the images in shards of chunk_size images to this folder instead.
+    """
+    base_seed = seed if seed is not None else int(time.time() * 1000) & 0x7FFFFFFF
+    if chunk_size is None:
+        chunk_size = SHARD_SIZE if shards is not None else max(1, min(256, total_images // (max(1, workers) * 4)))
+    chunks = _chunks(total_images, chunk_size)
+    if shards is not None:
+        os.makedirs(shards, exist_ok=True)
 
-def run_generation(total_images, workers=1, min_tiles=5, max_tiles=14):
     if workers <= 1:
-        for idx in range(total_images):
-            num_tiles_in_row = random.randint(min_tiles, max_tiles)
-            print(f"Generating image {idx + 1} with {num_tiles_in_row} tiles in a row...")
-            generate_augmented_image(num_tiles_in_row, output_stem=_build_output_stem(idx + 1))
+        for chunk in chunks:
+            _worker_generate_chunk(chunk, min_tiles, max_tiles, base_seed, scene, shards)
+            print(f"Generated image {chunk[-1]}/{total_images}")
         return
 
-    base_seed = int(time.time() * 1000) & 0x7FFFFFFF
-    print(f"Generating {total_images} images with {workers} workers...")
+    print(f"Generating {total_images} images with {workers} workers in chunks of {chunk_size}...")
     completed = 0
     with ProcessPoolExecutor(max_workers=workers) as executor:
-        futures = [
-            executor.submit(_worker_generate_image, idx + 1, min_tiles, max_tiles, base_seed)
-            for idx in range(total_images)
-        ]
+        futures = [executor.submit(_worker_generate_chunk, chunk, min_tiles, max_tiles, base_seed, scene, shards)
+                   for chunk in chunks]
 
         for future in as_completed(futures):
-            _, num_tiles_in_row = future.result()
-            completed += 1
-            print(f"Generated image {completed}/{total_images} ({num_tiles_in_row} tiles)")
-
-
-def benchmark_generation(total_images, workers, min_tiles, max_tiles):
-    start_single = time.perf_counter()
-    run_generation(total_images, workers=1, min_tiles=min_tiles, max_tiles=max_tiles)
-    single_duration = time.perf_counter() - start_single
-
-    start_multi = time.perf_counter()
-    run_generation(total_images, workers=workers, min_tiles=min_tiles, max_tiles=max_tiles)
-    multi_duration = time.perf_counter() - start_multi
-
-    speedup = single_duration / multi_duration if multi_duration > 0 else 0
-    print(f"Single worker time: {single_duration:.2f}s")
-    print(f"{workers} workers time: {multi_duration:.2f}s")
-    print(f"Speedup: {speedup:.2f}x")
+            completed += len(future.result())
+            print(f"Generated image {completed}/{total_images}")
+
+
+# The previous compositing, kept as the reference of the benchmark
+def _blend_overlay_float(background, overlay):
+    alpha = (overlay[:, :, 3:4].astype(np.float32)) / 255.0
+    foreground = overlay[:, :, :3].astype(np.float32)
+    blended = alpha * foreground + (1.0 - alpha) * background.astype(np.float32)
+    background[:] = blended.astype(np.uint8)
+
+
+def _box_labels_loop(tile_boxes, matrix, start_x, start_y):
+    boxes = []
+    for (xmin, ymin, xmax, ymax) in tile_boxes:
+        corners = np.array([[xmin, ymin, 1], [xmax, ymin, 1], [xmax, ymax, 1], [xmin, ymax, 1]])
+        rotated_corners = matrix.dot(corners.T).T
+        rotated_corners[:, 0] += start_x
+        rotated_corners[:, 1] += start_y
+        rx_min = max(0, min(1, np.min(rotated_corners[:, 0]) / image_width))
+        rx_max = max(0, min(1, np.max(rotated_corners[:, 0]) / image_width))
+        ry_min = max(0, min(1, np.min(rotated_corners[:, 1]) / image_height))
+        ry_max = max(0, min(1, np.max(rotated_corners[:, 1]) / image_height))
+        boxes.append(((rx_min + rx_max) / 2, (ry_min + ry_max) / 2, rx_max - rx_min, ry_max - ry_min))
+    return np.array(boxes)
+
+
+def _rate(run, count):
+    start = time.perf_counter()
+    for i in range(count):
+        run(i)
+    return count / (time.perf_counter() - start)
+
+
+def _benchmark_steps(samples=200):
+    # Each change on its own, on rows like the ones render_augmented_image draws
+    rng = np.random.default_rng(0)
+    cases = []
+    for _ in range(20):
+        tiles = int(rng.integers(5, 15))
+        tile_width = 60
+        tile_boxes = [(i * tile_width, 0, (i + 1) * tile_width, 80) for i in range(tiles)]
+        matrix = cv2.getRotationMatrix2D((tiles * tile_width // 2, 40), -float(rng.integers(0, 360)), 1.0)
+        overlay = rng.integers(0, 256, (600, 900, 4), dtype=np.uint8)
+        overlay[:, :, 3] = np.where(rng.random((600, 900)) < 0.4, 0, np.where(rng.random((600, 900)) < 0.8, 255, 128))
+        cases.append((tile_boxes, matrix, overlay, rng.integers(0, 256, (600, 900, 3), dtype=np.uint8)))
+
+    for tile_boxes, matrix, overlay, background in cases:
+        if not np.allclose(_box_labels_loop(tile_boxes, matrix, 100, 200), box_labels(tile_boxes, matrix, 100, 200), atol=1e-12):
+            raise AssertionError("Vectorized boxes differ from the per box transform")
+        expected, blended = background.copy(), background.copy()
+        _blend_overlay_float(expected, overlay)
+        blend_overlay(blended, overlay)
+        if np.abs(expected.astype(np.int16) - blended).max() > 1:
+            raise AssertionError("Fixed point blending differs by more than one level")
+
+    def step(name, old, new):
+        old_rate, new_rate = _rate(old, samples), _rate(new, samples)
+        print(f"{name:<26} {old_rate:>10.0f} -> {new_rate:>10.0f} per s   {new_rate / old_rate:>5.2f}x")
+
+    case = lambda i: cases[i % len(cases)]
+    step("box corners", lambda i: _box_labels_loop(case(i)[0], case(i)[1], 100, 200),
+         lambda i: box_labels(case(i)[0], case(i)[1], 100, 200))
+    step("alpha blending", lambda i: _blend_overlay_float(case(i)[3].copy(), case(i)[2]),
+         lambda i: blend_overlay(case(i)[3].copy(), case(i)[2]))
+
+
+def benchmark_generation(total_images, workers, min_tiles, max_tiles, chunk_size=None):
+    _benchmark_steps()
+
+    def images_per_second(**kwargs):
+        start = time.perf_counter()
+        run_generation(total_images, min_tiles=min_tiles, max_tiles=max_tiles, seed=0, **kwargs)
+        return total_images / (time.perf_counter() - start)
+
+    single = images_per_second(workers=1)
+    per_image = images_per_second(workers=workers, chunk_size=1)
+    chunked = images_per_second(workers=workers, chunk_size=chunk_size)
+    print(f"Single worker:                   {single:>8.1f} images/s")
+    print(f"{workers} workers, a task per image:   {per_image:>8.1f} images/s ({per_image / single:.2f}x)")
+    print(f"{workers} workers, chunked tasks:      {chunked:>8.1f} images/s ({chunked / single:.2f}x, "
+          f"{chunked / per_image:.2f}x of a task per image)")
+
+
+# Throughput of every scene against the single row
+# python data_augmentation.py --benchmark-scenes --total-images 60
+def benchmark_scenes(samples=60, rounds=3, min_tiles=5, max_tiles=14):
+    rates = {scene: 0.0 for scene in SCENE_NAMES}
+    tiles = {scene: 0 for scene in SCENE_NAMES}
+    # Rounds interleave the scenes, the best round of each is kept
+    for _ in range(rounds):
+        for scene in SCENE_NAMES:
+            rng = random.Random(scene)
+            start = time.perf_counter()
+            labelled = 0
+            for _ in range(samples):
+                image, labels = render_augmented_image(rng.randint(min_tiles, max_tiles), rng, scene)
+                labelled += len(labels)
+                if any(not 0 <= value <= 1 for label in labels for value in label[1:]):
+                    raise AssertionError(f"Label outside the image in scene {scene}: {labels}")
+            rates[scene] = max(rates[scene], samples / (time.perf_counter() - start))
+            tiles[scene] = labelled / samples
+
+    print(f"{'scene':<12} {'images/s':>9} {'of row':>7} {'tiles/image':>12}")
+    for scene in SCENE_NAMES:
+        ratio = rates[scene] / rates["row"]
+        print(f"{scene:<12} {rates[scene]:>9.1f} {ratio:>6.0%} {tiles[scene]:>12.1f}{'  below 80%' if ratio < 0.8 else ''}")
+    return all(rates[scene] >= 0.8 * rates["row"] for scene in SCENE_NAMES)
+
+
+# Memory and start up of the workers with and without the shared cache
+# python data_augmentation.py --benchmark-memory 1,4,16
+MEMORY_WORKER = """
+import sys, json, time
+start = time.perf_counter()
+import data_augmentation
+data_augmentation.render_augmented_image(14)
+startup = time.perf_counter() - start
+print(json.dumps(dict(data_augmentation._memory_kib(), startup=startup)), flush=True)
+sys.stdin.read()  # stay alive until every worker is measured, they share pages
+"""
+
+
+def _memory_kib():
+    # Resident and proportional set size, shared pages count once per sharer in pss
+    memory = {}
+    for path, key, name in (("/proc/self/status", "VmRSS:", "rss"), ("/proc/self/smaps_rollup", "Pss:", "pss")):
+        try:
+            with open(path) as status:
+                for line in status:
+                    if line.startswith(key):
+                        memory[name] = int(line.split()[1])
+        except OSError:
+            pass
+    if "rss" not in memory:
+        import resource
+        memory["rss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return memory
+
+
+def _first_report(worker):
+    for line in iter(worker.stdout.readline, ""):
+        if line.startswith("{"):
+            return json.loads(line)
+    raise RuntimeError("Worker exited before reporting")
+
+
+def _measure_workers(count, shared):
+    import subprocess
+    import sys
+
+    env = dict(os.environ, AUGMENTATION_SHARED_CACHE="1" if shared else "0")
+    start = time.perf_counter()
+    workers = [subprocess.Popen([sys.executable, "-c", MEMORY_WORKER], cwd=THIS_FOLDER, env=env, text=True,
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE) for _ in range(count)]
+    reports = [_first_report(worker) for worker in workers]
+    ready = time.perf_counter() - start
+    for worker in workers:
+        worker.stdin.close()
+        worker.wait()
+    return reports, ready
+
+
+def benchmark_memory(worker_counts=(1, 4, 16)):
+    if load_shared_cache() is None:
+        build_shared_cache()
+    print(f"{'cache':<11} {'workers':>7} {'rss MiB':>9} {'pss MiB':>9} {'startup s':>10} {'all ready s':>12}")
+    for shared in (False, True):
+        for count in worker_counts:
+            reports, ready = _measure_workers(count, shared)
+            mean = lambda key: sum(report.get(key, 0) for report in reports) / len(reports)
+            print(f"{'shared' if shared else 'in process':<11} {count:>7} {mean('rss') / 1024:>9.1f} {mean('pss') / 1024:>9.1f} "
+                  f"{mean('startup'):>10.2f} {ready:>12.2f}")
+    print("(per worker means, pss splits the shared pages between the workers mapping them)")
 
 
 def parse_args():
@@ -369,11 +864,19 @@ def parse_args():
     parser.add_argument("--workers", type=int, default=1, help="Number of worker processes")
     parser.add_argument("--min-tiles", type=int, default=5, help="Minimum tiles per generated image")
     parser.add_argument("--max-tiles", type=int, default=14, help="Maximum tiles per generated image")
+    parser.add_argument("--chunk-size", type=int, default=None, help="Images per worker task, defaults to about 4 tasks per worker")
+    parser.add_argument("--shards", default=None, metavar="FOLDER",
+                        help="Write the images in shards of --chunk-size images (512 by default) to FOLDER")
+    parser.add_argument("--seed", type=int, default=None, help="Seed of the generated images, defaults to the time")
     parser.add_argument(
         "--benchmark",
         action="store_true",
         help="Run sequential vs parallel benchmark using --total-images count",
     )
+    parser.add_argument("--scene", choices=SCENE_NAMES, default="row", help="Scene of the generated images")
+    parser.add_argument("--benchmark-scenes", action="store_true", help="Report the throughput of every scene, --total-images per scene")
+    parser.add_argument("--benchmark-memory", default=None, metavar="COUNTS",
+                        help="Comma separated worker counts, report their memory and start up with and without the shared cache")
     return parser.parse_args()
 
 
@@ -381,6 +884,10 @@ def main():
     args = parse_args()
     workers = max(1, args.workers)
 
+    if args.benchmark_memory:
+        benchmark_memory([int(count) for count in args.benchmark_memory.split(",")])
+        return
+
     if args.total_images is None:
         total_images = int(input("Enter the number of images to generate: "))
     else:
@@ -389,11 +896,15 @@ def main():
     min_tiles = min(args.min_tiles, args.max_tiles)
     max_tiles = max(args.min_tiles, args.max_tiles)
 
-    if args.benchmark:
+    if args.benchmark_scenes:
+        if not benchmark_scenes(total_images, min_tiles=min_tiles, max_tiles=max_tiles):
+            raise SystemExit(1)
+    elif args.benchmark:
         benchmark_workers = workers if workers > 1 else max(2, (os.cpu_count() or 2) - 1)
-        benchmark_generation(total_images, benchmark_workers, min_tiles, max_tiles)
+        benchmark_generation(total_images, benchmark_workers, min_tiles, max_tiles, args.chunk_size)
     else:
-        run_generation(total_images, workers=workers, min_tiles=min_tiles, max_tiles=max_tiles)
+        run_generation(total_images, workers=workers, min_tiles=min_tiles, max_tiles=max_tiles,
+                       chunk_size=args.chunk_size, seed=args.seed, scene=args.scene, shards=args.shards)
 
     print("Finish generating images")
 
@@ -0,0 +1,428 @@
+import os
+import time
+import random
+import struct
+import argparse
+import tempfile
+from glob import glob
+
+import cv2
+import numpy as np
+
+# Training images packed in shard files instead of one JPEG and one label file
+# per image, which are slow to list, move and read once there are tens of
+# thousands of them. A dataset is a folder of shards, each of at most
+# SHARD_SIZE images, read through memory maps. The train/val split is a split
+# of the sample indices, no file is moved.
+# python dataset_shards.py --convert datasets/original/augmented --output datasets/shards
+# python data_augmentation.py --total-images 20000 --workers 4 --shards datasets/shards
+# python dataset_shards.py --benchmark --samples 500
+# python main.py --shards datasets/shards --val-ratio 0.2
+THIS_FOLDER = os.path.dirname(os.path.abspath(__file__))
+SHARD_SIZE = 512
+SHARD_SUFFIX = ".shard"
+LABEL_FIELDS = 5  # class, center x, center y, width, height
+
+# File layout (little endian):
+#   header: magic, version, number of samples, capacity of the index
+#   index: INDEX[capacity], per sample the offset of its record, the number
+#          of bytes of the encoded image, of labels and of its name
+#   records: per sample float32[labels, 5] labels, the name in utf-8 and the
+#            encoded image, each record starts at a multiple of 4 bytes
+SHARD_MAGIC = b"MJSHRD"
+SHARD_VERSION = 1
+HEADER = struct.Struct("<6sHII")
+INDEX = np.dtype([("offset", "<u8"), ("image_size", "<u4"), ("labels", "<u2"), ("name_size", "<u2")])
+
+
+class ShardWriter():
+    """
+    Write samples to one shard, the shard appears at path when it is closed.
+    Parameters:
+        path: str, the shard file.
+        capacity: int, the maximum number of samples.
+    """
+    def __init__(self, path, capacity=SHARD_SIZE):
+        self.path = path
+        self.capacity = capacity
+        self.index = np.zeros(capacity, dtype=INDEX)
+        self.count = 0
+        self.tmp_path = f"{path}.{os.getpid()}.tmp"
+        self.file = open(self.tmp_path, "wb")
+        # The header and the index are written last, in the space kept here
+        self.file.seek(HEADER.size + INDEX.itemsize * capacity)
+
+    def add(self, image, labels, name=""):
+        """
+        Append a sample.
+        Parameters:
+            image: np.ndarray, an RGB image encoded as JPEG, or bytes of an encoded image stored as they are.
+            labels: rows of (class, center x, center y, width, height).
+            name: str, the name of the sample, such as the stem of its files.
+        """
+        if self.count == self.capacity:
+            raise ValueError(f"Shard {self.path} is full with {self.capacity} samples")
+        if isinstance(image, np.ndarray):
+            ok, encoded = cv2.imencode(".jpg", cv2.cvtColor(image, cv2.COLOR_RGB2BGR))
+            if not ok:
+                raise ValueError(f"Could not encode sample {name}")
+            image = encoded.tobytes()
+        labels = np.asarray(labels, dtype="<f4").reshape(-1, LABEL_FIELDS)
+        name = name.encode("utf-8")
+
+        offset = self.file.tell()
+        self.index[self.count] = (offset, len(image), len(labels), len(name))
+        self.file.write(labels.tobytes())
+        self.file.write(name)
+        self.file.write(image)
+        self.file.write(b"\0" * (-self.file.tell() % 4))
+        self.count += 1
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.file.seek(0)
+        self.file.write(HEADER.pack(SHARD_MAGIC, SHARD_VERSION, self.count, self.capacity))
+        self.file.write(self.index.tobytes())
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        self.file.close()
+        os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        # A failed writer leaves no shard behind
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def shard_path(output_dir, name):
+    return os.path.join(output_dir, f"{name}{SHARD_SUFFIX}")
+
+
+def _open_shard(path):
+    # Plain array view of the mapping, memmap slicing is slow on the hot path
+    raw = np.memmap(path, dtype=np.uint8, mode="r").view(np.ndarray)
+    magic, version, count, capacity = HEADER.unpack(raw[:HEADER.size].tobytes())
+    if magic != SHARD_MAGIC or version != SHARD_VERSION:
+        raise ValueError(f"{path} is not a shard of version {SHARD_VERSION}")
+    index = raw[HEADER.size:HEADER.size + INDEX.itemsize * capacity].view(INDEX)[:count]
+    return raw, index
+
+
+class ShardDataset():
+    """
+    Random access to the samples of a folder of shards, usable as a map style
+    dataset by torch's DataLoader. Every process maps the shards on first use.
+    Parameters:
+        path: str, the folder of the shards, or one shard.
+        indices: the samples of the dataset in this order, defaults to all of them.
+    """
+    def __init__(self, path, indices=None):
+        self.path = path
+        self.files = sorted(glob(os.path.join(path, f"*{SHARD_SUFFIX}"))) if os.path.isdir(path) else [path]
+        if not self.files:
+            raise FileNotFoundError(f"No shards in {path}")
+        self.shards = None
+        counts = [len(index) for _, index in self._shards()]
+        # Start of every shard in the sample numbers
+        self.starts = np.cumsum([0] + counts)
+        self.indices = np.arange(self.starts[-1]) if indices is None else np.asarray(indices, dtype=np.int64)
+
+    def _shards(self):
+        if self.shards is None:
+            self.shards = [_open_shard(file) for file in self.files]
+        return self.shards
+
+    def __getstate__(self):
+        # DataLoader workers map the shards again instead of receiving a copy
+        state = self.__dict__.copy()
+        state["shards"] = None
+        return state
+
+    def __len__(self):
+        return len(self.indices)
+
+    def read(self, index):
+        """
+        The stored sample, without decoding the image.
+        Returns:
+            image: np.ndarray, the bytes of the encoded image, a view of the shard.
+            labels: np.ndarray, float32 (labels, 5), a view of the shard.
+            name: str, the name of the sample.
+        """
+        if not -len(self.indices) <= index < len(self.indices):
+            raise IndexError(f"Sample {index} out of range for {len(self.indices)} samples")
+        sample = self.indices[index]
+        shard = int(self.starts.searchsorted(sample, side="right")) - 1
+        raw, shard_index = self._shards()[shard]
+        offset, image_size, labels, name_size = shard_index[sample - self.starts[shard]].tolist()
+        name_start = offset + 4 * LABEL_FIELDS * labels
+        image_start = name_start + name_size
+        return (raw[image_start:image_start + image_size],
+                raw[offset:name_start].view("<f4").reshape(labels, LABEL_FIELDS),
+                raw[name_start:image_start].tobytes().decode("utf-8"))
+
+    def __getitem__(self, index):
+        """
+        Returns:
+            image: np.ndarray, the RGB image.
+            labels: np.ndarray, float32 (tiles, 5) rows of class, center x, center y, width, height.
+        """
+        encoded, labels, _ = self.read(index)
+        return decode_image(encoded), labels.copy()
+
+    def subset(self, indices):
+        subset = ShardDataset.__new__(ShardDataset)
+        subset.__dict__.update(self.__getstate__())
+        subset.indices = self.indices[np.asarray(indices, dtype=np.int64)]
+        return subset
+
+    def split(self, val_ratio=0.2, seed=42):
+        """
+        Split the samples in a train and a validation subset, the same seed gives the same split.
+        Returns:
+            train: ShardDataset, the first 1 - val_ratio of the shuffled samples.
+            val: ShardDataset, the rest.
+        """
+        order = np.random.default_rng(seed).permutation(len(self))
+        split_index = int(len(order) * (1 - min(max(val_ratio, 0.0), 1.0)))
+        return self.subset(np.sort(order[:split_index])), self.subset(np.sort(order[split_index:]))
+
+
+def decode_image(encoded):
+    return cv2.cvtColor(cv2.imdecode(encoded, cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB)
+
+
+def yolo_sample(image, labels, im_file, imgsz):
+    # A sample in the batch format of the ultralytics detection trainer and validator
+    import torch
+
+    shape = image.shape[:2]
+    if shape != (imgsz, imgsz):
+        image = cv2.resize(image, (imgsz, imgsz), interpolation=cv2.INTER_AREA)
+    return {
+        "img": torch.from_numpy(np.ascontiguousarray(image.transpose(2, 0, 1))),
+        "cls": torch.from_numpy(labels[:, :1]),
+        "bboxes": torch.from_numpy(labels[:, 1:]),
+        "im_file": im_file,
+        "ori_shape": shape,
+        "resized_shape": (imgsz, imgsz),
+        "ratio_pad": ((imgsz / shape[0], imgsz / shape[1]), (0, 0)),
+    }
+
+
+def collate_yolo(batch):
+    import torch
+
+    return {
+        "img": torch.stack([sample["img"] for sample in batch]),
+        "cls": torch.cat([sample["cls"] for sample in batch]),
+        "bboxes": torch.cat([sample["bboxes"] for sample in batch]),
+        "batch_idx": torch.cat([torch.full((len(sample["cls"]),), float(i)) for i, sample in enumerate(batch)]),
+        **{key: [sample[key] for sample in batch] for key in ("im_file", "ori_shape", "resized_shape", "ratio_pad")},
+    }
+
+
+class YoloShardDataset(ShardDataset):
+    """
+    ShardDataset in the batch format of the ultralytics detection trainer.
+    Parameters:
+        imgsz: int, the size the square images are resized to.
+    """
+    def __init__(self, dataset, imgsz=640):
+        self.__dict__.update(dataset.__getstate__())
+        self.imgsz = imgsz
+
+    def __getitem__(self, index):
+        encoded, labels, name = self.read(index)
+        return yolo_sample(decode_image(encoded), labels.copy(), name, self.imgsz)
+
+    collate_fn = staticmethod(collate_yolo)
+
+
+def train_shards(config, path, val_ratio=0.2, seed=42):
+    """
+    Train and validate on a split of the shards instead of the train and val folders.
+    """
+    from ultralytics import YOLO
+    from ultralytics.models.yolo.detect import DetectionTrainer
+
+    train, val = ShardDataset(path).split(val_ratio, seed)
+
+    class ShardTrainer(DetectionTrainer):
+        def build_dataset(self, img_path, mode="train", batch=None):
+            return YoloShardDataset(train if mode == "train" else val, imgsz=self.args.imgsz)
+
+        def plot_training_labels(self):
+            # The labels are in the shards, not in label files
+            pass
+
+    model = YOLO(config["model"])
+    return model.train(trainer=ShardTrainer, **config)
+
+
+# python dataset_shards.py --convert datasets/train --output datasets/shards
+def _read_label_file(path):
+    if not os.path.exists(path):
+        return np.zeros((0, LABEL_FIELDS), dtype=np.float32)
+    return np.loadtxt(path, dtype=np.float32, ndmin=2).reshape(-1, LABEL_FIELDS)
+
+
+def convert_folder(input_dir, output_dir, shard_size=SHARD_SIZE, name=None):
+    """
+    Pack the images of input_dir/images and their labels (input_dir/labels, or
+    labeled as data_augmentation.py writes them) in shards, the JPEG bytes are
+    copied as they are. Images without a label file get no labels.
+    Returns:
+        count: int, the number of samples written.
+    """
+    images_dir = os.path.join(input_dir, "images")
+    labels_dir = next((os.path.join(input_dir, folder) for folder in ("labels", "labeled")
+                       if os.path.isdir(os.path.join(input_dir, folder))), os.path.join(input_dir, "labels"))
+    stems = sorted(os.path.splitext(entry.name)[0] for entry in os.scandir(images_dir)
+                   if entry.is_file() and entry.name.lower().endswith(".jpg"))
+    name = name or os.path.basename(os.path.normpath(input_dir))
+    os.makedirs(output_dir, exist_ok=True)
+
+    for start in range(0, len(stems), shard_size):
+        with ShardWriter(shard_path(output_dir, f"{name}-{start // shard_size:05d}"), shard_size) as writer:
+            for stem in stems[start:start + shard_size]:
+                with open(os.path.join(images_dir, f"{stem}.jpg"), "rb") as file:
+                    image = file.read()
+                writer.add(image, _read_label_file(os.path.join(labels_dir, f"{stem}.txt")), stem)
+    return len(stems)
+
+
+# Reads of the shards against the JPEG and label files they were converted from
+# python dataset_shards.py --benchmark --samples 500
+# python dataset_shards.py --benchmark --input datasets/train
+def _read_folder_sample(images_dir, labels_dir, stem):
+    # What the trainer does with a sample of the folders
+    image = cv2.cvtColor(cv2.imread(os.path.join(images_dir, f"{stem}.jpg"), cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB)
+    return image, _read_label_file(os.path.join(labels_dir, f"{stem}.txt"))
+
+
+def _read_folder_encoded(images_dir, labels_dir, stem):
+    with open(os.path.join(images_dir, f"{stem}.jpg"), "rb") as file:
+        image = file.read()
+    return image, _read_label_file(os.path.join(labels_dir, f"{stem}.txt"))
+
+
+def _drop_page_cache(paths):
+    # Reads from the disk instead of memory, where the system allows it
+    if not hasattr(os, "posix_fadvise"):
+        return False
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+    return True
+
+
+def _materialize_samples(output_dir, samples, seed):
+    from augmentation_dataset import AugmentedDataset
+
+    AugmentedDataset(samples, seed).materialize(output_dir)
+
+
+def benchmark_read(input_dir=None, samples=500, seed=0, shard_size=SHARD_SIZE):
+    with tempfile.TemporaryDirectory() as tmp:
+        if input_dir is None:
+            input_dir = os.path.join(tmp, "folder")
+            _materialize_samples(input_dir, samples, seed)
+        output_dir = os.path.join(tmp, "shards")
+
+        start = time.perf_counter()
+        count = convert_folder(input_dir, output_dir, shard_size)
+        convert_duration = time.perf_counter() - start
+
+        images_dir = os.path.join(input_dir, "images")
+        labels_dir = os.path.join(input_dir, "labels" if os.path.isdir(os.path.join(input_dir, "labels")) else "labeled")
+        start = time.perf_counter()
+        stems = sorted(os.path.splitext(entry.name)[0] for entry in os.scandir(images_dir) if entry.name.endswith(".jpg"))
+        list_folder = time.perf_counter() - start
+        start = time.perf_counter()
+        dataset = ShardDataset(output_dir)
+        list_shards = time.perf_counter() - start
+
+        # A shuffled epoch, as the trainer reads it
+        order = list(range(count))
+        random.Random(seed).shuffle(order)
+        folder_bytes = sum(os.path.getsize(os.path.join(images_dir, f"{stem}.jpg")) for stem in stems)
+        shard_bytes = sum(os.path.getsize(file) for file in dataset.files)
+
+        folder_files = [os.path.join(folder, name) for folder in (images_dir, labels_dir) for name in os.listdir(folder)]
+
+        # The encoded reads start from the disk, the decoded ones from the page cache
+        cold = _drop_page_cache(folder_files)
+        start = time.perf_counter()
+        for index in order:
+            _read_folder_encoded(images_dir, labels_dir, stems[index])
+        folder_raw_duration = time.perf_counter() - start
+
+        _drop_page_cache(dataset.files)
+        dataset = ShardDataset(output_dir)
+        start = time.perf_counter()
+        for index in order:
+            encoded, labels, _ = dataset.read(index)
+            encoded.tobytes(), labels.copy()
+        raw_duration = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for index in order:
+            _read_folder_sample(images_dir, labels_dir, stems[index])
+        folder_duration = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for index in order:
+            dataset[index]
+        shard_duration = time.perf_counter() - start
+
+        same = True
+        for index in order[:20]:
+            (image, labels), (folder_image, folder_labels) = dataset[index], _read_folder_sample(images_dir, labels_dir, stems[index])
+            same = same and np.array_equal(image, folder_image) and np.array_equal(labels, folder_labels)
+
+    print(f"Samples: {count} in {len(dataset.files)} shards ({len(stems) * 2} files before), same samples: {same}")
+    print(f"Convert:                {count / convert_duration:>9.1f} samples/s")
+    print(f"List folder:            {1e3 * list_folder:>9.2f} ms")
+    print(f"Open shards:            {1e3 * list_shards:>9.2f} ms")
+    print(f"Encoded reads {'from the disk' if cold else 'from the page cache'}, shuffled order")
+    print(f"Read JPEG + label file: {count / folder_raw_duration:>9.1f} samples/s ({folder_bytes / folder_raw_duration / 2 ** 20:.1f} MiB/s)")
+    print(f"Read shard:             {count / raw_duration:>9.1f} samples/s ({shard_bytes / raw_duration / 2 ** 20:.1f} MiB/s)")
+    print("Decoded to RGB")
+    print(f"Read JPEG + label file: {count / folder_duration:>9.1f} samples/s")
+    print(f"Read shard:             {count / shard_duration:>9.1f} samples/s")
+    print(f"Speedup encoded: {folder_raw_duration / raw_duration:.2f}x, decoded: {folder_duration / shard_duration:.2f}x")
+    return same
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Training images packed in shard files")
+    parser.add_argument("--convert", default=None, metavar="FOLDER", help="Pack FOLDER/images and its labels in shards")
+    parser.add_argument("--output", default=os.path.join(THIS_FOLDER, "datasets", "shards"), help="Folder of the shards")
+    parser.add_argument("--shard-size", type=int, default=SHARD_SIZE, help="Samples per shard")
+    parser.add_argument("--benchmark", action="store_true", help="Compare reading shards with reading the folder")
+    parser.add_argument("--input", default=None, help="Folder of the benchmark, defaults to --samples augmented images")
+    parser.add_argument("--samples", type=int, default=500, help="Number of augmented samples of the benchmark")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the benchmark samples")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.convert:
+        count = convert_folder(args.convert, args.output, max(1, args.shard_size))
+        print(f"Wrote {count} samples of {args.convert} to {args.output}")
+    if args.benchmark and not benchmark_read(args.input, args.samples, args.seed, max(1, args.shard_size)):
+        raise SystemExit(1)
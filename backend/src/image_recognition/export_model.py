@@ -0,0 +1,198 @@
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+from glob import glob
+
+THIS_FOLDER = os.path.dirname(os.path.abspath(__file__))
+weights_dir = os.path.join(THIS_FOLDER, "runs", "detect", "train5", "weights")
+default_weights = os.path.join(weights_dir, "best.pt")
+test_images = [
+    os.path.join(THIS_FOLDER, "..", "test.png"),
+    os.path.join(THIS_FOLDER, "..", "test2.jpg"),
+]
+augmented_images_path = os.path.join(THIS_FOLDER, "datasets", "original", "augmented", "images")
+
+# Model files for each backend, the same names tile_recognition looks for
+backend_files = {
+    "torch": "best.pt",
+    "onnx": "best.onnx",
+    "onnx-int8": "best-int8.onnx",
+    "openvino": "best_openvino_model",
+}
+
+
+# Export the trained detector for CPU inference
+# python export_model.py export --format onnx --int8
+def export_model(weights=default_weights, export_format="onnx", int8=False, imgsz=1024):
+    from ultralytics import YOLO
+
+    model = YOLO(weights)
+    if export_format == "openvino":
+        # OpenVINO calibrates INT8 with the validation images of data.yaml
+        exported = model.export(format="openvino", imgsz=imgsz, int8=int8, data=os.path.join(THIS_FOLDER, "data.yaml"))
+        print("Exported OpenVINO model to", exported)
+        return exported
+
+    exported = model.export(format="onnx", imgsz=imgsz, dynamic=True, simplify=True)
+    print("Exported ONNX model to", exported)
+
+    if int8:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        quantized = os.path.join(os.path.dirname(exported), backend_files["onnx-int8"])
+        quantize_dynamic(exported, quantized, weight_type=QuantType.QUInt8)
+        print("Exported INT8 ONNX model to", quantized)
+        return quantized
+    return exported
+
+
+# Compare latency, memory and detections of every exported backend
+# python export_model.py benchmark --runs 10 --synthetic 50
+def _peak_rss_mb():
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Kilobytes on Linux, bytes on macOS
+        return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+    except ImportError:
+        import psutil
+        return psutil.Process().memory_info().peak_wset / 1024 / 1024
+
+
+def _measure_backend(model_path, images, runs, imgsz, conf):
+    """
+    Runs in a child process so the memory of each backend is measured alone.
+    """
+    start_load = time.perf_counter()
+    from ultralytics import YOLO
+    model = YOLO(model_path, task="detect")
+    model(images[0], conf=conf, imgsz=imgsz, verbose=False)  # warm up
+    load_time = time.perf_counter() - start_load
+
+    latencies = []
+    detections = []
+    for image in images:
+        for run in range(runs):
+            start = time.perf_counter()
+            result = model(image, conf=conf, imgsz=imgsz, verbose=False)[0]
+            latencies.append(time.perf_counter() - start)
+        detections.append([
+            [int(cls)] + [float(v) for v in box]
+            for cls, box in zip(result.boxes.cls.tolist(), result.boxes.xyxy.tolist())
+        ])
+
+    latencies.sort()
+    return {
+        "load_s": load_time,
+        "mean_ms": 1e3 * sum(latencies) / len(latencies),
+        "p50_ms": 1e3 * latencies[len(latencies) // 2],
+        "p99_ms": 1e3 * latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))],
+        "peak_rss_mb": _peak_rss_mb(),
+        "detections": detections,
+    }
+
+
+def _iou(a, b):
+    x1, y1 = max(a[0], b[0]), max(a[1], b[1])
+    x2, y2 = min(a[2], b[2]), min(a[3], b[3])
+    inter = max(0.0, x2 - x1) * max(0.0, y2 - y1)
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / union if union > 0 else 0.0
+
+
+def _agreement(reference, detections, iou_threshold=0.5):
+    """
+    Fraction of reference boxes matched by a box of the same class, and the mean IoU of the matches.
+    """
+    matched = total = 0
+    ious = []
+    for ref_boxes, boxes in zip(reference, detections):
+        remaining = list(boxes)
+        total += len(ref_boxes)
+        for ref in ref_boxes:
+            candidates = [(_iou(ref[1:], box[1:]), i) for i, box in enumerate(remaining) if box[0] == ref[0]]
+            if not candidates:
+                continue
+            best_iou, best_index = max(candidates)
+            if best_iou >= iou_threshold:
+                matched += 1
+                ious.append(best_iou)
+                remaining.pop(best_index)
+    return {
+        "recall": matched / total if total else 1.0,
+        "mean_iou": sum(ious) / len(ious) if ious else 0.0,
+    }
+
+
+def benchmark_backends(runs=10, synthetic=50, imgsz=1024, conf=0.5):
+    images = [os.path.abspath(path) for path in test_images if os.path.exists(path)]
+    synthetic_images = sorted(glob(os.path.join(augmented_images_path, "*.jpg")))[:synthetic]
+    if synthetic and not synthetic_images:
+        print(f"No synthetic images in {augmented_images_path}, run data_augmentation.py first")
+    images += synthetic_images
+
+    results = {}
+    for backend, filename in backend_files.items():
+        model_path = os.path.join(weights_dir, filename)
+        if not os.path.exists(model_path):
+            print(f"Skipping {backend}: {model_path} not found, run export_model.py export first")
+            continue
+        command = [sys.executable, os.path.abspath(__file__), "measure", "--model", model_path,
+                   "--runs", str(runs), "--imgsz", str(imgsz), "--conf", str(conf), "--images", *images]
+        output = subprocess.run(command, capture_output=True, text=True, check=True).stdout
+        results[backend] = json.loads(output.strip().splitlines()[-1])
+
+    if "torch" not in results:
+        raise RuntimeError("The PyTorch model is needed as the reference")
+
+    reference = results["torch"]["detections"]
+    print(f"Images: {len(images)} ({len(synthetic_images)} synthetic), runs per image: {runs}")
+    print(f"{'backend':<10} {'load s':>7} {'mean ms':>8} {'p50 ms':>8} {'p99 ms':>8} {'RSS MB':>8} {'recall':>7} {'IoU':>6}")
+    for backend, result in results.items():
+        agreement = _agreement(reference, result["detections"])
+        print(f"{backend:<10} {result['load_s']:>7.2f} {result['mean_ms']:>8.1f} {result['p50_ms']:>8.1f} "
+              f"{result['p99_ms']:>8.1f} {result['peak_rss_mb']:>8.0f} {agreement['recall']:>7.3f} {agreement['mean_iou']:>6.3f}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Export and benchmark the tile detector")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = subparsers.add_parser("export", help="Export the trained model")
+    export_parser.add_argument("--weights", default=default_weights, help="Path of the trained PyTorch weights")
+    export_parser.add_argument("--format", choices=["onnx", "openvino"], default="onnx", help="Export format")
+    export_parser.add_argument("--int8", action="store_true", help="Also quantize the model to INT8")
+    export_parser.add_argument("--imgsz", type=int, default=1024, help="Input image size")
+
+    benchmark_parser = subparsers.add_parser("benchmark", help="Compare every exported backend")
+    benchmark_parser.add_argument("--runs", type=int, default=10, help="Runs per image")
+    benchmark_parser.add_argument("--synthetic", type=int, default=50, help="Number of augmented images to add")
+    benchmark_parser.add_argument("--imgsz", type=int, default=1024, help="Input image size")
+    benchmark_parser.add_argument("--conf", type=float, default=0.5, help="Confidence threshold")
+
+    measure_parser = subparsers.add_parser("measure", help=argparse.SUPPRESS)
+    measure_parser.add_argument("--model", required=True)
+    measure_parser.add_argument("--runs", type=int, default=10)
+    measure_parser.add_argument("--imgsz", type=int, default=1024)
+    measure_parser.add_argument("--conf", type=float, default=0.5)
+    measure_parser.add_argument("--images", nargs="+", required=True)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.command == "export":
+        export_model(args.weights, args.format, args.int8, args.imgsz)
+    elif args.command == "benchmark":
+        benchmark_backends(args.runs, args.synthetic, args.imgsz, args.conf)
+    elif args.command == "measure":
+        print(json.dumps(_measure_backend(args.model, args.images, args.runs, args.imgsz, args.conf)))
+
+
+# python export_model.py export --int8
+# python export_model.py benchmark
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,36 @@
+import argparse
 from ultralytics import YOLO
 import yaml
 
+# python main.py                 trains on the train folder
+# python main.py --stream 20000  trains on augmented images rendered on the fly
+# python main.py --shards datasets/shards --val-ratio 0.2  trains and validates on a split of the shards
+parser = argparse.ArgumentParser(description="Train the tile detector")
+parser.add_argument("--config", default="configs/train2.yaml", help="Training config")
+parser.add_argument("--stream", type=int, default=0, help="Number of streamed training images, 0 reads the train folder")
+parser.add_argument("--seed", type=int, default=0, help="Seed of the streamed images")
+parser.add_argument("--scene", default="row", help="Scene of the streamed images, see data_augmentation.SCENES")
+parser.add_argument("--shards", default=None, help="Folder of dataset shards to train on instead of the train folder")
+parser.add_argument("--val-ratio", type=float, default=0.2, help="Share of the shard samples kept for validation")
+parser.add_argument("--split-seed", type=int, default=42, help="Seed of the train/val split of the shards")
+args = parser.parse_args()
+
 # Load the config
-config_path = "configs/train2.yaml"
+config_path = args.config
 with open(config_path, "r") as file:
     config = yaml.load(file, Loader=yaml.FullLoader)
 
-# Load the model
-model = YOLO(config["model"])
+if args.shards:
+    from dataset_shards import train_shards
+
+    train_results = train_shards(config, args.shards, args.val_ratio, args.split_seed)
+elif args.stream:
+    from augmentation_dataset import train_streaming
+
+    train_results = train_streaming(config, args.stream, args.seed, args.scene)
+else:
+    # Load the model
+    model = YOLO(config["model"])
 
-# Train the model
-train_results = model.train(**config)
+    # Train the model
+    train_results = model.train(**config)
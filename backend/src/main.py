@@ -1,4 +1,5 @@
 import os
+import logging
 
 if __package__ in (None, ""):
     import sys
@@ -8,13 +9,17 @@ if __package__ in (None, ""):
     if _backend_dir not in sys.path:
         sys.path.insert(0, _backend_dir)
 
-    from src.pattern_recognition.tile_recognition import tile_recognition
-    from src.pattern_recognition.main import check_win_condition, unpackage_breakdown_list
-    from src.tile_generation.main import tile_generation
+    from src.pattern_recognition.main import check_win_condition, evaluate_hand, unpackage_breakdown_list
+    from src.pattern_recognition.inference_service import service_enabled, detect_remote, UndecodableImage
+    from src.pattern_recognition.suit_table import load_table
+    from src.tile_generation.main import tile_generation, encode_tiles, load_atlas
+    from src.metrics import span, observe
 else:
-    from .pattern_recognition.tile_recognition import tile_recognition
-    from .pattern_recognition.main import check_win_condition, unpackage_breakdown_list
-    from .tile_generation.main import tile_generation
+    from .pattern_recognition.main import check_win_condition, evaluate_hand, unpackage_breakdown_list
+    from .pattern_recognition.inference_service import service_enabled, detect_remote, UndecodableImage
+    from .pattern_recognition.suit_table import load_table
+    from .tile_generation.main import tile_generation, encode_tiles, load_atlas
+    from .metrics import span, observe
 
 others = {
     "round": "east", # the current round
@@ -28,24 +33,116 @@ others = {
     "bonus": 30, # the bonus money for each tai
 }
 _this_dir = os.path.dirname(os.path.abspath(__file__))
+logger = logging.getLogger(__name__)
+
+# Stages reported by the inference service, as named in the metrics
+service_stages = {"queue_wait": "detection_queue", "decode": "decode", "inference": "detection"}
+
+def tile_recognition(image_path):
+    # The model is only loaded in the process that runs the detection
+    if __package__ in (None, ""):
+        from src.pattern_recognition.tile_recognition import tile_recognition as detect
+    else:
+        from .pattern_recognition.tile_recognition import tile_recognition as detect
+    return detect(image_path)
+
+def detect_image(image):
+    # Detect the tiles of a decoded BGR image in this process
+    if __package__ in (None, ""):
+        from src.pattern_recognition.tile_recognition import detect_tiles
+    else:
+        from .pattern_recognition.tile_recognition import detect_tiles
+    return detect_tiles([image])[0]
+
+def warm_up():
+    # Load everything the first analysis needs, the detector only when it runs in this process
+    load_atlas()
+    load_table()
+    if not service_enabled():
+        if __package__ in (None, ""):
+            from src.pattern_recognition.tile_recognition import get_model
+        else:
+            from .pattern_recognition.tile_recognition import get_model
+        get_model()
+
+def recognize_tiles(image_path):
+    # Use the inference service when INFERENCE_ADDRESS is set, else detect in this process
+    if not service_enabled():
+        return tile_recognition(image_path)
+
+    with open(image_path, "rb") as image_file:
+        return recognize_image(image_file.read())
+
+def recognize_image(image_bytes):
+    # Recognize the tiles of an encoded image without writing it to disk
+    if service_enabled():
+        tiles, timings = detect_remote(image_bytes)
+        logger.debug("Inference service timings %s", timings)
+        for stage, name in service_stages.items():
+            if stage in timings:
+                observe(name, timings[stage])
+        return tiles
+
+    import cv2
+    import numpy as np
+
+    with span("decode"):
+        image = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise UndecodableImage("Unable to decode image")
+    return detect_image(image)
+
+def analyze_image(image_bytes, others_settings=None):
+    """
+    Analyze an uploaded image in memory.
+    Parameters:
+        image_bytes: bytes, the encoded image (jpg or png).
+        others_settings: dict, the game settings, defaults to others.
+    Returns:
+        result: HandResult, the best result of the hand.
+        png: bytes, the image of the winning tiles, or None if the hand does not win.
+    """
+    return score_tiles(recognize_image(image_bytes), others_settings)
+
+def score_tiles(tiles, others_settings=None):
+    """
+    Score recognized tiles and draw the winning hand.
+    Parameters:
+        tiles: tuple of list, (bing, bamboo, wan, words, bonus).
+        others_settings: dict, the game settings, defaults to others.
+    Returns:
+        result: HandResult, the best result of the hand.
+        png: bytes, the image of the winning tiles, or None if the hand does not win.
+    """
+    if others_settings is None:
+        others_settings = others
+
+    bing, bamboo, wan, words, bonus = tiles
+    result = evaluate_hand(bing, bamboo, wan, words, bonus, others_settings)
+
+    # Encode the picture of the winning tiles once, no file is written
+    winning_tiles = unpackage_breakdown_list(result.breakdown)
+    return result, encode_tiles(winning_tiles)
 
-def backend_main(others_settings=None, output_filename=None):
+def backend_main(others_settings=None, output_filename=None, image_path=None):
     if others_settings is None:
         others_settings = others
 
-    bing = [1, 2, 3, 4, 5, 6, 7, 8, 9]
-    bamboo = [10, 11, 12, 10, 11, 12, 10, 11]
-    wan = []
-    words = []
-    bonus = []
+    if image_path:
+        bing, bamboo, wan, words, bonus = recognize_tiles(image_path)
+    else:
+        bing = [1, 2, 3, 4, 5, 6, 7, 8, 9]
+        bamboo = [10, 11, 12, 10, 11, 12, 10, 11]
+        wan = []
+        words = []
+        bonus = []
 
     # Recognize the tiles
-    final_money, final_breakdown = check_win_condition(bing, bamboo, wan, words, bonus, others_settings)
+    result = evaluate_hand(bing, bamboo, wan, words, bonus, others_settings)
 
     # Generate picture of the winning tiles
-    print("Generating winning tiles image...")
-    print("final_breakdown: ", final_breakdown)
-    tiles = unpackage_breakdown_list(final_breakdown)
+    logger.debug("Generating winning tiles image, breakdown %s", result.breakdown)
+    tiles = unpackage_breakdown_list(result.breakdown)
     
     # Determine save path if filename is provided
     save_path = None
@@ -56,7 +153,7 @@ def backend_main(others_settings=None, output_filename=None):
         
     tile_generation(tiles, output=True, save_path=save_path)
 
-    return final_money, final_breakdown
+    return result
 
 
 # Core logic of backend
@@ -65,34 +162,36 @@ def final_backend_main(file_path: str, others_settings=None):
         others_settings = others
 
     # Recognize the tiles
-    print("Recognizing tiles in", file_path)
-    bing, bamboo, wan, words, bonus = tile_recognition(file_path)
+    logger.info("Recognizing tiles in %s", file_path)
+    bing, bamboo, wan, words, bonus = recognize_tiles(file_path)
 
-    # Print the recognized tiles to check
-    print(f"Bing tiles: {bing}")
-    print(f"Bamboo tiles: {bamboo}")
-    print(f"Wan tiles: {wan}")
-    print(f"Word tiles: {words}")
-    print(f"Bonus tiles: {bonus}")
+    # Log the recognized tiles to check
+    logger.debug("Bing tiles: %s", bing)
+    logger.debug("Bamboo tiles: %s", bamboo)
+    logger.debug("Wan tiles: %s", wan)
+    logger.debug("Word tiles: %s", words)
+    logger.debug("Bonus tiles: %s", bonus)
 
     # Generate picture of tiles
-    print("Generating virtual tile image...")
+    logger.debug("Generating virtual tile image")
     tiles = bing + bamboo + wan + words + bonus
     tile_generation(tiles, output=False)
     
     # Check the winning condition
-    print("Checking win condition and money count...")
+    logger.debug("Checking win condition and money count")
     final_money, final_breakdown = check_win_condition(bing, bamboo, wan, words, bonus, others_settings)
 
-    print(f"Final money: {final_money}")
-    print(f"Final breakdown: {final_breakdown}")
+    logger.info("Final money: %s", final_money)
+    logger.info("Final breakdown: %s", final_breakdown)
 
     # Generate picture of the winning tiles
-    print("Generating winning tiles image...")
+    logger.debug("Generating winning tiles image")
     tiles = unpackage_breakdown_list(final_breakdown)
     tile_generation(tiles, output=True)
 
     return final_money, final_breakdown
 
 if __name__ == "__main__":
+    from src.metrics import configure_logging
+    configure_logging()
     final_money, final_breakdown = final_backend_main("test2.jpg")
\ No newline at end of file
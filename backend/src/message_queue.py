@@ -0,0 +1,185 @@
+import os
+import json
+import time
+import queue
+import socket
+import logging
+import argparse
+import threading
+
+import socketio
+
+from .pattern_recognition.inference_service import send_frame, recv_frame
+
+# Socket.IO message queues, so an event emitted by one worker reaches the
+# clients connected to every worker. SOCKETIO_MESSAGE_QUEUE selects one:
+#   redis://host:port/0, amqp://...  handled by Flask-SocketIO (needs redis or kombu)
+#   broker://host:port               the local broker of this module
+#   memory://                        several servers inside one process, for tests
+# python -m src.message_queue --serve
+DEFAULT_BROKER_ADDRESS = "127.0.0.1:5056"
+RECONNECT_DELAY = 1.0
+
+logger = logging.getLogger(__name__)
+
+
+def _parse_address(address):
+    host, port = address.rsplit(":", 1)
+    return host, int(port)
+
+
+class MessageBroker():
+    """
+    Minimal pub/sub broker: every message published on a channel is sent to
+    every connection subscribed to that channel.
+    """
+    def __init__(self, address=DEFAULT_BROKER_ADDRESS):
+        self.address = _parse_address(address)
+        self.lock = threading.Lock()
+        self.subscribers = {}
+        self.sock = None
+
+    def serve_forever(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(self.address)
+        self.sock.listen(128)
+        logger.info("Listening on %s:%s", self.address[0], self.address[1])
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                break
+            threading.Thread(target=self._handle_connection, args=(conn,), daemon=True).start()
+
+    def shutdown(self):
+        if self.sock is not None:
+            self.sock.close()
+
+    def _handle_connection(self, conn):
+        channels = []
+        send_lock = threading.Lock()
+        try:
+            while True:
+                header, payload = recv_frame(conn)
+                if header.get("type") == "subscribe":
+                    with self.lock:
+                        self.subscribers.setdefault(header["channel"], []).append((conn, send_lock))
+                    channels.append(header["channel"])
+                elif header.get("type") == "publish":
+                    self._publish(header["channel"], payload)
+        except (ConnectionError, OSError, ValueError):
+            pass
+        finally:
+            with self.lock:
+                for channel in channels:
+                    self.subscribers[channel] = [s for s in self.subscribers[channel] if s[0] is not conn]
+            conn.close()
+
+    def _publish(self, channel, payload):
+        with self.lock:
+            subscribers = list(self.subscribers.get(channel, ()))
+        for conn, send_lock in subscribers:
+            try:
+                with send_lock:
+                    send_frame(conn, {"channel": channel}, payload)
+            except OSError:
+                pass  # dropped by its own connection thread
+
+
+class BrokerManager(socketio.PubSubManager):
+    """
+    Socket.IO client manager on top of MessageBroker.
+    """
+    name = "broker"
+
+    def __init__(self, url="broker://" + DEFAULT_BROKER_ADDRESS, channel="flask-socketio", write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.address = _parse_address(url.split("://", 1)[1])
+        self.publish_lock = threading.Lock()
+        self.publisher = None
+
+    def _publish(self, data):
+        payload = json.dumps(data).encode("utf-8")
+        with self.publish_lock:
+            # One retry on a fresh connection if the broker was restarted
+            for attempt in range(2):
+                try:
+                    if self.publisher is None:
+                        self.publisher = socket.create_connection(self.address)
+                    send_frame(self.publisher, {"type": "publish", "channel": self.channel}, payload)
+                    return
+                except OSError:
+                    if self.publisher is not None:
+                        self.publisher.close()
+                    self.publisher = None
+                    if attempt:
+                        raise
+
+    def _listen(self):
+        while True:
+            try:
+                with socket.create_connection(self.address) as conn:
+                    send_frame(conn, {"type": "subscribe", "channel": self.channel})
+                    while True:
+                        _, payload = recv_frame(conn)
+                        yield payload.decode("utf-8")
+            except (ConnectionError, OSError):
+                self._get_logger().error("Message broker connection lost, reconnecting")
+                time.sleep(RECONNECT_DELAY)
+
+
+class InProcessManager(socketio.PubSubManager):
+    """
+    Socket.IO client manager for several servers inside one process.
+    """
+    name = "memory"
+    channels = {}
+    channels_lock = threading.Lock()
+
+    def __init__(self, url="memory://", channel="flask-socketio", write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.queue = queue.Queue()
+        if not write_only:
+            with self.channels_lock:
+                self.channels.setdefault(channel, []).append(self.queue)
+
+    def _publish(self, data):
+        with self.channels_lock:
+            queues = list(self.channels.get(self.channel, ()))
+        for q in queues:
+            q.put(data)
+
+    def _listen(self):
+        while True:
+            yield self.queue.get()
+
+
+def socketio_options(url=None) -> dict:
+    """
+    Keyword arguments of SocketIO for a message queue URL, defaults to the
+    SOCKETIO_MESSAGE_QUEUE environment variable. Empty for a single worker.
+    """
+    url = url if url is not None else os.getenv("SOCKETIO_MESSAGE_QUEUE", "")
+    if not url:
+        return {}
+    if url.startswith("broker://"):
+        return {"client_manager": BrokerManager(url)}
+    if url.startswith("memory://"):
+        return {"client_manager": InProcessManager(url)}
+    return {"message_queue": url}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Socket.IO message broker")
+    parser.add_argument("--serve", action="store_true", help="Start the message broker")
+    parser.add_argument("--address", default=DEFAULT_BROKER_ADDRESS, help=f"host:port to listen on (default {DEFAULT_BROKER_ADDRESS})")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    from .metrics import configure_logging
+    configure_logging()
+    args = parse_args()
+    if args.serve:
+        MessageBroker(args.address).serve_forever()
@@ -0,0 +1,244 @@
+import os
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+# Timing spans of the analysis stages, kept as histograms and served in the
+# Prometheus text format by /metrics. The analysis workers and the inference
+# service run in other processes, they collect the spans of a job and send
+# them back with the result, so every span ends up in the web process.
+# The decomposition engines tally the nodes they explore (table lookups and
+# records decoded for the suit table, recursion steps for the memoized
+# decomposer, memo hits explore nothing) and count_explored records them per
+# engine, a hand served entirely from the memo is recorded as "cached".
+# Every gunicorn worker keeps its own histograms, so the web app calls
+# share_metrics with a directory (METRICS_DIR), then each web worker also
+# writes them to <pid>.json there whenever they change and /metrics sums the
+# files of every worker. Files of exited workers are kept, so the totals never
+# go back, the directory is emptied when the server starts.
+# LOG_LEVEL sets the level of the loggers (default INFO, DEBUG shows the
+# details of every analysis).
+SECONDS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+NODES_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 4096)
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+_local = threading.local()
+_shared_dir = None
+
+
+def configure_logging(level=None):
+    """
+    Configure the root logger once, the level defaults to the LOG_LEVEL environment variable.
+    """
+    level = (level or os.getenv("LOG_LEVEL", "INFO")).upper()
+    logging.basicConfig(level=level, format=LOG_FORMAT)
+
+
+class Histogram():
+    """
+    Cumulative histogram with one series per label value.
+    """
+    def __init__(self, name, documentation, label, buckets):
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.series = {}
+
+    def observe(self, label_value, value, count=1):
+        with self.lock:
+            series = self.series.get(label_value)
+            if series is None:
+                series = self.series[label_value] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["buckets"][i] += count
+            series["sum"] += value * count
+            series["count"] += count
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {label_value: {"buckets": list(series["buckets"]), "sum": series["sum"], "count": series["count"]}
+                    for label_value, series in self.series.items()}
+
+    def render(self, others=()) -> list:
+        """
+        Lines of the histogram, summed with the snapshots of other processes.
+        """
+        merged = self.snapshot()
+        for other in others:
+            for label_value, series in other.items():
+                target = merged.setdefault(label_value, {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0})
+                target["buckets"] = [a + b for a, b in zip(target["buckets"], series["buckets"])]
+                target["sum"] += series["sum"]
+                target["count"] += series["count"]
+
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for label_value, series in sorted(merged.items()):
+            label = f'{self.label}="{label_value}"'
+            for bound, count in zip(self.buckets, series["buckets"]):
+                lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {series["count"]}')
+            lines.append(f"{self.name}_sum{{{label}}} {series['sum']}")
+            lines.append(f"{self.name}_count{{{label}}} {series['count']}")
+        return lines
+
+
+stage_seconds = Histogram("mahjong_analysis_stage_seconds", "Time spent in each stage of the analysis", "stage", SECONDS_BUCKETS)
+decomposition_nodes = Histogram("mahjong_decomposition_nodes", "Nodes explored per hand by each decomposition engine", "engine", NODES_BUCKETS)
+HISTOGRAMS = (stage_seconds, decomposition_nodes)
+
+
+def share_metrics(directory):
+    """
+    Share the histograms of this process with the other web workers through directory, None keeps them private.
+    """
+    global _shared_dir
+    _shared_dir = directory or None
+    if _shared_dir is not None:
+        os.makedirs(_shared_dir, exist_ok=True)
+        _dump()
+
+
+def _dump():
+    # This process's histograms for the other workers' /metrics, replaced whole
+    if _shared_dir is None or getattr(_local, "recording", False):
+        return
+    path = os.path.join(_shared_dir, f"{os.getpid()}.json")
+    try:
+        with open(f"{path}.tmp", "w") as f:
+            json.dump({histogram.name: histogram.snapshot() for histogram in HISTOGRAMS}, f)
+        os.replace(f"{path}.tmp", path)
+    except OSError as e:
+        logging.getLogger(__name__).warning("Could not write the metrics of this worker: %s", e)
+
+
+def _other_processes() -> list:
+    # The snapshots written by every other process
+    if _shared_dir is None:
+        return []
+    own = f"{os.getpid()}.json"
+    snapshots = []
+    for name in os.listdir(_shared_dir):
+        if not name.endswith(".json") or name == own:
+            continue
+        try:
+            with open(os.path.join(_shared_dir, name)) as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return snapshots
+
+
+def observe(stage, seconds):
+    # Into the spans of the current job when one is collected, else straight into the histograms
+    collected = getattr(_local, "collected", None)
+    if collected is not None:
+        collected["spans"][stage] = collected["spans"].get(stage, 0.0) + seconds
+    else:
+        stage_seconds.observe(stage, seconds)
+        _dump()
+
+
+def count_nodes(engine, nodes):
+    collected = getattr(_local, "collected", None)
+    if collected is not None:
+        collected["nodes"][engine] = collected["nodes"].get(engine, 0) + nodes
+    else:
+        decomposition_nodes.observe(engine, nodes)
+        _dump()
+
+
+def tally(engine, nodes=1):
+    # Only counted inside count_explored, the benchmarks and the table build pay nothing
+    explored = getattr(_local, "explored", None)
+    if explored is not None:
+        explored[engine] = explored.get(engine, 0) + nodes
+
+
+@contextmanager
+def count_explored():
+    """
+    Tally the nodes explored by the decomposition engines in this thread and record them per engine on exit.
+    Yields:
+        explored: dict, {engine: nodes}.
+    """
+    previous = getattr(_local, "explored", None)
+    _local.explored = explored = {}
+    try:
+        yield explored
+    finally:
+        _local.explored = previous
+        for engine, nodes in (explored or {"cached": 0}).items():
+            count_nodes(engine, nodes)
+
+
+@contextmanager
+def span(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+
+@contextmanager
+def collect():
+    """
+    Collect the spans and node counts of one job in this thread instead of recording them.
+    Yields:
+        collected: dict, {"spans": {stage: seconds}, "nodes": {engine: count}}.
+    """
+    previous = getattr(_local, "collected", None)
+    _local.collected = {"spans": {}, "nodes": {}}
+    try:
+        yield _local.collected
+    finally:
+        _local.collected = previous
+
+
+def record(collected):
+    """
+    Record the spans and node counts collected by another process.
+    """
+    # Written once for the whole job
+    _local.recording = True
+    try:
+        for stage, seconds in collected.get("spans", {}).items():
+            observe(stage, seconds)
+        for engine, nodes in collected.get("nodes", {}).items():
+            count_nodes(engine, nodes)
+    finally:
+        _local.recording = False
+    _dump()
+
+
+def metric_lines(name, documentation, values, kind="gauge", label=None, per_process=False) -> list:
+    """
+    Lines of a gauge or counter, values is a number or a dict of label value -> number.
+    per_process labels them with the pid when the web workers share their metrics.
+    """
+    lines = [f"# HELP {name} {documentation}", f"# TYPE {name} {kind}"]
+    pid = f'pid="{os.getpid()}"' if per_process and _shared_dir is not None else ""
+    if isinstance(values, dict):
+        lines.extend(f'{name}{{{pid}{"," if pid else ""}{label}="{label_value}"}} {value}'
+                     for label_value, value in sorted(values.items()))
+    else:
+        lines.append(f"{name}{{{pid}}} {values}" if pid else f"{name} {values}")
+    return lines
+
+
+def render(extra_lines=()) -> str:
+    """
+    Returns:
+        text: str, every metric in the Prometheus text format.
+    """
+    others = _other_processes()
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines += histogram.render([other.get(histogram.name, {}) for other in others])
+    lines += list(extra_lines)
+    return "\n".join(lines) + "\n"
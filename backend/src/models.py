@@ -1,5 +1,18 @@
+import os
+import threading
+from collections import OrderedDict
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, selectinload
+
 from db import db
 
+# Serialized games by id, dropped whenever a game, its players or its rounds are
+# written, and least recently used first past SNAPSHOT_CACHE_ITEMS games
+SNAPSHOT_CACHE_ITEMS = int(os.getenv('SNAPSHOT_CACHE_ITEMS', 1024))
+_snapshots = OrderedDict()
+_snapshots_lock = threading.Lock()
+
 class Game(db.Model):
     __tablename__ = 'games'
     id = db.Column(db.Integer, primary_key=True)
@@ -7,26 +20,93 @@ class Game(db.Model):
     round_wind = db.Column(db.String(20), default='East')
     dealer_id = db.Column(db.Integer, default=1) # 1-4 referring to seat position
     continues = db.Column(db.Integer, default=0)
+    seq = db.Column(db.Integer, default=0, nullable=False) # bumped on every write, orders the delta events
     
-    players = db.relationship('Player', backref='game', lazy=True, cascade="all, delete-orphan")
-    rounds = db.relationship('RoundRecord', backref='game', lazy=True, cascade="all, delete-orphan")
+    players = db.relationship('Player', backref='game', lazy=True, cascade="all, delete-orphan", order_by='Player.id')
+    rounds = db.relationship('RoundRecord', backref='game', lazy=True, cascade="all, delete-orphan", order_by='RoundRecord.id')
+
+    @classmethod
+    def _load_options(cls, full):
+        # Players and rounds come in one SELECT each instead of one per object.
+        # The winner and loser of a round are players of the same game, so they
+        # are found in the identity map without another query.
+        options = [selectinload(cls.players)]
+        if full:
+            options.append(selectinload(cls.rounds))
+        return options
+
+    @classmethod
+    def by_code(cls, game_code, full=False):
+        """
+        Load a game by its code.
+        Parameters:
+            game_code: str, the room code.
+            full: bool, also load the rounds, for to_dict.
+        Returns:
+            game: Game, or None if there is no such game.
+        """
+        return cls.query.options(*cls._load_options(full)).filter_by(game_code=game_code).first()
+
+    def snapshot(self):
+        """
+        The serialized game, cached until the game is written again.
+        """
+        # The identity does not refresh an expired instance, unlike self.id
+        game_id = inspect(self).identity[0]
+        with _snapshots_lock:
+            cached = _snapshots.get(game_id)
+            if cached is not None:
+                _snapshots.move_to_end(game_id)
+        # seq also catches writes made by other worker processes, the code
+        # a new game that got the id of a deleted one (SQLite reuses rowids)
+        if cached is not None and cached['seq'] == self.seq and cached['game_code'] == self.game_code:
+            return cached
+
+        data = Game.query.options(*Game._load_options(full=True)).filter_by(id=game_id).one().to_dict()
+        with _snapshots_lock:
+            _snapshots[game_id] = data
+            _snapshots.move_to_end(game_id)
+            while len(_snapshots) > SNAPSHOT_CACHE_ITEMS:
+                _snapshots.popitem(last=False)
+        return data
 
     def to_dict(self):
+        data = self.summary_dict()
+        data['rounds'] = [r.to_dict() for r in self.rounds]
+        return data
+
+    def summary_dict(self):
+        # The game without its round history
         return {
             'id': self.id,
             'game_code': self.game_code,
             'round_wind': self.round_wind,
             'dealer_id': self.dealer_id,
             'continues': self.continues,
+            'seq': self.seq,
             'players': [player.to_dict() for player in self.players],
-            'rounds': [r.to_dict() for r in self.rounds]
         }
 
+    def rounds_page(self, after=None, limit=50):
+        """
+        One page of the round history, oldest first.
+        Parameters:
+            after: int, the id of the last round of the previous page.
+            limit: int, the number of rounds of the page.
+        Returns:
+            rounds: list of RoundRecord.
+        """
+        # Keyset pagination on the (game_id, id) index, O(limit) however long the game is
+        query = RoundRecord.query.filter(RoundRecord.game_id == self.id)
+        if after is not None:
+            query = query.filter(RoundRecord.id > after)
+        return query.order_by(RoundRecord.id).limit(limit).all()
+
 
 class Player(db.Model):
     __tablename__ = 'players'
     id = db.Column(db.Integer, primary_key=True)
-    game_id = db.Column(db.Integer, db.ForeignKey('games.id'), nullable=False)
+    game_id = db.Column(db.Integer, db.ForeignKey('games.id'), nullable=False, index=True)
     name = db.Column(db.String(50), nullable=False)
     money = db.Column(db.Integer, default=0)
     seat_position = db.Column(db.Integer, nullable=False) # 1: East, 2: South, 3: West, 4: North
@@ -42,10 +122,14 @@ class Player(db.Model):
 
 class RoundRecord(db.Model):
     __tablename__ = 'round_records'
+    # Also serves lookups by game_id alone
+    __table_args__ = (
+        db.Index('ix_round_records_game_id_id', 'game_id', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     game_id = db.Column(db.Integer, db.ForeignKey('games.id'), nullable=False)
-    winner_id = db.Column(db.Integer, db.ForeignKey('players.id'), nullable=True) # Null if draw
-    loser_id = db.Column(db.Integer, db.ForeignKey('players.id'), nullable=True) # Null if self-draw or draw
+    winner_id = db.Column(db.Integer, db.ForeignKey('players.id'), nullable=True, index=True) # Null if draw
+    loser_id = db.Column(db.Integer, db.ForeignKey('players.id'), nullable=True, index=True) # Null if self-draw or draw
     points_exchanged = db.Column(db.Integer, default=0)
     win_type = db.Column(db.String(20), nullable=False) # 'ron', 'tsumo', 'draw'
     is_dealer_win = db.Column(db.Boolean, default=False)
@@ -65,3 +149,46 @@ class RoundRecord(db.Model):
             'win_type': self.win_type,
             'is_dealer_win': self.is_dealer_win
         }
+
+
+class RoomCodeCounter(db.Model):
+    # Single row, the next counter value of src/room_codes.py
+    __tablename__ = 'room_code_counter'
+    id = db.Column(db.Integer, primary_key=True)
+    value = db.Column(db.BigInteger, nullable=False, default=0)
+    # Random key of the room code permutation when ROOM_CODE_KEY is not set
+    secret = db.Column(db.String(64))
+
+
+class FinishedJob(db.Model):
+    # Result of an async analysis until a socket watches it, in the database so
+    # the web worker that handles watch_analysis finds it whichever worker ran it
+    __tablename__ = 'finished_jobs'
+    job_id = db.Column(db.String(36), primary_key=True)
+    payload = db.Column(db.Text, nullable=False) # JSON of the analysis_result event
+    finished_at = db.Column(db.Float, nullable=False) # Unix time, expired after FINISHED_JOBS_TTL
+
+
+def _written_game_ids(session):
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Game):
+            yield obj.id
+        elif isinstance(obj, (Player, RoundRecord)):
+            yield obj.game_id
+
+@event.listens_for(Session, "after_flush")
+def _invalidate_on_flush(session, flush_context):
+    game_ids = session.info.setdefault("written_game_ids", set())
+    game_ids.update(game_id for game_id in _written_game_ids(session) if game_id is not None)
+    with _snapshots_lock:
+        for game_id in game_ids:
+            _snapshots.pop(game_id, None)
+
+@event.listens_for(Session, "after_commit")
+@event.listens_for(Session, "after_soft_rollback")
+def _invalidate_on_commit(session, *args):
+    # Drop snapshots built from the uncommitted state between the flush and the commit
+    game_ids = session.info.pop("written_game_ids", set())
+    with _snapshots_lock:
+        for game_id in game_ids:
+            _snapshots.pop(game_id, None)
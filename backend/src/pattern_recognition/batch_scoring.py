@@ -0,0 +1,238 @@
+import time
+import random
+import argparse
+from typing import NamedTuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from .hand_decomposition import NUM_TILES
+from .suit_table import SUIT_STARTS, SUIT_SIZE, FLAG_SETS, FLAG_DUI, FLAG_ALL_KE, FLAG_ALL_KE_DUI, suit_flags
+from .tai_rules import BING, BAMBOO, WAN, BONUS_START, HandMasks, setting_masks, score_masks_batch
+
+# Score many hands at once from a 2-D array of tile counts, one row per hand
+# and one column per tile of `index` in tile_generation/main.py. Gives the same
+# result as evaluate_hand without building a breakdown for every hand.
+SEATS = ["east", "south", "west", "north"]
+WORDS_START = 28
+
+# Rows per worker task when a process pool is used
+CHUNK_SIZE = 50000
+
+
+class BatchResult(NamedTuple):
+    """
+    Result of scoring a batch of hands.
+    Attributes:
+        win: 1-D array of bool, whether each hand is a winning hand.
+        tai: 1-D array of int, the tai count of each winning hand, 0 otherwise.
+        money: 2-D array of int, the money of east, south, west and north for each hand.
+    """
+    win: np.ndarray
+    tai: np.ndarray
+    money: np.ndarray
+
+
+def score_hands(batch, settings, workers=1, chunk_size=CHUNK_SIZE) -> BatchResult:
+    """
+    Score a batch of hands.
+    Parameters:
+        batch: 2-D array of int, shape (hands, 43), the count of each tile.
+        settings: dict, the same conditions as `others` of check_win_condition.
+        workers: int, the number of worker processes for large batches.
+        chunk_size: int, the number of rows per worker task.
+    Returns:
+        result: BatchResult, the win mask, tai counts and money of each hand.
+    """
+    batch = np.asarray(batch)
+    if batch.ndim != 2 or batch.shape[1] != NUM_TILES:
+        raise ValueError(f"Expected a batch of shape (hands, {NUM_TILES}), got {batch.shape}")
+
+    if workers <= 1 or len(batch) <= chunk_size:
+        return _score_chunk(batch, settings)
+
+    chunks = [batch[i:i + chunk_size] for i in range(0, len(batch), chunk_size)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(_score_chunk, chunks, [settings] * len(chunks)))
+
+    return BatchResult(
+        np.concatenate([result.win for result in results]),
+        np.concatenate([result.tai for result in results]),
+        np.concatenate([result.money for result in results]),
+    )
+
+
+def _score_chunk(batch, settings) -> BatchResult:
+    batch = batch.astype(np.int16, copy=False)
+    hands = len(batch)
+
+    # Words form ke with three or more copies and dui with exactly two
+    words = batch[:, WORDS_START:WORDS_START + 7]
+    words_ke = words >= 3
+    words_dui = words == 2
+    ke_count = words_ke.sum(axis=1)
+    need_dui = ~words_dui.any(axis=1)
+
+    suits = [batch[:, start:start + SUIT_SIZE] for start in SUIT_STARTS]
+    flags = np.stack([suit_flags(suit) for suit in suits], axis=1)
+    tiles = np.stack([suit.sum(axis=1) for suit in suits], axis=1)
+
+    has_sets = (flags & FLAG_SETS) != 0
+    has_dui = (flags & FLAG_DUI) != 0
+    all_ke = (flags & FLAG_ALL_KE) != 0
+    all_ke_dui = (flags & FLAG_ALL_KE_DUI) != 0
+
+    # The dui can only be in the suit with two tiles over a multiple of three
+    dui_in_suit = np.zeros((hands, 3), dtype=bool)
+    suit_all_ke = np.zeros(hands, dtype=bool)
+    for suit in range(3):
+        others = [i for i in range(3) if i != suit]
+        fits = has_dui[:, suit] & has_sets[:, others].all(axis=1)
+        dui_in_suit[:, suit] = need_dui & fits
+        suit_all_ke |= need_dui & fits & all_ke_dui[:, suit] & all_ke[:, others].all(axis=1)
+
+    no_dui_fits = ~need_dui & has_sets.all(axis=1)
+    suit_all_ke |= no_dui_fits & all_ke.all(axis=1)
+
+    set_tiles = tiles - 2 * dui_in_suit
+    set_count = ke_count + set_tiles.sum(axis=1) // 3
+    win = (dui_in_suit.any(axis=1) | no_dui_fits) & (set_count == 5)
+
+    tai = _tai_counts(batch, settings, words_ke, words_dui, ke_count, set_tiles, dui_in_suit, suit_all_ke & win)
+    money = _money(tai, settings)
+
+    # Only keep hands where the winner gets paid, like evaluate_hand
+    seat = SEATS.index(settings["seat"])
+    win &= money[:, seat] > 0
+    tai = np.where(win, tai, 0)
+    money[~win] = 0
+    return BatchResult(win, tai, money)
+
+
+def _tai_counts(batch, settings, words_ke, words_dui, ke_count, set_tiles, dui_in_suit, all_ke):
+    suit_bits = np.array([BING, BAMBOO, WAN])
+    word_bits = 1 << np.arange(7)
+
+    # Only the last words dui counts, like hand_masks
+    last_word_dui = 6 - np.argmax(words_dui[:, ::-1], axis=1)
+    dui_word = np.where(words_dui.any(axis=1), word_bits[last_word_dui], 0)
+
+    hand = HandMasks(
+        set_suits=((set_tiles >= 3) * suit_bits).sum(axis=1),
+        set_words=(words_ke * word_bits).sum(axis=1),
+        word_sets=ke_count,
+        # The all ke breakdown is the best one whenever it exists
+        ke_count=np.where(all_ke, 5, 0),
+        dui_suit=(dui_in_suit * suit_bits).sum(axis=1),
+        dui_word=dui_word,
+        bonus=((batch[:, BONUS_START:BONUS_START + 8] > 0) * (1 << np.arange(8))).sum(axis=1),
+    )
+    return score_masks_batch(hand, setting_masks(settings)).astype(np.int32)
+
+
+def _money(tai, settings):
+    money = np.zeros((len(tai), 4), dtype=np.int64)
+    seat = SEATS.index(settings["seat"])
+    wins = SEATS.index(settings["wins"])
+    dealer = SEATS.index(settings["dealer"])
+    base = settings["base"]
+    bonus = settings["bonus"]
+    dealer_money = 2 * settings["continues"] - 1
+
+    if seat == wins and seat != dealer:
+        pay = base + bonus * tai
+        money[:, seat] += pay * 3 + bonus * dealer_money
+        for other in range(4):
+            if other != seat:
+                money[:, other] -= pay
+        money[:, dealer] -= bonus * dealer_money
+    elif seat == wins:
+        pay = base + bonus * (tai + dealer_money)
+        money[:, seat] += pay * 3
+        for other in range(4):
+            if other != seat:
+                money[:, other] -= pay
+    elif wins == dealer or seat == dealer:
+        pay = base + bonus * (tai + dealer_money)
+        money[:, seat] += pay
+        money[:, wins] -= pay
+    else:
+        pay = base + bonus * tai
+        money[:, seat] += pay
+        money[:, wins] -= pay
+    return money
+
+
+# Throughput benchmark
+# python -m src.pattern_recognition.batch_scoring --benchmark --workers 4
+def _random_batch(hands, seed=0, pool_size=10000):
+    from .hand_decomposition import random_winning_hand
+
+    rng = random.Random(seed)
+    pool = np.zeros((min(hands, pool_size), NUM_TILES), dtype=np.int16)
+    for row in pool:
+        for tile in random_winning_hand(rng):
+            row[tile] += 1
+        if rng.random() < 0.3:
+            # Swap one tile so some hands cannot win
+            row[rng.randint(1, 27)] += 1
+            row[rng.choice(np.flatnonzero(row[1:35]) + 1)] -= 1
+    return np.resize(pool, (hands, NUM_TILES))
+
+
+def _evaluate_rows(batch, settings):
+    from .main import evaluate_hand
+    from .hand_decomposition import split_tiles
+
+    money, tai = [], []
+    for row in batch:
+        tiles = [tile for tile, cnt in enumerate(row) for _ in range(cnt)]
+        result = evaluate_hand(*split_tiles(tiles), settings)
+        money.append([result.money[seat] for seat in SEATS])
+        tai.append(result.tai)
+    return np.array(money, dtype=np.int64).reshape(-1, 4), np.array(tai)
+
+
+def benchmark_scoring(max_hands=1000000, workers=1, compare_hands=2000):
+    import contextlib
+    import io
+
+    settings = {
+        "round": "east", "dealer": "south", "continues": 2, "dice": 18,
+        "seat": "east", "wins": "west", "base": 100, "bonus": 30,
+    }
+
+    # Same answer as evaluate_hand
+    sample = _random_batch(compare_hands, seed=1)
+    with contextlib.redirect_stdout(io.StringIO()):
+        start_single = time.perf_counter()
+        expected_money, expected_tai = _evaluate_rows(sample, settings)
+        single_duration = time.perf_counter() - start_single
+    result = score_hands(sample, settings)
+    mismatches = int(((expected_money != result.money).any(axis=1) | (expected_tai != result.tai)).sum())
+    print(f"evaluate_hand: {compare_hands / single_duration:,.0f} hands/s, mismatches with score_hands: {mismatches}")
+
+    batch = _random_batch(max_hands)
+    score_hands(batch[:10], settings)  # load the suit table
+    size = 1
+    while size <= max_hands:
+        start = time.perf_counter()
+        result = score_hands(batch[:size], settings, workers=workers)
+        duration = time.perf_counter() - start
+        print(f"Batch {size:>9,}: {size / duration:>12,.0f} hands/s ({int(result.win.sum())} winning)")
+        size *= 10
+    return mismatches == 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Mahjong batch scoring")
+    parser.add_argument("--benchmark", action="store_true", help="Measure hands/second from 1 to --max-hands")
+    parser.add_argument("--max-hands", type=int, default=1000000, help="Largest batch size")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.benchmark and not benchmark_scoring(args.max_hands, max(1, args.workers)):
+        raise SystemExit(1)
@@ -0,0 +1,275 @@
+import time
+import random
+import argparse
+from functools import lru_cache
+
+from ..metrics import tally
+
+# Hands are decomposed on a fixed 43-slot count vector, slot i holds the number
+# of copies of tile i using the numbering of `index` in tile_generation/main.py
+# (1-9 bing, 10-18 bamboo, 19-27 wan, 28-34 words, 35-42 bonus, 0 unused)
+
+NUM_TILES = 43
+SUIT_TILES = range(1, 28)
+WORD_TILES = range(28, 35)
+BONUS_TILES = range(35, 43)
+
+# Size of the memo tables, large enough for a busy server but still bounded
+CACHE_SIZE = 1 << 16
+
+
+def to_count_vector(tiles) -> tuple:
+    """
+    Convert a list of tile numbers to a 43-slot count vector.
+    Parameters:
+        tiles: iterable of int, the tile numbers.
+    Returns:
+        counts: tuple of int, the number of copies of each tile.
+    """
+    counts = [0] * NUM_TILES
+    for tile in tiles:
+        if 0 < tile < NUM_TILES:
+            counts[tile] += 1
+    return tuple(counts)
+
+
+def can_start_shun(tile: int) -> bool:
+    """
+    Check if a shun (tile, tile+1, tile+2) can start from the tile.
+    Only bing, bamboo and wan from one to seven can start a shun.
+    """
+    return tile in SUIT_TILES and (tile - 1) % 9 < 7
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def decompose_sets(counts: tuple) -> tuple:
+    """
+    Find every distinct way to split the tiles into ke and shun.
+    Always branches on the lowest remaining tile: it can only be used by a ke
+    of itself or by shun starting from itself, so each decomposition is found
+    exactly once. Sub results are memoized by the remaining count vector.
+    Parameters:
+        counts: tuple of int, the 43-slot count vector.
+    Returns:
+        decompositions: tuple of tuple, each one is a tuple of sets like
+            ("ke", x, x, x) or ("shun", x, x+1, x+2) in ascending order.
+            Empty if the tiles cannot be fully split.
+    """
+    tally("memoized")
+
+    # Find the lowest remaining tile
+    tile = next((i for i, cnt in enumerate(counts) if cnt > 0), None)
+    if tile is None:
+        return ((),)
+
+    cnt = counts[tile]
+    decompositions = []
+
+    # Use the tile in zero or one ke, every remaining copy must start a shun
+    for ke in ((1, 0) if cnt >= 3 else (0,)):
+        shun = cnt - 3 * ke
+        if shun > 0 and not (can_start_shun(tile) and counts[tile + 1] >= shun and counts[tile + 2] >= shun):
+            continue
+
+        rest = list(counts)
+        rest[tile] = 0
+        if shun > 0:
+            rest[tile + 1] -= shun
+            rest[tile + 2] -= shun
+
+        sets = (("ke", tile, tile, tile),) * ke + (("shun", tile, tile + 1, tile + 2),) * shun
+        for sub in decompose_sets(tuple(rest)):
+            decompositions.append(sets + sub)
+
+    return tuple(decompositions)
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def decompose_hand(counts: tuple, need_dui=True) -> tuple:
+    """
+    Find every distinct decomposition of the tiles into sets and one dui.
+    Parameters:
+        counts: tuple of int, the 43-slot count vector.
+        need_dui: bool, whether a dui still has to be taken from these tiles.
+    Returns:
+        decompositions: tuple of tuple, each one starts with the dui (if any)
+            followed by the sets of decompose_sets.
+    """
+    if not need_dui:
+        return decompose_sets(counts)
+
+    tally("memoized")
+    decompositions = []
+    for tile, cnt in enumerate(counts):
+        if cnt < 2:
+            continue
+
+        rest = list(counts)
+        rest[tile] -= 2
+        for sub in decompose_sets(tuple(rest)):
+            decompositions.append((("dui", tile, tile),) + sub)
+
+    return tuple(decompositions)
+
+
+def clear_cache():
+    """
+    Drop the memoized sub results.
+    """
+    decompose_sets.cache_clear()
+    decompose_hand.cache_clear()
+
+
+def split_tiles(tiles) -> tuple:
+    """
+    Split tile numbers into the lists used by check_win_condition.
+    Returns:
+        bing, bamboo, wan, words, bonus: list of int.
+    """
+    bing, bamboo, wan, words, bonus = [], [], [], [], []
+    for tile in tiles:
+        if 1 <= tile <= 9:
+            bing.append(tile)
+        elif 10 <= tile <= 18:
+            bamboo.append(tile)
+        elif 19 <= tile <= 27:
+            wan.append(tile)
+        elif 28 <= tile <= 34:
+            words.append(tile)
+        elif 35 <= tile <= 42:
+            bonus.append(tile)
+    return bing, bamboo, wan, words, bonus
+
+
+def random_winning_hand(rng=random, words=True, max_bonus=2) -> list:
+    """
+    Build a random 17-tile winning hand (one dui and five sets) plus some bonus tiles.
+    Parameters:
+        rng: random.Random, the random generator.
+        words: bool, whether words tiles can be used.
+        max_bonus: int, the maximum number of bonus tiles.
+    Returns:
+        tiles: list of int, the tile numbers in random order.
+    """
+    last_tile = 34 if words else 27
+    while True:
+        counts = [0] * NUM_TILES
+        dui = rng.randint(1, last_tile)
+        counts[dui] += 2
+        for _ in range(5):
+            tile = rng.randint(1, last_tile)
+            if can_start_shun(tile) and rng.random() < 0.5:
+                for i in range(3):
+                    counts[tile + i] += 1
+            else:
+                counts[tile] += 3
+        if max(counts) <= 4:
+            break
+
+    tiles = [tile for tile, cnt in enumerate(counts) for _ in range(cnt)]
+    tiles += rng.sample(list(BONUS_TILES), rng.randint(0, max_bonus))
+    rng.shuffle(tiles)
+    return tiles
+
+
+# Benchmark against the recursion of check_sets
+# python -m src.pattern_recognition.hand_decomposition --benchmark
+def _benchmark_hands():
+    """
+    17-tile hands with many dui and multiple ke, the worst case of check_sets.
+    """
+    return [
+        # bing 1-4 three times each and a dui of five
+        [1, 1, 1, 2, 2, 2, 3, 3, 3, 4, 4, 4, 5, 5, 6, 7, 8],
+        # two suits with overlapping ke and shun
+        [1, 1, 1, 2, 2, 2, 3, 3, 3, 10, 10, 10, 11, 11, 11, 12, 12],
+        # four copies of several tiles
+        [1, 1, 1, 1, 2, 2, 2, 2, 3, 3, 3, 3, 4, 4, 5, 5, 6],
+        # many dui across all suits
+        [1, 1, 2, 2, 3, 3, 10, 10, 11, 11, 12, 12, 19, 19, 19, 20, 20],
+        # pure wan with ke
+        [19, 19, 19, 20, 20, 20, 21, 21, 21, 22, 22, 22, 23, 23, 24, 25, 26],
+    ]
+
+
+def _legacy_decompositions(tiles, others):
+    from collections import Counter
+    from copy import deepcopy
+    from .main import check_sets, empty_money
+
+    best = {"money": empty_money(), "breakdown": []}
+    tile_count = Counter(tiles)
+    for tile in tile_count:
+        if tile_count[tile] >= 2:
+            temp_count = deepcopy(tile_count)
+            temp_count[tile] -= 2
+            check_sets(temp_count, [("dui", tile, tile)], [], others, best=best)
+    return best["money"]
+
+
+def _memoized_decompositions(tiles, others):
+    from .main import check_winning_money
+
+    best = {"east": 0, "south": 0, "west": 0, "north": 0}
+    for sets in decompose_hand(to_count_vector(tiles)):
+        if len(sets) != 6:
+            continue
+        money = check_winning_money(list(sets), [], others)
+        if money[others["seat"]] > best[others["seat"]]:
+            best = money
+    return best
+
+
+def benchmark_decomposition(rounds=20, seed=0):
+    import contextlib
+    import io
+
+    others = {
+        "round": "east", "dealer": "east", "continues": 1, "dice": 18,
+        "seat": "east", "wins": "south", "base": 100, "bonus": 30,
+    }
+    rng = random.Random(seed)
+    hands = _benchmark_hands()
+    for hand in hands:
+        rng.shuffle(hand)
+
+    # check_sets prints on every leaf, keep the output out of the timing
+    with contextlib.redirect_stdout(io.StringIO()):
+        start_legacy = time.perf_counter()
+        for _ in range(rounds):
+            legacy = [_legacy_decompositions(hand, others) for hand in hands]
+        legacy_duration = time.perf_counter() - start_legacy
+
+    start_cold = time.perf_counter()
+    for _ in range(rounds):
+        clear_cache()
+        memoized = [_memoized_decompositions(hand, others) for hand in hands]
+    cold_duration = time.perf_counter() - start_cold
+
+    start_warm = time.perf_counter()
+    for _ in range(rounds):
+        memoized = [_memoized_decompositions(hand, others) for hand in hands]
+    warm_duration = time.perf_counter() - start_warm
+
+    if legacy != memoized:
+        raise RuntimeError(f"Decomposition mismatch: {legacy} != {memoized}")
+
+    total = rounds * len(hands)
+    print(f"Hands: {len(hands)} x {rounds} rounds")
+    print(f"check_sets recursion: {legacy_duration:.3f}s ({legacy_duration / total * 1e3:.3f} ms/hand)")
+    print(f"Memoized decomposer (cold cache): {cold_duration:.3f}s ({cold_duration / total * 1e3:.3f} ms/hand)")
+    print(f"Memoized decomposer (warm cache): {warm_duration:.3f}s ({warm_duration / total * 1e3:.3f} ms/hand)")
+    print(f"Speedup (cold): {legacy_duration / cold_duration:.1f}x")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Mahjong hand decomposition")
+    parser.add_argument("--benchmark", action="store_true", help="Compare with the check_sets recursion")
+    parser.add_argument("--rounds", type=int, default=20, help="Number of rounds over the benchmark hands")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.benchmark:
+        benchmark_decomposition(rounds=args.rounds)
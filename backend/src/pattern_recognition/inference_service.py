@@ -0,0 +1,321 @@
+import os
+import json
+import time
+import queue
+import socket
+import struct
+import logging
+import argparse
+import threading
+from collections import deque
+
+# Local inference worker that keeps the YOLO model warm in its own process.
+# The web workers send the uploaded image bytes over a local TCP socket, so
+# under eventlet the request greenlet yields while the detection runs, and
+# concurrent uploads are coalesced into micro-batches.
+# python -m src.pattern_recognition.inference_service --serve
+DEFAULT_ADDRESS = "127.0.0.1:5055"
+DEFAULT_MAX_BATCH = 8
+DEFAULT_MAX_WAIT_MS = 10
+CONNECT_RETRIES = 5
+CONNECT_RETRY_DELAY = 1.0
+
+# Frame: header length, payload length, JSON header, raw payload
+FRAME = struct.Struct("<II")
+STAGES = ["queue_wait", "decode", "inference", "total"]
+
+logger = logging.getLogger(__name__)
+
+
+class UndecodableImage(ValueError):
+    """
+    Raised when the uploaded bytes are not an image, the client's fault unlike other analysis errors.
+    """
+
+
+def parse_address(address=None) -> tuple:
+    """
+    Parse "host:port", defaulting to the INFERENCE_ADDRESS environment variable.
+    """
+    address = address or os.getenv("INFERENCE_ADDRESS", DEFAULT_ADDRESS)
+    host, port = address.rsplit(":", 1)
+    return host, int(port)
+
+
+def _recv_exact(conn, size) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed by peer")
+        data.extend(chunk)
+    return bytes(data)
+
+
+def send_frame(conn, header: dict, payload=b""):
+    header_bytes = json.dumps(header).encode("utf-8")
+    conn.sendall(FRAME.pack(len(header_bytes), len(payload)) + header_bytes + payload)
+
+
+def recv_frame(conn) -> tuple:
+    header_size, payload_size = FRAME.unpack(_recv_exact(conn, FRAME.size))
+    header = json.loads(_recv_exact(conn, header_size))
+    payload = _recv_exact(conn, payload_size) if payload_size else b""
+    return header, payload
+
+
+class _Metrics():
+    def __init__(self, window=1000):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.batches = 0
+        self.batch_sizes = {}
+        self.latencies = {stage: deque(maxlen=window) for stage in STAGES}
+
+    def record_batch(self, size):
+        with self.lock:
+            self.batches += 1
+            self.batch_sizes[size] = self.batch_sizes.get(size, 0) + 1
+
+    def record_request(self, timings, error=False):
+        with self.lock:
+            self.requests += 1
+            self.errors += int(error)
+            for stage, seconds in timings.items():
+                self.latencies[stage].append(seconds)
+
+    def snapshot(self, queue_depth) -> dict:
+        with self.lock:
+            stages = {}
+            for stage, samples in self.latencies.items():
+                ordered = sorted(samples)
+                stages[stage] = {
+                    "count": len(ordered),
+                    "mean_ms": 1e3 * sum(ordered) / len(ordered) if ordered else 0.0,
+                    "p50_ms": 1e3 * ordered[len(ordered) // 2] if ordered else 0.0,
+                    "p99_ms": 1e3 * ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] if ordered else 0.0,
+                }
+            return {
+                "queue_depth": queue_depth,
+                "requests": self.requests,
+                "errors": self.errors,
+                "batches": self.batches,
+                "mean_batch_size": self.requests / self.batches if self.batches else 0.0,
+                "batch_sizes": {str(size): count for size, count in sorted(self.batch_sizes.items())},
+                "latency": stages,
+            }
+
+
+class _Pending():
+    def __init__(self, payload, conf):
+        self.payload = payload
+        self.conf = conf
+        self.enqueued = time.perf_counter()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.undecodable = False
+        self.timings = {}
+
+
+class InferenceServer():
+    """
+    Serve tile detection over a local socket, batching concurrent requests.
+    Parameters:
+        address: str, "host:port" to listen on.
+        max_batch: int, the maximum number of images per model call.
+        max_wait: float, seconds to wait for more images after the first one.
+        detector: callable(images, conf) -> list of tile tuples, defaults to
+            tile_recognition.detect_tiles (loads the model in this process).
+    """
+    def __init__(self, address=None, max_batch=DEFAULT_MAX_BATCH, max_wait=DEFAULT_MAX_WAIT_MS / 1e3, detector=None):
+        self.address = parse_address(address)
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max(0.0, max_wait)
+        self.detector = detector
+        self.queue = queue.Queue()
+        self.metrics = _Metrics()
+        self.running = threading.Event()
+        self.sock = None
+
+    def _load_detector(self):
+        if self.detector is None:
+            from .tile_recognition import detect_tiles, get_model
+            get_model()  # load before listening so the first request is not slow
+            self.detector = detect_tiles
+
+    def serve_forever(self):
+        self._load_detector()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(self.address)
+        self.sock.listen(128)
+        self.running.set()
+        threading.Thread(target=self._batch_loop, daemon=True).start()
+        logger.info("Listening on %s:%s (max batch %s, max wait %.0f ms)",
+                    self.address[0], self.address[1], self.max_batch, self.max_wait * 1e3)
+
+        while self.running.is_set():
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                break
+            threading.Thread(target=self._handle_connection, args=(conn,), daemon=True).start()
+
+    def shutdown(self):
+        self.running.clear()
+        if self.sock is not None:
+            self.sock.close()
+
+    def _handle_connection(self, conn):
+        with conn:
+            try:
+                header, payload = recv_frame(conn)
+                if header.get("type") == "metrics":
+                    send_frame(conn, self.metrics.snapshot(self.queue.qsize()))
+                    return
+
+                pending = _Pending(payload, header.get("conf", 0.5))
+                self.queue.put(pending)
+                pending.done.wait()
+                if pending.error is not None:
+                    send_frame(conn, {"error": pending.error, "undecodable": pending.undecodable, "timings": pending.timings})
+                else:
+                    send_frame(conn, {"tiles": pending.result, "timings": pending.timings})
+            except (ConnectionError, OSError, ValueError) as e:
+                logger.warning("Dropped connection: %s", e)
+
+    def _next_batch(self) -> list:
+        batch = [self.queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _batch_loop(self):
+        while self.running.is_set():
+            batch = self._next_batch()
+            try:
+                self._run_batch(batch)
+            except Exception as e:
+                # The loop outlives a failed batch, its callers get the error
+                logger.exception("Inference batch failed")
+                for pending in batch:
+                    if pending.result is None and pending.error is None:
+                        pending.error = str(e)
+            finally:
+                self.metrics.record_batch(len(batch))
+                for pending in batch:
+                    pending.timings["total"] = time.perf_counter() - pending.enqueued
+                    self.metrics.record_request(pending.timings, error=pending.error is not None)
+                    pending.done.set()
+
+    def _run_batch(self, batch):
+        import cv2
+        import numpy as np
+
+        started = time.perf_counter()
+        images, ready = [], []
+        for pending in batch:
+            pending.timings["queue_wait"] = started - pending.enqueued
+            decode_start = time.perf_counter()
+            try:
+                image = cv2.imdecode(np.frombuffer(pending.payload, dtype=np.uint8), cv2.IMREAD_COLOR)
+            except cv2.error:
+                # An empty payload raises instead of returning None
+                image = None
+            pending.timings["decode"] = time.perf_counter() - decode_start
+            if image is None:
+                pending.error = "Unable to decode image"
+                pending.undecodable = True
+                continue
+            images.append(image)
+            ready.append(pending)
+
+        # One model call per confidence threshold, normally just one
+        for conf in sorted({pending.conf for pending in ready}):
+            group = [i for i, pending in enumerate(ready) if pending.conf == conf]
+            inference_start = time.perf_counter()
+            try:
+                results = self.detector([images[i] for i in group], conf=conf)
+                for i, tiles in zip(group, results):
+                    ready[i].result = [list(tile_list) for tile_list in tiles]
+            except Exception as e:
+                for i in group:
+                    ready[i].error = str(e)
+            inference_time = time.perf_counter() - inference_start
+            for i in group:
+                ready[i].timings["inference"] = inference_time
+
+
+def detect_remote(image_bytes: bytes, conf=0.5, address=None, timeout=60.0) -> tuple:
+    """
+    Detect the tiles of an encoded image with the inference service.
+    Parameters:
+        image_bytes: bytes, the encoded image (jpg or png).
+        conf: float, the confidence threshold.
+        address: str, "host:port" of the service.
+        timeout: float, seconds to wait for the answer.
+    Returns:
+        tiles: tuple of list, (bing, bamboo, wan, words, bonus).
+        timings: dict of float, seconds spent in each stage of the service.
+    """
+    # The service may still be loading the model right after start up
+    for attempt in range(CONNECT_RETRIES + 1):
+        try:
+            conn = socket.create_connection(parse_address(address), timeout=timeout)
+            break
+        except ConnectionRefusedError:
+            if attempt == CONNECT_RETRIES:
+                raise
+            time.sleep(CONNECT_RETRY_DELAY)
+
+    with conn:
+        send_frame(conn, {"type": "detect", "conf": conf}, image_bytes)
+        header, _ = recv_frame(conn)
+    if header.get("undecodable"):
+        raise UndecodableImage(header["error"])
+    if "error" in header:
+        raise RuntimeError(f"Inference service error: {header['error']}")
+    return tuple(header["tiles"]), header["timings"]
+
+
+def service_metrics(address=None, timeout=5.0) -> dict:
+    """
+    Read the queue depth, batch sizes and stage latencies of the service.
+    """
+    with socket.create_connection(parse_address(address), timeout=timeout) as conn:
+        send_frame(conn, {"type": "metrics"})
+        header, _ = recv_frame(conn)
+    return header
+
+
+def service_enabled() -> bool:
+    return bool(os.getenv("INFERENCE_ADDRESS"))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Mahjong tile inference service")
+    parser.add_argument("--serve", action="store_true", help="Start the inference service")
+    parser.add_argument("--address", default=None, help=f"host:port to listen on (default {DEFAULT_ADDRESS})")
+    parser.add_argument("--max-batch", type=int, default=int(os.getenv("INFERENCE_MAX_BATCH", DEFAULT_MAX_BATCH)), help="Maximum images per model call")
+    parser.add_argument("--max-wait-ms", type=float, default=float(os.getenv("INFERENCE_MAX_WAIT_MS", DEFAULT_MAX_WAIT_MS)), help="Milliseconds to wait to fill a batch")
+    parser.add_argument("--metrics", action="store_true", help="Print the metrics of a running service")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    from ..metrics import configure_logging
+    configure_logging()
+    args = parse_args()
+    if args.metrics:
+        print(json.dumps(service_metrics(args.address), indent=2))
+    elif args.serve:
+        InferenceServer(args.address, args.max_batch, args.max_wait_ms / 1e3).serve_forever()
@@ -1,20 +1,55 @@
+import logging
 from copy import deepcopy
+from typing import NamedTuple
+from ..metrics import span, count_explored
 from ..tile_generation.main import tile_translation, tile_number
-from .tile_recognition import tile_recognition
-
-from collections import Counter
+from .hand_decomposition import to_count_vector
+from .suit_table import decompose_by_suit
+from .tai_rules import hand_masks, setting_masks, score_masks
 
 # Extract tile numbers and index
 tile_numbers = ["one", "two", "three", "four", "five", "six", "seven", "eight", "nine"]
 words_index = ['east', 'south', 'west', 'north']
 
-# Final result of the game
-final_money = {"east": 0, "south": 0, "west": 0, "north": 0}
-final_breakdown = []
+logger = logging.getLogger(__name__)
+
+
+class HandResult(NamedTuple):
+    """
+    Result of evaluating one hand, every call gets its own copy.
+    Attributes:
+        money: dict of int, the maximum money that can be won.
+        breakdown: list of tuple, the breakdown of the winning hand, empty if there is none.
+        tai: int, the tai count of the winning hand.
+        tai_items: list of tuple, (name, tai) of every tai rule of the winning hand.
+    """
+    money: dict
+    breakdown: list
+    tai: int
+    tai_items: list
+
+
+def empty_money() -> dict:
+    return {"east": 0, "south": 0, "west": 0, "north": 0}
+
 
 def check_win_condition(bing, bamboo, wan, words, bonus, others=None) -> tuple[dict, list]:
     """
     Check if the tiles can form a winning hand and the maximum money that can be won.
+    Safe to call concurrently, see evaluate_hand.
+    Returns:
+        final_money: dict of int, the maximum money that can be won.
+        final_breakdown: list of tuple, the breakdown of the winning hand.
+    """
+    result = evaluate_hand(bing, bamboo, wan, words, bonus, others)
+    return result.money, result.breakdown
+
+
+def evaluate_hand(bing, bamboo, wan, words, bonus, others=None) -> HandResult:
+    """
+    Find the winning hand with the maximum money.
+    Keeps the best result found so far in local state only, so hands can be
+    evaluated concurrently from threads, greenlets or worker processes.
     Parameters:
         bing: list of int, the tiles of bing.
         bamboo: list of int, the tiles of bamboo.
@@ -24,11 +59,12 @@ def check_win_condition(bing, bamboo, wan, words, bonus, others=None) -> tuple[d
         others: list of conditions, including the current round, seats, etc.
 
     Returns:
-        final_money: dict of int, the maximum money that can be won.
-        final_breakdown: list of tuple, the breakdown of the winning hand.
+        result: HandResult, the maximum money and the breakdown of the winning hand.
     """
 
-    global final_breakdown, final_money
+    final_money = empty_money()
+    final_breakdown = []
+    final_tai, final_tai_items = 0, []
     shun = dui = ke = 0
 
     breakdown = []
@@ -43,31 +79,80 @@ def check_win_condition(bing, bamboo, wan, words, bonus, others=None) -> tuple[d
             dui += 1
             breakdown.append(("dui", x, x))
     
-    # Check shun and ke and eliminate dui first
+    # Check shun and ke, try every possible dui if the words have none
+    if dui == 0:
+        logger.debug("Try to form a dui first")
+    else:
+        logger.debug("Already has a dui and form ke and shun instead")
+
+    with span("decomposition"), count_explored():
+        tile_count = to_count_vector(bing + bamboo + wan)
+        decompositions = decompose_by_suit(tile_count, need_dui=(dui == 0))
+
+    with span("scoring"):
+        game_masks = setting_masks(others)
+        for sets in decompositions:
+            set_count = sum(1 for item in sets if item[0] != "dui")
+            if shun + ke + set_count != 5:
+                continue
+
+            tmp_breakdown = breakdown + list(sets)
+            tmp_tai, tmp_tai_items = score_masks(hand_masks(tmp_breakdown, bonus), game_masks)
+            tmp_money = winning_money(tmp_tai, others)
+            if tmp_money[others["seat"]] > final_money[others["seat"]]:
+                final_money = tmp_money
+                final_breakdown = tmp_breakdown
+                final_tai, final_tai_items = tmp_tai, tmp_tai_items
+
+    return HandResult(final_money, final_breakdown, final_tai, final_tai_items)
+
+
+def brute_force_evaluate(bing, bamboo, wan, words, bonus, others=None) -> HandResult:
+    """
+    Same as evaluate_hand but built on the check_sets recursion.
+    Slow, only used to verify the decomposition engines.
+    """
+    from collections import Counter
+
+    shun = dui = ke = 0
+    breakdown = []
+    for x in range(28, 35):
+        cnt = words.count(x)
+        if cnt >= 3:
+            ke += 1
+            breakdown.append(("ke", x, x, x))
+        elif cnt == 2:
+            dui += 1
+            breakdown.append(("dui", x, x))
+
+    best = {"money": empty_money(), "breakdown": []}
     tile_count = Counter(bing + bamboo + wan)
     if dui == 0:
-        # Try every possible dui
-        print("PATTERN RECOGNITION: Try to form a dui first")
-        for tile in tile_count:
+        for tile in list(tile_count):
             if tile_count[tile] >= 2:
                 temp_count = deepcopy(tile_count)
                 temp_count[tile] -= 2
+                if temp_count[tile] == 0:
+                    del temp_count[tile]
 
                 breakdown.append(("dui", tile, tile))
-                check_sets(temp_count, breakdown, bonus, others, shun, ke)
+                check_sets(temp_count, breakdown, bonus, others, shun, ke, best)
                 breakdown.pop()
     else:
-        print("PATTERN RECOGNITION: Already has a dui and form ke and shun instead")
-        for tile in tile_count:
-            check_sets(tile_count, breakdown, bonus, others, shun, ke)
+        check_sets(tile_count, breakdown, bonus, others, shun, ke, best)
 
-    return final_money, final_breakdown
+    tai_count, tai_items = 0, []
+    if best["breakdown"]:
+        tai_count, tai_items = score_masks(hand_masks(best["breakdown"], bonus), setting_masks(others))
+    return HandResult(best["money"], best["breakdown"], tai_count, tai_items)
 
 
 # Check if the tiles can form sets using recursion
-def check_sets(tile_count, breakdown, bonus, others=None, shun=0, ke=0) -> None:
+def check_sets(tile_count, breakdown, bonus, others=None, shun=0, ke=0, best=None) -> dict:
     """
     Try to form every possible winning hand using recursion.
+    Replaced by hand_decomposition in check_win_condition, kept as the brute
+    force reference for benchmarks and verification.
     Parameters:
         tile_count: Counter, the count of each tile.
         breakdown: list of tuple, the breakdown of the current winning hand.
@@ -75,26 +160,28 @@ def check_sets(tile_count, breakdown, bonus, others=None, shun=0, ke=0) -> None:
         others: list of conditions, including the current round, seats, etc.
         shun: int, the number of shun.
         ke: int, the number of ke.
+        best: dict with "money" and "breakdown", the best hand found so far.
     Returns:
-        None
+        best: dict with "money" and "breakdown", the best hand found so far.
     """
 
-    global final_breakdown, final_money
+    if best is None:
+        best = {"money": empty_money(), "breakdown": []}
 
     # If no tiles left, return True
     if sum(tile_count.values()) == 0 and shun + ke == 5:
         tmp_money = check_winning_money(breakdown, bonus, others)
-        if tmp_money[others["seat"]] > final_money[others["seat"]]:
-            final_money = tmp_money
-            final_breakdown = deepcopy(breakdown)
+        if tmp_money[others["seat"]] > best["money"][others["seat"]]:
+            best["money"] = tmp_money
+            best["breakdown"] = deepcopy(breakdown)
 
-        print("PATTERN RECOGNITION: Form a winning hand...")
-        return
+        logger.debug("Form a winning hand")
+        return best
     
     # If no tiles left but not enough sets, return False
     if shun + ke == 5 or sum(tile_count.values()) == 0:
-        print("PATTERN RECOGNITION: Unable to form winning hand because of tile lacking")
-        return
+        logger.debug("Unable to form winning hand because of tile lacking")
+        return best
 
     # Find first available tile to form a shun or ke
     for tile in list(tile_count.keys()):
@@ -110,7 +197,7 @@ def check_sets(tile_count, breakdown, bonus, others=None, shun=0, ke=0) -> None:
                 del temp_count[tile]
 
             breakdown.append(("ke", tile, tile, tile))
-            check_sets(temp_count, breakdown, bonus, others, shun, ke + 1)
+            check_sets(temp_count, breakdown, bonus, others, shun, ke + 1, best)
             breakdown.pop() # Backtrack
     
         # Try to form a shun, words cannot form shun
@@ -138,10 +225,10 @@ def check_sets(tile_count, breakdown, bonus, others=None, shun=0, ke=0) -> None:
                         del temp_count[next2]
 
                     breakdown.append(("shun", tile, next1, next2))
-                    check_sets(temp_count, breakdown, bonus, others, shun + 1, ke)
+                    check_sets(temp_count, breakdown, bonus, others, shun + 1, ke, best)
                     breakdown.pop() # Backtrack
     
-    return
+    return best
 
 
 # Check the winning money
@@ -156,132 +243,30 @@ def check_winning_money(breakdown, bonus, others=None) -> dict:
         money: dict, the winning money.
     """
 
-    money = {"east": 0, "south": 0, "west": 0, "north": 0}
-
-    self_winning = False
-    dealer_money = 2 * others["continues"] - 1 if others is not None else 0
-
     # Check the winning money
     if breakdown is None:
-        return money
-    
-    # Check if someone fang chong, if self_winning then all other 3 players lose
-    if others["seat"] == others["wins"]:
-        self_winning = True
+        return empty_money()
 
-    # Check the breakdown
-    tai_count = 0
+    tai_count, _ = score_masks(hand_masks(breakdown, bonus), setting_masks(others))
+    return winning_money(tai_count, others)
 
+
+def winning_money(tai_count, others) -> dict:
     """
-    player has words of current round: 1
-    player has words of the seat: 1
-    player has bonus spring, summer, autumn, winter: 1
-    player has bonus plum, orchid, chrysanthemum, bamboo: 1
-    player has all ke: 4
-    player has all with same type with words: 4
-    player has all with same type without words: 8
-    player has only words: 8
-    player has zong, fa, bai, but one is dui: 4
-    player has zong, fa, bai, but all are ke: 8
-    player has east, south, west, north, but one is dui: 8
-    player has east, south, west, north, but all are ke: 16
+    Calculate the money of each seat from the tai count.
+    Parameters:
+        tai_count: int, the tai count of the winning hand.
+        others: list of conditions, including the current round, seats, etc.
+    Returns:
+        money: dict, the winning money.
     """
 
-    other_types = {"word": [], "bamboo": 0, "wan": 0, "bing": 0}
-    dui_type = ""
-    shun_count = ke_count = 0
+    money = empty_money()
+    dealer_money = 2 * others["continues"] - 1
 
-    # Check the type of each set in the breakdown
-    for item in breakdown:
-        if item[0] == "dui":
-            tile_name = tile_translation(item[1])
-            if item[1] >= 28 and item[1] <= 34:
-                dui_type = tile_name
-            elif tile_name[0] == "b":
-                dui_type = "bing"
-            elif tile_name[0] == "w":
-                dui_type = "wan"
-            elif tile_name[0] == "s":
-                dui_type = "bamboo"
+    # Check if someone fang chong, if self_winning then all other 3 players lose
+    self_winning = others["seat"] == others["wins"]
 
-        else:
-            if item[0] == "shun":
-                shun_count += 1
-            elif item[0] == "ke":
-                ke_count += 1
-
-            tile_name = tile_translation(item[1])
-            if item[1] >= 28 and item[1] <= 34:
-                other_types["word"].append(tile_name)
-            elif tile_name[0] == "b":
-                other_types["bing"] += 1
-            elif tile_name[0] == "w":
-                other_types["wan"] += 1
-            elif tile_name[0] == "s":
-                other_types["bamboo"] += 1
-
-    # Check if the player has words of the current round
-    if others["round"] in other_types["word"]:
-        tai_count += 1
-    # Check if the player has words of the seat
-    current_seat = (words_index.index(others["seat"]) - words_index.index(others["dealer"]) + 4) % 4
-    if words_index[current_seat] in other_types["word"]:
-        tai_count += 1
-    # Check if the player has bonus spring, summer, autumn, winter
-    if bonus is not None and any(tile in bonus for tile in range(35, 39)):
-        tai_count += 1
-    # Check if the player has bonus plum, orchid, chrysanthemum, bamboo
-    if bonus is not None and any(tile in bonus for tile in range(39, 43)):
-        tai_count += 1
-    # Check if the player has all ke
-    if ke_count == 5:
-        tai_count += 4
-    # Check if the player has all with same type
-    if dui_type == "bing":
-        if other_types["bamboo"] == 0 and other_types["wan"] == 0 and len(other_types["word"]) == 0:
-            tai_count += 8
-        elif other_types["bamboo"] == 0 and other_types["wan"] == 0:
-            tai_count += 4
-    elif dui_type == "wan":
-        if other_types["bamboo"] == 0 and other_types["bing"] == 0 and len(other_types["word"]) == 0:
-            tai_count += 4
-        elif other_types["bamboo"] == 0 and other_types["bing"] == 0:
-            tai_count += 8
-    elif dui_type == "bamboo":
-        if other_types["bing"] == 0 and other_types["wan"] == 0 and len(other_types["word"]) == 0:
-            tai_count += 8
-        elif other_types["bing"] == 0 and other_types["wan"] == 0:
-            tai_count += 4
-    else:
-        if len(other_types["word"]) == 5:
-            tai_count += 8
-        elif len(other_types["word"]) + other_types["bamboo"] == 5 or \
-             len(other_types["word"]) + other_types["wan"] == 5 or \
-             len(other_types["word"]) + other_types["bing"] == 5:
-            tai_count += 4
-    # Check if the player has zong, fa, bai
-    if dui_type not in ["zong", "fa", "bai"]:
-        if all(tile in other_types["word"] for tile in ["zong", "fa", "bai"]):
-            tai_count += 8
-    elif dui_type == "zong" and all(tile in other_types["word"] for tile in ["fa", "bai"]):
-        tai_count += 4
-    elif dui_type == "fa" and all(tile in other_types["word"] for tile in ["zong", "bai"]):
-        tai_count += 4
-    elif dui_type == "bai" and all(tile in other_types["word"] for tile in ["zong", "fa"]):
-        tai_count += 4
-    # Check if the player has east, south, west, north
-    if dui_type not in words_index:
-        if all(tile in other_types["word"] for tile in words_index):
-            tai_count += 16
-    elif dui_type == "east" and all(tile in other_types["word"] for tile in ["south", "west", "north"]):
-        tai_count += 8
-    elif dui_type == "south" and all(tile in other_types["word"] for tile in ["east", "west", "north"]):
-        tai_count += 8
-    elif dui_type == "west" and all(tile in other_types["word"] for tile in ["east", "south", "north"]):
-        tai_count += 8
-    elif dui_type == "north" and all(tile in other_types["word"] for tile in ["east", "south", "west"]):
-        tai_count += 8
-    
     # Calculate the money based on the tai count and winning conditions
     if self_winning and others["seat"] != others["dealer"]:
         money[others["seat"]] += (others["base"] + others["bonus"] * tai_count) * 3 + others["bonus"] * dealer_money
@@ -320,4 +305,86 @@ def unpackage_breakdown_list(breakdown: list) -> list:
         else:
             unpackaged_breakdown.extend([item[1], item[2], item[3]])
     
-    return unpackaged_breakdown
\ No newline at end of file
+    return unpackaged_breakdown
+
+# Stress test concurrent evaluation
+# python -m src.pattern_recognition.main --stress --hands 500 --workers 32
+def _random_case(seed):
+    import random
+    from .hand_decomposition import random_winning_hand, split_tiles
+
+    rng = random.Random(seed)
+    seats = words_index
+    others = {
+        "round": rng.choice(seats),
+        "dealer": rng.choice(seats),
+        "continues": rng.randint(1, 5),
+        "dice": rng.randint(3, 18),
+        "seat": rng.choice(seats),
+        "wins": rng.choice(seats),
+        "base": rng.choice([50, 100, 200, 300]),
+        "bonus": rng.choice([10, 20, 30, 50]),
+    }
+    return split_tiles(random_winning_hand(rng)), others
+
+
+def _evaluate_case(seed):
+    tiles, others = _random_case(seed)
+    return evaluate_hand(*tiles, others)
+
+
+def stress_evaluation(num_hands=500, workers=32):
+    import contextlib
+    import io
+    from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+    seeds = list(range(num_hands))
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        expected = [_evaluate_case(seed) for seed in seeds]
+
+        # Run in reverse so neighbouring hands are evaluated at the same time
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            threaded = dict(zip(reversed(seeds), executor.map(_evaluate_case, reversed(seeds))))
+
+        with ProcessPoolExecutor(max_workers=min(workers, 8)) as executor:
+            processed = dict(zip(seeds, executor.map(_evaluate_case, seeds, chunksize=16)))
+
+        try:
+            import eventlet
+            pool = eventlet.GreenPool(workers)
+            greened = dict(zip(seeds, pool.imap(_evaluate_case, seeds)))
+        except ImportError:
+            greened = None
+
+    failures = 0
+    for seed in seeds:
+        runs = {"threads": threaded[seed], "processes": processed[seed]}
+        if greened is not None:
+            runs["greenlets"] = greened[seed]
+        for name, result in runs.items():
+            if result != expected[seed]:
+                failures += 1
+                print(f"Hand {seed} ({name}): expected {expected[seed]}, got {result}")
+
+    winning = sum(1 for result in expected if result.breakdown)
+    print(f"Hands: {num_hands} ({winning} winning), workers: {workers}")
+    print(f"Greenlets: {'skipped, eventlet is not installed' if greened is None else 'checked'}")
+    print(f"Mismatches: {failures}")
+    return failures == 0
+
+
+def parse_args():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Mahjong pattern recognition")
+    parser.add_argument("--stress", action="store_true", help="Evaluate many hands concurrently and compare results")
+    parser.add_argument("--hands", type=int, default=500, help="Number of distinct hands")
+    parser.add_argument("--workers", type=int, default=32, help="Number of concurrent workers")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.stress and not stress_evaluation(args.hands, args.workers):
+        raise SystemExit(1)
@@ -0,0 +1,441 @@
+import os
+import sys
+import time
+import random
+import struct
+import logging
+import argparse
+import threading
+from functools import lru_cache
+from itertools import combinations_with_replacement, product
+
+import numpy as np
+
+from ..metrics import tally
+from .hand_decomposition import NUM_TILES, CACHE_SIZE, decompose_sets, decompose_hand, clear_cache
+
+# Every suit (bing 1-9, bamboo 10-18, wan 19-27) is decomposed independently,
+# so the decompositions of each 9-tile count vector are built offline:
+# python -m src.pattern_recognition.suit_table --build
+_this_dir = os.path.dirname(os.path.abspath(__file__))
+table_path = os.path.join(_this_dir, "suit_table.bin")
+logger = logging.getLogger(__name__)
+
+# File layout (little endian):
+#   header: magic, version, number of keys, number of data bytes
+#   keys: uint32[n], sorted base-5 codes of the suit count vectors
+#   offsets: uint32[n + 1], start of each key's record in data
+#   data: uint8[], per key the number of decompositions, then for each
+#         decomposition its length followed by the set codes
+TABLE_MAGIC = b"MJSUIT"
+TABLE_VERSION = 1
+HEADER = struct.Struct("<6sHII")
+
+SUIT_STARTS = (1, 10, 19)
+SUIT_SIZE = 9
+MAX_SETS = 5
+
+# Set codes relative to the first tile of the suit
+KE_CODE = 0     # 0-8: ke of tile
+SHUN_CODE = 9   # 9-15: shun starting from tile
+DUI_CODE = 16   # 16-24: dui of tile
+
+_table = None
+_table_lock = threading.Lock()
+
+
+def suit_code(counts) -> int:
+    """
+    Encode a 9-slot suit count vector (each count at most 4) in base 5.
+    """
+    code = 0
+    for cnt in reversed(counts):
+        code = code * 5 + cnt
+    return code
+
+
+def _encode_set(item, start) -> int:
+    if item[0] == "ke":
+        return KE_CODE + item[1] - start
+    elif item[0] == "shun":
+        return SHUN_CODE + item[1] - start
+    return DUI_CODE + item[1] - start
+
+
+def _decode_set(code, start) -> tuple:
+    if code >= DUI_CODE:
+        tile = start + code - DUI_CODE
+        return ("dui", tile, tile)
+    elif code >= SHUN_CODE:
+        tile = start + code - SHUN_CODE
+        return ("shun", tile, tile + 1, tile + 2)
+    tile = start + code - KE_CODE
+    return ("ke", tile, tile, tile)
+
+
+def _suit_vectors():
+    """
+    Every suit count vector that splits into at most five sets and at most one dui.
+    """
+    vectors = set()
+    for set_count in range(MAX_SETS + 1):
+        for sets in combinations_with_replacement(range(KE_CODE, DUI_CODE), set_count):
+            counts = [0] * SUIT_SIZE
+            for code in sets:
+                if code >= SHUN_CODE:
+                    for i in range(3):
+                        counts[code - SHUN_CODE + i] += 1
+                else:
+                    counts[code - KE_CODE] += 3
+            if max(counts) > 4:
+                continue
+
+            vectors.add(tuple(counts))
+            for tile in range(SUIT_SIZE):
+                if counts[tile] <= 2:
+                    with_dui = list(counts)
+                    with_dui[tile] += 2
+                    vectors.add(tuple(with_dui))
+    return vectors
+
+
+def _engine_decompositions(counts, start=SUIT_STARTS[0]) -> tuple:
+    """
+    Decompositions of one suit from the memoized decomposer, without dui first.
+    """
+    full_counts = [0] * NUM_TILES
+    full_counts[start:start + SUIT_SIZE] = counts
+    full_counts = tuple(full_counts)
+    return decompose_sets(full_counts) + decompose_hand(full_counts, need_dui=True)
+
+
+def _engine_encoded(counts) -> list:
+    return [tuple(_encode_set(item, SUIT_STARTS[0]) for item in sets) for sets in _engine_decompositions(counts)]
+
+
+def build_table(path=table_path):
+    """
+    Build the suit decomposition table and write it to the path.
+    """
+    vectors = sorted(_suit_vectors(), key=suit_code)
+
+    keys = np.empty(len(vectors), dtype="<u4")
+    offsets = np.empty(len(vectors) + 1, dtype="<u4")
+    data = bytearray()
+    for i, counts in enumerate(vectors):
+        decompositions = _engine_decompositions(counts)
+        if len(decompositions) > 255:
+            raise ValueError(f"Too many decompositions for {counts}")
+
+        keys[i] = suit_code(counts)
+        offsets[i] = len(data)
+        data.append(len(decompositions))
+        for sets in _engine_encoded(counts):
+            data.append(len(sets))
+            data.extend(sets)
+    offsets[-1] = len(data)
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as file:
+        file.write(HEADER.pack(TABLE_MAGIC, TABLE_VERSION, len(keys), len(data)))
+        file.write(keys.tobytes())
+        file.write(offsets.tobytes())
+        file.write(bytes(data))
+    os.replace(tmp_path, path)
+
+    print(f"Suit table saved as {path} ({len(keys)} vectors, {os.path.getsize(path)} bytes)")
+
+
+def _read_table(path):
+    if not os.path.exists(path):
+        logger.warning("%s not found, using the hand decomposer instead", path)
+        return False
+
+    # Plain array view of the mapping, memmap slicing is slow on the hot path
+    raw = np.memmap(path, dtype=np.uint8, mode="r").view(np.ndarray)
+    magic, version, key_count, data_size = HEADER.unpack(raw[:HEADER.size].tobytes())
+    if magic != TABLE_MAGIC or version != TABLE_VERSION:
+        logger.warning("%s has version %s, expected %s, using the hand decomposer instead", path, version, TABLE_VERSION)
+        return False
+
+    keys_start = HEADER.size
+    offsets_start = keys_start + 4 * key_count
+    data_start = offsets_start + 4 * (key_count + 1)
+    return {
+        "keys": raw[keys_start:offsets_start].view("<u4"),
+        "offsets": raw[offsets_start:data_start].view("<u4"),
+        "data": raw[data_start:data_start + data_size],
+    }
+
+
+def load_table(path=table_path):
+    """
+    Memory-map the suit table on first use.
+    Returns:
+        table: dict of arrays, or None if the file is missing or outdated.
+    """
+    global _table
+    if _table is None:
+        with _table_lock:
+            if _table is None:
+                _table = _read_table(path)
+    return _table or None
+
+
+def _parse_record(record) -> list:
+    decompositions = []
+    pos = 1
+    for _ in range(record[0]):
+        length = record[pos]
+        decompositions.append(tuple(record[pos + 1:pos + 1 + length]))
+        pos += 1 + length
+    return decompositions
+
+
+def _lookup(table, code):
+    keys = table["keys"]
+    # Search with the array dtype so the keys are not converted on every call
+    i = int(keys.searchsorted(np.uint32(code)))
+    if i == len(keys) or keys[i] != code:
+        return None
+
+    offsets = table["offsets"]
+    return _parse_record(table["data"][int(offsets[i]):int(offsets[i + 1])].tobytes())
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def suit_decompositions(counts: tuple, start: int) -> tuple:
+    """
+    Look up the decompositions of one suit.
+    Parameters:
+        counts: tuple of int, the 9-slot count vector of the suit.
+        start: int, the first tile of the suit (1, 10 or 19).
+    Returns:
+        without_dui: tuple of tuple, the decompositions into sets only.
+        with_dui: tuple of tuple, the decompositions into one dui and sets.
+    """
+    table = load_table()
+    encoded = None
+    if table is not None and max(counts) <= 4:
+        encoded = _lookup(table, suit_code(counts))
+
+    if encoded is not None:
+        # One node for the lookup and one for every record decoded
+        tally("suit_table", 1 + len(encoded))
+        decompositions = [tuple(_decode_set(code, start) for code in sets) for sets in encoded]
+    elif table is not None and max(counts) <= 4 and sum(counts) <= 3 * MAX_SETS + 2:
+        # Every winnable vector is in the table
+        tally("suit_table")
+        decompositions = []
+    else:
+        decompositions = _engine_decompositions(counts, start)
+
+    without_dui = tuple(sets for sets in decompositions if not sets or sets[0][0] != "dui")
+    with_dui = tuple(sets for sets in decompositions if sets and sets[0][0] == "dui")
+    return without_dui, with_dui
+
+
+def decompose_by_suit(counts: tuple, need_dui=True) -> list:
+    """
+    Same as hand_decomposition.decompose_hand for bing, bamboo and wan tiles,
+    built from one table lookup per suit.
+    Parameters:
+        counts: tuple of int, the 43-slot count vector.
+        need_dui: bool, whether a dui still has to be taken from these tiles.
+    Returns:
+        decompositions: list of tuple, each one starts with the dui (if any)
+            followed by the sets in ascending order.
+    """
+    suits = [suit_decompositions(tuple(counts[start:start + SUIT_SIZE]), start) for start in SUIT_STARTS]
+
+    decompositions = []
+    if not need_dui:
+        for combination in product(*(without_dui for without_dui, _ in suits)):
+            decompositions.append(sum(combination, ()))
+        return decompositions
+
+    # Exactly one suit holds the dui
+    for dui_suit, (_, with_dui) in enumerate(suits):
+        choices = [with_dui if i == dui_suit else without_dui for i, (without_dui, _) in enumerate(suits)]
+        for combination in product(*choices):
+            dui = combination[dui_suit][0]
+            sets = sum((sets[1:] if i == dui_suit else sets for i, sets in enumerate(combination)), ())
+            decompositions.append((dui,) + sets)
+    return decompositions
+
+
+# Flags of each suit vector for vectorized win checks
+FLAG_SETS = 1           # can be split into sets only
+FLAG_DUI = 2            # can be split into one dui and sets
+FLAG_ALL_KE = 4         # can be split into ke only
+FLAG_ALL_KE_DUI = 8     # can be split into one dui and ke only
+_key_flags = None
+
+
+def _encoded_flags(encoded) -> int:
+    flags = 0
+    for sets in encoded:
+        has_dui = len(sets) > 0 and sets[0] >= DUI_CODE
+        all_ke = all(code < SHUN_CODE for code in sets[has_dui:])
+        if has_dui:
+            flags |= FLAG_DUI | (FLAG_ALL_KE_DUI if all_ke else 0)
+        else:
+            flags |= FLAG_SETS | (FLAG_ALL_KE if all_ke else 0)
+    return flags
+
+
+def _table_flags(table):
+    global _key_flags
+    if _key_flags is None:
+        with _table_lock:
+            if _key_flags is None:
+                offsets = table["offsets"].tolist()
+                data = table["data"].tobytes()
+                _key_flags = np.array(
+                    [_encoded_flags(_parse_record(data[offsets[i]:offsets[i + 1]])) for i in range(len(offsets) - 1)],
+                    dtype=np.uint8,
+                )
+    return _key_flags
+
+
+def suit_flags(suit_counts):
+    """
+    Vectorized flags of many suit count vectors, the same for every suit.
+    Parameters:
+        suit_counts: 2-D array of int, one 9-slot suit count vector per row.
+    Returns:
+        flags: 1-D array of uint8, FLAG_* bits of each row.
+    """
+    suit_counts = np.asarray(suit_counts)
+    flags = np.zeros(len(suit_counts), dtype=np.uint8)
+    if len(suit_counts) == 0:
+        return flags
+
+    table = load_table()
+    in_table = np.zeros(len(suit_counts), dtype=bool)
+    if table is not None:
+        in_domain = (suit_counts <= 4).all(axis=1) & (suit_counts.sum(axis=1) <= 3 * MAX_SETS + 2)
+        codes = (suit_counts.astype(np.int64) @ (5 ** np.arange(SUIT_SIZE, dtype=np.int64))).astype(np.uint32)
+        keys = table["keys"]
+        index = np.minimum(keys.searchsorted(codes), len(keys) - 1)
+        found = in_domain & (keys[index] == codes)
+        flags[found] = _table_flags(table)[index[found]]
+        # Vectors in the domain but not in the table cannot be split
+        in_table = in_domain
+
+    # Fall back to the decomposer for everything the table does not cover
+    rest = np.flatnonzero(~in_table)
+    if len(rest):
+        unique, inverse = np.unique(suit_counts[rest], axis=0, return_inverse=True)
+        unique_flags = np.array(
+            [_encoded_flags(_engine_encoded(tuple(int(c) for c in row))) for row in unique],
+            dtype=np.uint8,
+        )
+        flags[rest] = unique_flags[inverse.reshape(-1)]
+    return flags
+
+
+# Cross-check the table against the decomposer and the check_sets recursion
+# python -m src.pattern_recognition.suit_table --verify
+def verify_table(hands=200, seed=0):
+    import contextlib
+    import io
+    from .main import evaluate_hand, brute_force_evaluate
+    from .hand_decomposition import random_winning_hand, split_tiles
+
+    table = load_table()
+    if table is None:
+        raise RuntimeError("Suit table is not available, build it with --build first")
+
+    errors = 0
+
+    # Every entry matches the decomposer
+    for code in table["keys"]:
+        counts = [(int(code) // 5 ** i) % 5 for i in range(SUIT_SIZE)]
+        for start in SUIT_STARTS:
+            expected = _engine_decompositions(counts, start)
+            encoded = _lookup(table, int(code))
+            if tuple(tuple(_decode_set(c, start) for c in sets) for sets in encoded) != expected:
+                errors += 1
+                print(f"Entry {counts} (start {start}) does not match the decomposer")
+
+    # Vectors outside of the table cannot be decomposed
+    rng = random.Random(seed)
+    for _ in range(20000):
+        counts = [rng.choice((0, 0, 0, 1, 2, 3, 4)) for _ in range(SUIT_SIZE)]
+        if sum(counts) > 3 * MAX_SETS + 2 or _lookup(table, suit_code(counts)) is not None:
+            continue
+        if _engine_decompositions(counts):
+            errors += 1
+            print(f"Vector {counts} is missing from the table")
+
+    # Whole hands match the brute force recursion
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i in range(hands):
+            tiles = random_winning_hand(rng)
+            if i % 2:
+                # Swap one tile so some hands cannot win
+                tiles[rng.randrange(len(tiles))] = rng.randint(1, 34)
+            others = {
+                "round": "east", "dealer": rng.choice(["east", "south"]), "continues": 1, "dice": 18,
+                "seat": "east", "wins": rng.choice(["east", "west"]), "base": 100, "bonus": 30,
+            }
+            expected = brute_force_evaluate(*split_tiles(tiles), others)
+            result = evaluate_hand(*split_tiles(tiles), others)
+            if result.money != expected.money:
+                errors += 1
+                print(f"Hand {sorted(tiles)}: expected {expected.money}, got {result.money}", file=sys.stderr)
+
+    print(f"Table entries: {len(table['keys'])}, hands: {hands}, errors: {errors}")
+    return errors == 0
+
+
+# Compare the table lookups with the memoized decomposer
+# python -m src.pattern_recognition.suit_table --benchmark
+def benchmark_table(hands=2000, seed=0):
+    from .hand_decomposition import random_winning_hand, to_count_vector
+
+    rng = random.Random(seed)
+    vectors = [to_count_vector(tile for tile in random_winning_hand(rng, words=False, max_bonus=0)) for _ in range(hands)]
+
+    load_table()
+    clear_cache()
+    start_engine = time.perf_counter()
+    for counts in vectors:
+        decompose_hand(counts)
+    engine_duration = time.perf_counter() - start_engine
+
+    suit_decompositions.cache_clear()
+    start_table = time.perf_counter()
+    for counts in vectors:
+        decompose_by_suit(counts)
+    table_duration = time.perf_counter() - start_table
+
+    start_warm = time.perf_counter()
+    for counts in vectors:
+        decompose_by_suit(counts)
+    warm_duration = time.perf_counter() - start_warm
+
+    print(f"Hands: {hands}")
+    print(f"Memoized decomposer: {engine_duration / hands * 1e6:.1f} us/hand")
+    print(f"Suit table: {table_duration / hands * 1e6:.1f} us/hand")
+    print(f"Suit table (warm cache): {warm_duration / hands * 1e6:.1f} us/hand")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Mahjong suit decomposition table")
+    parser.add_argument("--build", action="store_true", help="Build the table file")
+    parser.add_argument("--verify", action="store_true", help="Cross-check the table with the brute force recursion")
+    parser.add_argument("--benchmark", action="store_true", help="Compare the table with the memoized decomposer")
+    parser.add_argument("--hands", type=int, default=200, help="Number of hands to verify or benchmark")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.build:
+        build_table()
+    if args.verify and not verify_table(args.hands):
+        sys.exit(1)
+    if args.benchmark:
+        benchmark_table(args.hands)
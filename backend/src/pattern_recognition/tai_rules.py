@@ -0,0 +1,157 @@
+from typing import NamedTuple, Callable
+
+# Tai rules as a table of predicates over bitmasks of the breakdown. Each
+# predicate only uses &, |, == and != so the same rule works on Python ints for
+# one breakdown and on NumPy arrays for a batch of hands.
+SEATS = ["east", "south", "west", "north"]
+# Part of the keys of cached scores, bump it whenever a rule or the scoring of
+# a breakdown changes so the scores cached before are not served
+SCORING_VERSION = 1
+
+# Suit bits
+BING = 1
+BAMBOO = 2
+WAN = 4
+
+# Words bits, tile 28 + i is bit i
+WORDS_START = 28
+EAST, SOUTH, WEST, NORTH, ZONG, FA, BAI = (1 << i for i in range(7))
+WINDS = EAST | SOUTH | WEST | NORTH
+DRAGONS = ZONG | FA | BAI
+
+# Bonus bits, tile 35 + i is bit i
+BONUS_START = 35
+SEASONS = 0x0F   # spring, summer, autumn, winter
+FLOWERS = 0xF0   # plum, orchid, chrysanthemum, bamboo
+
+# Per tile lookup tables, indexed like `index` in tile_generation/main.py
+TILE_SUIT = [0] + [BING] * 9 + [BAMBOO] * 9 + [WAN] * 9 + [0] * 15
+TILE_WORD = [0] * 28 + [1 << i for i in range(7)] + [0] * 8
+TILE_BONUS = [0] * 35 + [1 << i for i in range(8)]
+
+
+class HandMasks(NamedTuple):
+    """
+    Bitmasks of one breakdown, or arrays of them for a batch.
+    Attributes:
+        set_suits: suit bits of the ke and shun.
+        set_words: words bits of the ke.
+        word_sets: number of ke of words.
+        ke_count: number of ke.
+        dui_suit: suit bit of the dui, 0 if the dui is words.
+        dui_word: words bit of the dui, 0 if the dui is a suit.
+        bonus: bonus bits of the bonus tiles.
+    """
+    set_suits: int
+    set_words: int
+    word_sets: int
+    ke_count: int
+    dui_suit: int
+    dui_word: int
+    bonus: int
+
+
+class SettingMasks(NamedTuple):
+    """
+    Bitmasks of the game settings.
+    Attributes:
+        round_word: words bit of the current round.
+        seat_word: words bit of the winning player's seat relative to the dealer.
+    """
+    round_word: int
+    seat_word: int
+
+
+class TaiRule(NamedTuple):
+    name: str
+    tai: int
+    applies: Callable
+
+
+def _one_bit(mask):
+    # Exactly one bit set, works on ints and arrays
+    return (mask != 0) & ((mask & (mask - 1)) == 0)
+
+
+def _one_suit(hand):
+    return _one_bit(hand.set_suits | hand.dui_suit)
+
+
+# The tai rules, checked in order
+TAI_RULES = [
+    TaiRule("round_wind", 1, lambda hand, game: (hand.set_words & game.round_word) != 0),
+    TaiRule("seat_wind", 1, lambda hand, game: (hand.set_words & game.seat_word) != 0),
+    TaiRule("seasons", 1, lambda hand, game: (hand.bonus & SEASONS) != 0),
+    TaiRule("flowers", 1, lambda hand, game: (hand.bonus & FLOWERS) != 0),
+    TaiRule("all_ke", 4, lambda hand, game: hand.ke_count == 5),
+    TaiRule("pure_one_suit", 8, lambda hand, game: _one_suit(hand) & ((hand.set_words | hand.dui_word) == 0)),
+    TaiRule("half_one_suit", 4, lambda hand, game: _one_suit(hand) & ((hand.set_words | hand.dui_word) != 0)),
+    TaiRule("all_words", 8, lambda hand, game: ((hand.set_suits | hand.dui_suit) == 0) & (hand.word_sets == 5)),
+    TaiRule("big_three_dragons", 8, lambda hand, game: ((hand.set_words & DRAGONS) == DRAGONS) & ((hand.dui_word & DRAGONS) == 0)),
+    TaiRule("small_three_dragons", 4, lambda hand, game: ((hand.dui_word & DRAGONS) != 0) & (((hand.set_words | hand.dui_word) & DRAGONS) == DRAGONS)),
+    TaiRule("big_four_winds", 16, lambda hand, game: ((hand.set_words & WINDS) == WINDS) & ((hand.dui_word & WINDS) == 0)),
+    TaiRule("small_four_winds", 8, lambda hand, game: ((hand.dui_word & WINDS) != 0) & (((hand.set_words | hand.dui_word) & WINDS) == WINDS)),
+]
+
+
+def setting_masks(others) -> SettingMasks:
+    """
+    Compile the game settings to bitmasks.
+    """
+    seat = (SEATS.index(others["seat"]) - SEATS.index(others["dealer"]) + 4) % 4
+    return SettingMasks(1 << SEATS.index(others["round"]), 1 << seat)
+
+
+def hand_masks(breakdown, bonus) -> HandMasks:
+    """
+    Compute the bitmasks of a breakdown.
+    Parameters:
+        breakdown: list of tuple, the breakdown of the winning hand.
+        bonus: list of int, the tiles of bonus.
+    Returns:
+        masks: HandMasks, the bitmasks of the breakdown.
+    """
+    set_suits = set_words = word_sets = ke_count = dui_suit = dui_word = bonus_mask = 0
+    for item in breakdown:
+        tile = item[1]
+        if item[0] == "dui":
+            # Only the last dui counts
+            dui_suit = TILE_SUIT[tile]
+            dui_word = TILE_WORD[tile]
+            continue
+
+        if item[0] == "ke":
+            ke_count += 1
+        set_suits |= TILE_SUIT[tile]
+        if TILE_WORD[tile]:
+            set_words |= TILE_WORD[tile]
+            word_sets += 1
+
+    for tile in bonus or ():
+        if 0 < tile < len(TILE_BONUS):
+            bonus_mask |= TILE_BONUS[tile]
+
+    return HandMasks(set_suits, set_words, word_sets, ke_count, dui_suit, dui_word, bonus_mask)
+
+
+def score_masks(hand: HandMasks, game: SettingMasks) -> tuple[int, list]:
+    """
+    Count the tai of one breakdown.
+    Returns:
+        tai: int, the tai count.
+        fired: list of tuple, (name, tai) of every rule that applies.
+    """
+    fired = [(rule.name, rule.tai) for rule in TAI_RULES if rule.applies(hand, game)]
+    return sum(tai for _, tai in fired), fired
+
+
+def score_masks_batch(hand: HandMasks, game: SettingMasks):
+    """
+    Count the tai of a batch, every field of hand is an array.
+    Returns:
+        tai: array of int, the tai count of each hand.
+    """
+    tai = 0
+    for rule in TAI_RULES:
+        tai = tai + rule.tai * rule.applies(hand, game)
+    return tai
@@ -1,16 +1,88 @@
-from ultralytics import YOLO
+import importlib.util
+import threading
+import hashlib
+import logging
 import os
 
-# Load the model
+from ..metrics import span
+
 _this_dir = os.path.dirname(os.path.abspath(__file__))
-model_path = os.path.join(_this_dir, "..", "image_recognition", "runs", "detect", "train5", "weights", "best.pt")
-model = YOLO(model_path)
+weights_dir = os.path.join(_this_dir, "..", "image_recognition", "runs", "detect", "train5", "weights")
 
-def tile_recognition(image_path):
-    # Detect the tiles in the image
-    print("TILE RECOGNITION: Detecting tiles in", image_path)
-    results = model(image_path, conf=0.5)
+logger = logging.getLogger(__name__)
+
+# Exported models written by image_recognition/export_model.py, and the runtime each one needs
+backends = {
+    "openvino": ("best_openvino_model", "openvino"),
+    "onnx-int8": ("best-int8.onnx", "onnxruntime"),
+    "onnx": ("best.onnx", "onnxruntime"),
+    "torch": ("best.pt", "torch"),
+}
+# Order tried by DETECTOR_BACKEND=auto, the INT8 model is only used when asked for
+auto_backends = ["onnx", "torch"]
+
+def select_backend(name=None):
+    """
+    Pick the detector backend.
+    Parameters:
+        name: str, one of backends or "auto", defaults to the DETECTOR_BACKEND environment variable.
+    Returns:
+        backend: str, the selected backend.
+        path: str, the path of the model file.
+    """
+    name = (name or os.getenv("DETECTOR_BACKEND", "auto")).lower()
+    candidates = auto_backends if name == "auto" else [name, "torch"]
+    for backend in candidates:
+        if backend not in backends:
+            raise ValueError(f"Unknown detector backend: {backend}")
+        filename, runtime = backends[backend]
+        path = os.path.join(weights_dir, filename)
+        if os.path.exists(path) and importlib.util.find_spec(runtime) is not None:
+            return backend, path
+        if backend != "torch":
+            logger.warning("%s backend unavailable, falling back", backend)
+    return "torch", os.path.join(weights_dir, backends["torch"][0])
+
+def model_fingerprint(name=None):
+    """
+    Name the detector by its backend and the hash of its model files, so results
+    of another model are told apart.
+    Returns:
+        fingerprint: str, "backend:sha256", "backend:missing" without model files.
+    """
+    backend, path = select_backend(name)
+    if os.path.isdir(path):
+        files = sorted(os.path.join(root, f) for root, _, names in os.walk(path) for f in names)
+    else:
+        files = [path] if os.path.exists(path) else []
+    if not files:
+        return f"{backend}:missing"
+    digest = hashlib.sha256()
+    for file in files:
+        digest.update(os.path.relpath(file, path).encode("utf-8"))
+        with open(file, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+    return f"{backend}:{digest.hexdigest()[:16]}"
+
+# The model is loaded on first use, importing ultralytics pulls in torch
+_model = None
+_model_lock = threading.Lock()
+
+def get_model():
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                from ultralytics import YOLO
 
+                # Exported ONNX / OpenVINO models run without PyTorch eager mode
+                backend, model_path = select_backend()
+                _model = YOLO(model_path, task="detect")
+                logger.info("Using the %s backend (%s)", backend, model_path)
+    return _model
+
+def group_tiles(classes):
     # Initialize the lists
     bing = []     # 1-9
     bamboo = []  # 10-18
@@ -18,20 +90,38 @@ def tile_recognition(image_path):
     words = []   # 28-34
     bonus = []   # 35-42
 
+    for cls in classes:
+        if cls <= 9 and cls >= 1:
+            bing.append(cls)
+        elif cls <= 18 and cls >= 10:
+            bamboo.append(cls)
+        elif cls <= 27 and cls >= 19:
+            wan.append(cls)
+        elif cls <= 34 and cls >= 28:
+            words.append(cls)
+        elif cls <= 42 and cls >= 35:
+            bonus.append(cls)
+
+    return bing, bamboo, wan, words, bonus
+
+def detect_tiles(images, conf=0.5):
+    """
+    Detect the tiles of a batch of images with one model call.
+    Parameters:
+        images: list of image paths or BGR arrays.
+        conf: float, the confidence threshold.
+    Returns:
+        tiles: list of tuple, (bing, bamboo, wan, words, bonus) for each image.
+    """
+    model = get_model()
+    with span("detection"):
+        results = model(images, conf=conf, verbose=False)
+
     # Extract the bounding boxes and labels
-    for result in results:
-        for box in result.boxes:
-            cls = int(box.cls)
-
-            if cls <= 9 and cls >= 1:
-                bing.append(cls)
-            elif cls <= 18 and cls >= 10:
-                bamboo.append(cls)
-            elif cls <= 27 and cls >= 19:
-                wan.append(cls)
-            elif cls <= 34 and cls >= 28:
-                words.append(cls)
-            elif cls <= 42 and cls >= 35:
-                bonus.append(cls)
-    
-    return bing, bamboo, wan, words, bonus
\ No newline at end of file
+    with span("grouping"):
+        return [group_tiles(int(box.cls) for box in result.boxes) for result in results]
+
+def tile_recognition(image_path):
+    # Detect the tiles in the image
+    logger.debug("Detecting tiles in %s", image_path)
+    return detect_tiles([image_path])[0]
@@ -0,0 +1,270 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+from .pattern_recognition.inference_service import FRAME
+
+# Content addressed cache of the analysis. Detections are keyed by the hash of
+# the uploaded bytes and scores by the hash of the detected tiles and the game
+# settings, so a re-upload of the same photo skips the detector, and another
+# photo of the same hand skips the scoring and the rendering. Detections are
+# also keyed by the detector's backend and model hash, and scores by
+# SCORING_VERSION, so a new model or new rules never get old results.
+# With a path the entries are kept in a SQLite file, shared by every worker
+# process that opens it and kept across restarts.
+DEFAULT_MAX_ITEMS = 4096
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+BUSY_TIMEOUT_MS = 5000
+# Use times and counters of the SQLite backend are written after this many
+# updates or seconds, or with the next put
+FLUSH_ITEMS = 64
+FLUSH_SECONDS = 5.0
+STAGES = ["detect", "score"]
+
+
+def encode_entry(header: dict, payload=b"") -> bytes:
+    header_bytes = json.dumps(header).encode("utf-8")
+    return FRAME.pack(len(header_bytes), len(payload)) + header_bytes + payload
+
+
+def decode_entry(data: bytes) -> tuple:
+    header_size, payload_size = FRAME.unpack_from(data)
+    header = json.loads(data[FRAME.size:FRAME.size + header_size])
+    return header, data[FRAME.size + header_size:FRAME.size + header_size + payload_size]
+
+
+class MemoryBackend():
+    """
+    Least recently used entries of this process.
+    """
+    def __init__(self, max_items, max_bytes):
+        self.max_items = max(1, max_items)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.items = OrderedDict()
+        self.size = 0
+        self.counters = {}
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.items:
+                return None
+            self.items.move_to_end(key)
+            return self.items[key]
+
+    def put(self, key, value: bytes):
+        with self.lock:
+            if key in self.items:
+                self.size -= len(self.items.pop(key))
+            self.items[key] = value
+            self.size += len(value)
+            while len(self.items) > self.max_items or (self.size > self.max_bytes and len(self.items) > 1):
+                _, evicted = self.items.popitem(last=False)
+                self.size -= len(evicted)
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"items": len(self.items), "bytes": self.size, "counters": dict(self.counters)}
+
+
+def _blocking(function, *args):
+    # Under eventlet a sqlite3 call would stall every greenlet until it returns,
+    # so it runs in eventlet's pool of native threads
+    try:
+        from eventlet import patcher, tpool
+    except ImportError:
+        return function(*args)
+    if not patcher.is_monkey_patched("thread"):
+        return function(*args)
+    return tpool.execute(function, *args)
+
+
+class SQLiteBackend():
+    """
+    Least recently used entries in a SQLite file, safe to open from several processes.
+    A hit only reads, the use times and the counters are written in batches.
+    """
+    def __init__(self, path, max_items, max_bytes):
+        self.max_items = max(1, max_items)
+        self.max_bytes = max_bytes
+        # Held by the calling greenlet or thread around the blocking call
+        self.lock = threading.Lock()
+        self.used = {}
+        self.counters = {}
+        self.flushed = time.monotonic()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # One connection per process behind a lock, greenlets of one thread would
+        # otherwise each open their own
+        self.conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT_MS / 1e3, isolation_level=None, check_same_thread=False)
+        with self.lock:
+            _blocking(self._create)
+
+    def _create(self):
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB NOT NULL, "
+                          "size INTEGER NOT NULL, used REAL NOT NULL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS ix_entries_used ON entries (used)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+
+    def _flush_due(self):
+        return (len(self.used) + sum(self.counters.values()) >= FLUSH_ITEMS or
+                time.monotonic() - self.flushed >= FLUSH_SECONDS)
+
+    def _take_pending(self):
+        used, counters = self.used, self.counters
+        self.used, self.counters = {}, {}
+        self.flushed = time.monotonic()
+        return used, counters
+
+    def _write_pending(self, used, counters):
+        # Inside a transaction, the use times and counts gathered since the last write
+        self.conn.executemany("UPDATE entries SET used = MAX(used, ?) WHERE key = ?",
+                              [(when, key) for key, when in used.items()])
+        self.conn.executemany("INSERT INTO counters (name, value) VALUES (?, ?) "
+                              "ON CONFLICT (name) DO UPDATE SET value = value + excluded.value", list(counters.items()))
+
+    def _transaction(self, work, *args):
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = work(*args)
+            self.conn.execute("COMMIT")
+            return result
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+
+    def _flush(self):
+        if self.used or self.counters:
+            _blocking(self._transaction, self._write_pending, *self._take_pending())
+
+    def _select(self, key):
+        row = self.conn.execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+        return bytes(row[0]) if row is not None else None
+
+    def get(self, key):
+        with self.lock:
+            value = _blocking(self._select, key)
+            if value is not None:
+                self.used[key] = time.time()
+            if self._flush_due():
+                self._flush()
+        return value
+
+    def _insert(self, key, value, used, counters):
+        self._write_pending(used, counters)
+        self.conn.execute("INSERT OR REPLACE INTO entries (key, value, size, used) VALUES (?, ?, ?, ?)",
+                          (key, value, len(value), time.time()))
+        items, size = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        # Evict the least recently used entries until both bounds hold
+        while items > 1 and (items > self.max_items or size > self.max_bytes):
+            evicted_key, evicted_size = self.conn.execute(
+                "SELECT key, size FROM entries ORDER BY used LIMIT 1").fetchone()
+            self.conn.execute("DELETE FROM entries WHERE key = ?", (evicted_key,))
+            items, size = items - 1, size - evicted_size
+
+    def put(self, key, value: bytes):
+        # The pending use times go in first, so the eviction sees them
+        with self.lock:
+            _blocking(self._transaction, self._insert, key, value, *self._take_pending())
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + 1
+
+    def _totals(self):
+        items, size = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        counters = dict(self.conn.execute("SELECT name, value FROM counters").fetchall())
+        return items, size, counters
+
+    def stats(self) -> dict:
+        with self.lock:
+            self._flush()
+            items, size, counters = _blocking(self._totals)
+        return {"items": items, "bytes": size, "counters": counters}
+
+
+def _digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+class AnalysisCache():
+    """
+    Cache of the detection and scoring stages of the analysis.
+    Parameters:
+        max_items: int, the maximum number of entries kept.
+        max_bytes: int, the maximum total size of the entries kept.
+        path: str, the SQLite file to keep the entries in, None keeps them in memory.
+    """
+    def __init__(self, max_items=DEFAULT_MAX_ITEMS, max_bytes=DEFAULT_MAX_BYTES, path=None):
+        self.path = path
+        if path:
+            self.backend = SQLiteBackend(path, max_items, max_bytes)
+        else:
+            self.backend = MemoryBackend(max_items, max_bytes)
+        # A detection is only valid for the detector that made it, found on first use
+        self.detector = None
+
+    def _lookup(self, stage, key):
+        value = self.backend.get(f"{stage}:{key}")
+        self.backend.count(f"{stage}_hits" if value is not None else f"{stage}_misses")
+        return value
+
+    def _detect_key(self, image_bytes):
+        if self.detector is None:
+            from .pattern_recognition.tile_recognition import model_fingerprint
+            self.detector = model_fingerprint()
+        return f"{self.detector}:{_digest(image_bytes)}"
+
+    def _score_key(self, tiles, others_settings):
+        from .pattern_recognition.tai_rules import SCORING_VERSION
+
+        # The multiset of every tile group, the order of detection does not matter
+        tiles = [sorted(group) for group in tiles]
+        return f"v{SCORING_VERSION}:{_digest(json.dumps([tiles, others_settings], sort_keys=True).encode('utf-8'))}"
+
+    def get_detection(self, image_bytes):
+        """
+        Returns:
+            tiles: list of list, (bing, bamboo, wan, words, bonus), or None on a miss.
+        """
+        value = self._lookup("detect", self._detect_key(image_bytes))
+        return decode_entry(value)[0]["tiles"] if value is not None else None
+
+    def put_detection(self, image_bytes, tiles):
+        self.backend.put(f"detect:{self._detect_key(image_bytes)}", encode_entry({"tiles": [list(group) for group in tiles]}))
+
+    def get_score(self, tiles, others_settings):
+        """
+        Returns:
+            result: HandResult, and png: bytes or None, or None on a miss.
+        """
+        from .pattern_recognition.main import HandResult
+
+        value = self._lookup("score", self._score_key(tiles, others_settings))
+        if value is None:
+            return None
+        header, png = decode_entry(value)
+        return HandResult(**header["result"]), png or None
+
+    def put_score(self, tiles, others_settings, result, png):
+        self.backend.put(f"score:{self._score_key(tiles, others_settings)}",
+                         encode_entry({"result": result._asdict()}, png or b""))
+
+    def stats(self) -> dict:
+        stats = self.backend.stats()
+        counters = stats.pop("counters")
+        for stage in STAGES:
+            hits, misses = counters.get(f"{stage}_hits", 0), counters.get(f"{stage}_misses", 0)
+            stats[stage] = {"hits": hits, "misses": misses,
+                            "hit_rate": hits / (hits + misses) if hits + misses else 0.0}
+        stats["shared"] = bool(self.path)
+        return stats
@@ -0,0 +1,55 @@
+import threading
+from collections import OrderedDict
+
+# Bounded in-memory store for the images of recent analyses, so uploads and
+# generated hands are served without writing them to static/.
+DEFAULT_MAX_ITEMS = 256
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+
+class ResultStore():
+    """
+    Least recently used store of result images.
+    Parameters:
+        max_items: int, the maximum number of results kept.
+        max_bytes: int, the maximum total size of the images kept.
+    """
+    def __init__(self, max_items=DEFAULT_MAX_ITEMS, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_items = max(1, max_items)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.items = OrderedDict()
+        self.size = 0
+
+    def put(self, result_id, images: dict):
+        """
+        Store the images of a result.
+        Parameters:
+            result_id: str, the id of the result.
+            images: dict, name -> (bytes, mimetype), None values are skipped.
+        """
+        images = {name: image for name, image in images.items() if image is not None}
+        size = sum(len(data) for data, _ in images.values())
+        with self.lock:
+            if result_id in self.items:
+                self.size -= self.items.pop(result_id)[1]
+            self.items[result_id] = (images, size)
+            self.size += size
+            while len(self.items) > self.max_items or (self.size > self.max_bytes and len(self.items) > 1):
+                _, (_, evicted_size) = self.items.popitem(last=False)
+                self.size -= evicted_size
+
+    def get(self, result_id, name):
+        """
+        Returns:
+            image: tuple, (bytes, mimetype), or None if it was evicted or never stored.
+        """
+        with self.lock:
+            if result_id not in self.items:
+                return None
+            self.items.move_to_end(result_id)
+            return self.items[result_id][0].get(name)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"items": len(self.items), "bytes": self.size, "max_items": self.max_items, "max_bytes": self.max_bytes}
@@ -0,0 +1,104 @@
+import os
+import string
+import hashlib
+import secrets
+import threading
+
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
+
+# Room codes without a lookup per attempt. Each process reserves a block of
+# counter values from the database in one statement, and every counter value
+# is mapped to a 6 character code by a keyed permutation, so consecutive games
+# do not get guessable codes and two counter values never give the same code.
+# The key is ROOM_CODE_KEY, or else a random one the first process stores
+# with the counter, never a value known from the source.
+ALPHABET = string.ascii_uppercase + string.digits
+CODE_LENGTH = 6
+KEYSPACE = len(ALPHABET) ** CODE_LENGTH   # 2,176,782,336 codes
+BLOCK_SIZE = 1000
+FEISTEL_ROUNDS = 4
+COUNTER_TABLE = "room_code_counter"
+
+
+def _round_function(key, round_index, half):
+    digest = hashlib.blake2b(half.to_bytes(2, "little"), digest_size=2, key=key, salt=round_index.to_bytes(16, "little"))
+    return int.from_bytes(digest.digest(), "little")
+
+
+def permute(value, key):
+    """
+    Map a counter value in [0, KEYSPACE) to another value of the range, one to one.
+    A 32 bit Feistel network with cycle walking, since KEYSPACE < 2**32.
+    """
+    while True:
+        left, right = value >> 16, value & 0xFFFF
+        for round_index in range(FEISTEL_ROUNDS):
+            left, right = right, left ^ _round_function(key, round_index, right)
+        value = (left << 16) | right
+        if value < KEYSPACE:
+            return value
+
+
+def encode(value):
+    chars = []
+    for _ in range(CODE_LENGTH):
+        value, digit = divmod(value, len(ALPHABET))
+        chars.append(ALPHABET[digit])
+    return "".join(reversed(chars))
+
+
+class RoomCodeAllocator():
+    """
+    Hand out room codes from blocks of a shared database counter.
+    Parameters:
+        engine: the SQLAlchemy engine holding the counter table.
+        key: bytes, the permutation key, defaults to the ROOM_CODE_KEY environment
+            variable, then to the random key stored with the counter.
+        block_size: int, the number of codes reserved per database round trip.
+    """
+    def __init__(self, engine, key=None, block_size=BLOCK_SIZE):
+        self.engine = engine
+        if key is None and os.getenv("ROOM_CODE_KEY"):
+            key = os.environ["ROOM_CODE_KEY"].encode("utf-8")
+        self.key = hashlib.blake2b(key, digest_size=16).digest() if key is not None else None
+        self.block_size = block_size
+        self.lock = threading.Lock()
+        self.next = self.end = 0
+
+    def _ensure_counter(self):
+        # The counter row and the stored key are created by the first process that
+        # needs them, a process racing it on the insert just reads them after
+        for attempt in range(2):
+            try:
+                with self.engine.begin() as conn:
+                    conn.execute(text(f"INSERT INTO {COUNTER_TABLE} (id, value) SELECT 1, 0 "
+                                      f"WHERE NOT EXISTS (SELECT 1 FROM {COUNTER_TABLE} WHERE id = 1)"))
+                    conn.execute(text(f"UPDATE {COUNTER_TABLE} SET secret = :secret WHERE id = 1 AND secret IS NULL"),
+                                 {"secret": secrets.token_hex(32)})
+                    return conn.execute(text(f"SELECT secret FROM {COUNTER_TABLE} WHERE id = 1")).scalar()
+            except IntegrityError:
+                if attempt:
+                    raise
+
+    def _reserve_block(self):
+        if self.key is None:
+            self.key = hashlib.blake2b(bytes.fromhex(self._ensure_counter()), digest_size=16).digest()
+        # The UPDATE holds the row lock until the end of the transaction, so the
+        # SELECT reads this process's new value even with concurrent reservers
+        with self.engine.begin() as conn:
+            conn.execute(text(f"UPDATE {COUNTER_TABLE} SET value = value + :size WHERE id = 1"), {"size": self.block_size})
+            end = conn.execute(text(f"SELECT value FROM {COUNTER_TABLE} WHERE id = 1")).scalar()
+        if end is None:
+            raise RuntimeError(f"The {COUNTER_TABLE} row is missing, run python migrations.py")
+        if end > KEYSPACE:
+            raise RuntimeError("Room code keyspace exhausted")
+        return end - self.block_size, end
+
+    def next_code(self):
+        with self.lock:
+            if self.next >= self.end:
+                self.next, self.end = self._reserve_block()
+            value = self.next
+            self.next += 1
+        return encode(permute(value, self.key))
@@ -1,5 +1,11 @@
 import os
-import cv2
+import time
+import logging
+import argparse
+import threading
+
+from ..metrics import span
+from ..result_store import ResultStore
 
 _this_dir = os.path.dirname(os.path.abspath(__file__))
 index = ['blank',
@@ -12,30 +18,110 @@ tile_path = os.path.join(_this_dir, "assets/")
 output_path = os.path.join(_this_dir, "../../static/outputs/output.png")
 debug_path = os.path.join(_this_dir, "debug.png")
 
-def tile_generation(tiles, output=False, save_path=None):
-    # Load images based on the tile types
-    images = []
+# All sprites are decoded once into one atlas, shape (height, 43, width, 4),
+# so tile t is atlas[:, t] and a hand is rendered with a single gather
+_atlas = None
+_atlas_lock = threading.Lock()
+logger = logging.getLogger(__name__)
+
+# PNGs of recent hands, about 130 KB each and one cache in every process
+# (the web process and each analysis worker), so bounded by bytes as well
+RENDER_CACHE_ITEMS = int(os.getenv('RENDER_CACHE_ITEMS', 256))
+RENDER_CACHE_BYTES = int(os.getenv('RENDER_CACHE_BYTES', 16 * 1024 * 1024))
+_render_cache = ResultStore(max_items=RENDER_CACHE_ITEMS, max_bytes=RENDER_CACHE_BYTES)
+
+def load_atlas():
+    global _atlas
+    if _atlas is None:
+        with _atlas_lock:
+            if _atlas is None:
+                import cv2
+                import numpy as np
+
+                sprites = {tile: cv2.imread(tile_path + index[tile] + ".png", cv2.IMREAD_UNCHANGED) for tile in range(1, 43)}
+                height, width = sprites[1].shape[:2]
+                atlas = np.zeros((height, len(index), width, 4), dtype=np.uint8)
+                for tile, sprite in sprites.items():
+                    if sprite is None or sprite.shape != (height, width, 4):
+                        raise ValueError(f"Tile sprite {index[tile]} is missing or not {width}x{height} BGRA")
+                    atlas[:, tile] = sprite
+                _atlas = atlas
+    return _atlas
+
+def render_tiles(tiles, out=None):
+    """
+    Render the tiles side by side.
+    Parameters:
+        tiles: list of int, the tiles to render.
+        out: array, optional C-contiguous uint8 buffer of shape (height, len(tiles) * width, 4) to render into.
+    Returns:
+        image: array, the BGRA image, or None if there are no valid tiles.
+    Raises:
+        ValueError: if out does not match the rendered image.
+    """
+    import numpy as np
+
+    valid = []
     for tile in tiles:
         if tile > 0 and tile < 43:
-            image = cv2.imread(tile_path + index[tile] + ".png", cv2.IMREAD_UNCHANGED)
-            images.append(image)
+            valid.append(tile)
         else:
-            print("Invalid tile type: ", tile)
-    
-    # Concatenate images horizontally
-    if images:
-        final_image = cv2.hconcat(images)
+            logger.warning("Invalid tile type: %s", tile)
+    if not valid:
+        return None
+
+    atlas = load_atlas()
+    height, _, width, channels = atlas.shape
+    shape = (height, len(valid) * width, channels)
+    if out is None:
+        out = np.empty(shape, dtype=np.uint8)
+    elif out.shape != shape or out.dtype != np.uint8 or not out.flags.c_contiguous:
+        # A reshape of any other buffer is a copy, the image would never reach it
+        raise ValueError(f"out must be a C-contiguous uint8 array of shape {shape}, "
+                         f"got {out.dtype} {out.shape}{'' if out.flags.c_contiguous else ' not contiguous'}")
+    np.take(atlas, valid, axis=1, out=out.reshape(height, len(valid), width, channels))
+    return out
+
+def _encode(tiles):
+    import cv2
+
+    with span("rendering"):
+        final_image = render_tiles(tiles)
+    if final_image is None:
+        return None
+    with span("encoding"):
+        return cv2.imencode(".png", final_image)[1].tobytes()
+
+def encode_tiles(tiles):
+    """
+    Render the tiles to PNG bytes in memory, identical hands are encoded once.
+    Returns:
+        png: bytes, or None if there are no valid tiles.
+    """
+    tiles = tuple(tiles)
+    cached = _render_cache.get(tiles, "png")
+    if cached is not None:
+        return cached[0]
+    png = _encode(tiles)
+    if png is not None:
+        _render_cache.put(tiles, {"png": (png, "image/png")})
+    return png
+
+def tile_generation(tiles, output=False, save_path=None):
+    import cv2
 
+    final_image = render_tiles(tiles)
+    if final_image is not None:
         if output:
             # Save the final image to the specified output path
             final_output_path = save_path if save_path else output_path
             cv2.imwrite(final_output_path, final_image)
-            print("Generated image saved as", output_path)
+            logger.info("Generated image saved as %s", final_output_path)
         else:
             cv2.imwrite(debug_path, final_image)
-            print("Generated image saved as", debug_path)
+            logger.info("Generated image saved as %s", debug_path)
     else:
-        print("No tiles to generate")
+        logger.info("No tiles to generate")
 
 
 def tile_translation(tile):
@@ -54,4 +140,58 @@ def tile_number(tile):
     if tile in index:
         return index.index(tile)
     else:
-        return 0  # Invalid tile name
\ No newline at end of file
+        return 0  # Invalid tile name
+
+
+# Render benchmark
+# python -m src.tile_generation.main --benchmark
+def _render_from_disk(tiles):
+    # The previous renderer, decodes every sprite from disk for every hand
+    import cv2
+
+    return cv2.hconcat([cv2.imread(tile_path + index[tile] + ".png", cv2.IMREAD_UNCHANGED) for tile in tiles])
+
+def benchmark_render(hands=500, seconds=2.0):
+    import random
+    import cv2
+    import numpy as np
+
+    rng = random.Random(0)
+    cases = [[rng.randint(1, 42) for _ in range(17)] for _ in range(hands)]
+    load_atlas()
+    for tiles in cases[:20]:
+        if not np.array_equal(_render_from_disk(tiles), render_tiles(tiles)):
+            raise AssertionError(f"Atlas render differs from disk render for {tiles}")
+
+    def rate(render):
+        count, start = 0, time.perf_counter()
+        while time.perf_counter() - start < seconds:
+            render(cases[count % hands])
+            count += 1
+        return count / (time.perf_counter() - start)
+
+    buffer = np.empty_like(render_tiles(cases[0]))
+    for tiles in cases:
+        encode_tiles(tiles)  # fill the render cache
+    results = [
+        ("disk imread + hconcat", rate(_render_from_disk)),
+        ("atlas render", rate(render_tiles)),
+        ("atlas render, reused buffer", rate(lambda tiles: render_tiles(tiles, out=buffer))),
+        ("disk render + PNG encode", rate(lambda tiles: cv2.imencode(".png", _render_from_disk(tiles)))),
+        ("atlas render + PNG encode", rate(lambda tiles: _encode(tuple(tiles)))),
+        ("encode_tiles, cached", rate(encode_tiles)),
+    ]
+    for name, renders in results:
+        print(f"{name:<30} {renders:>12,.0f} renders/s")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Mahjong tile image generation")
+    parser.add_argument("--benchmark", action="store_true", help="Measure renders/second of the disk and atlas renderers")
+    parser.add_argument("--hands", type=int, default=500, help="Number of distinct hands")
+    parser.add_argument("--seconds", type=float, default=2.0, help="Seconds per measurement")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.benchmark:
+        benchmark_render(args.hands, args.seconds)
@@ -8,11 +8,20 @@ import Results from './components/Results';
 import Game from './components/Game';
 import Lobby from './components/Lobby';
 
+export interface TaiItem {
+  name: string;
+  tai: number;
+}
+
 export interface AnalysisResult {
   money: number;
   breakdown: string;
-  uploaded_image_url: string;
-  generated_image_url: string;
+  tai: number;
+  tai_items: TaiItem[];
+  uploaded_image_url: string | null;
+  generated_image_url: string | null;
+  uploaded_image?: string | null;
+  generated_image?: string | null;
 }
 
 // Inner component so we can use useLocation for styling navigation
@@ -1,4 +1,4 @@
-import { useState, useEffect } from 'react';
+import { useState, useEffect, useRef } from 'react';
 import { useParams, useNavigate } from 'react-router-dom';
 import axios from 'axios';
 import { io } from 'socket.io-client';
@@ -21,9 +21,32 @@ interface GameState {
   round_wind: string;
   dealer_id: number;
   continues: number;
+  seq: number;
   players: Player[];
 }
 
+// Sent by the server on every win, only what changed since seq - 1
+interface GameDelta {
+  game_code: string;
+  seq: number;
+  round_wind: string;
+  dealer_id: number;
+  continues: number;
+  players: { id: number; money: number }[];
+}
+
+const applyDelta = (game: GameState, delta: GameDelta): GameState => {
+  const money = new Map(delta.players.map((p) => [p.id, p.money]));
+  return {
+    ...game,
+    seq: delta.seq,
+    round_wind: delta.round_wind,
+    dealer_id: delta.dealer_id,
+    continues: delta.continues,
+    players: game.players.map((p) => (money.has(p.id) ? { ...p, money: money.get(p.id)! } : p)),
+  };
+};
+
 const WINDS = ['East', 'South', 'West', 'North'];
 
 const Game = () => {
@@ -31,6 +54,8 @@ const Game = () => {
   const navigate = useNavigate();
   
   const [gameState, setGameState] = useState<GameState | null>(null);
+  const gameRef = useRef<GameState | null>(null);
+  gameRef.current = gameState;
 
   // Analyzer / Win Modal state
   const [showWinModal, setShowWinModal] = useState(false);
@@ -45,34 +70,71 @@ const Game = () => {
   const [error, setError] = useState<string | null>(null);
 
   useEffect(() => {
-    // 1. Fetch initial game state
-    const fetchGame = async () => {
-      try {
-        const response = await axios.get(`${API_URL}/api/game/${roomCode}`);
-        setGameState(response.data);
-      } catch (err) {
-        console.error("Game not found", err);
-        navigate('/game');
-      }
-    };
-    
     if (roomCode) {
-      fetchGame();
-      
-      // 2. Setup WebSocket
-      const newSocket = io(API_URL);
+      // 1. Setup WebSocket
+      // Websocket only, long polling needs sticky sessions across backend workers
+      const newSocket = io(API_URL, { transports: ['websocket'] });
       
-      newSocket.emit('join_game', { room_code: roomCode });
-      
-      newSocket.on('game_updated', (updatedGame: GameState) => {
-        setGameState(updatedGame);
+      // Fetch a full snapshot when a delta was missed
+      const resync = async () => {
+        try {
+          const since = gameRef.current?.seq;
+          const response = await axios.get(`${API_URL}/api/game/${roomCode}/resync`, {
+            params: since === undefined ? {} : { since },
+          });
+          if (response.data.snapshot) {
+            setGameState(response.data.snapshot);
+          }
+        } catch (err) {
+          console.error("Failed to resync game", err);
+        }
+      };
+
+      newSocket.on('game_delta', (delta: GameDelta) => {
+        const current = gameRef.current;
+        if (!current || delta.seq <= current.seq) {
+          return;
+        }
+        if (delta.seq === current.seq + 1) {
+          gameRef.current = applyDelta(current, delta);
+          setGameState(gameRef.current);
+        } else {
+          resync();
+        }
+      });
+
+      // Every connection gets a new sid, so the room is joined again on each
+      // one, then deltas sent while the socket was disconnected are fetched
+      newSocket.on('connect', () => {
+        newSocket.emit('join_game', { room_code: roomCode });
+        if (gameRef.current) {
+          resync();
+        }
       });
 
       newSocket.on('game_ended', () => {
         alert('This game has been ended and recorded data deleted.');
         navigate('/game');
       });
-      
+
+      // 2. Fetch initial game state
+      const fetchGame = async () => {
+        try {
+          const response = await axios.get(`${API_URL}/api/game/${roomCode}/summary`);
+          gameRef.current = response.data;
+          setGameState(response.data);
+          // Joined before the summary arrived, a win in between was ignored
+          if (newSocket.connected) {
+            resync();
+          }
+        } catch (err) {
+          console.error("Game not found", err);
+          navigate('/game');
+        }
+      };
+
+      fetchGame();
+
       return () => {
         newSocket.disconnect();
       };
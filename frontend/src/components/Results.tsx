@@ -15,11 +15,15 @@ const Results: React.FC<ResultsProps> = ({ result, onReset }) => {
       <div className="results-grid">
         <div className="result-card">
           <h3>Your Hand</h3>
-          <img src={`${API_URL}${result.uploaded_image_url}`} alt="Uploaded Hand" />
+          <img src={result.uploaded_image ?? `${API_URL}${result.uploaded_image_url}`} alt="Uploaded Hand" />
         </div>
         <div className="result-card">
           <h3>Winning Breakdown</h3>
-          <img src={`${API_URL}${result.generated_image_url}`} alt="Generated Winning Hand" />
+          {result.generated_image || result.generated_image_url ? (
+            <img src={result.generated_image ?? `${API_URL}${result.generated_image_url}`} alt="Generated Winning Hand" />
+          ) : (
+            <p>No winning hand found</p>
+          )}
         </div>
       </div>
 
@@ -28,6 +32,14 @@ const Results: React.FC<ResultsProps> = ({ result, onReset }) => {
           <h3>Breakdown Data</h3>
           <pre>{result.breakdown}</pre>
         </div>
+        <div className="detail-card">
+          <h3>Tai ({result.tai})</h3>
+          <ul>
+            {result.tai_items.map((item) => (
+              <li key={item.name}>{item.name.replace(/_/g, ' ')}: {item.tai}</li>
+            ))}
+          </ul>
+        </div>
         <div className="detail-card">
           <h3>Final Money</h3>
           <pre>{result.money}</pre>
@@ -35,6 +35,8 @@ const UploadForm: React.FC<UploadFormProps> = ({ onAnalyze, loading }) => {
 
     const formData = new FormData();
     formData.append('file', file);
+    // Images come back in the response, so any backend worker can serve the analysis
+    formData.append('inline', '1');
     Object.entries(settings).forEach(([key, value]) => {
       formData.append(key, String(value));
     });